@@ -0,0 +1,234 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+import numpy as np
+
+try:
+    import faiss
+except ImportError:  # faiss-cpu is optional, the exact engine works without it
+    faiss = None
+
+# Below this many tracks brute force is already fast enough, no ANN index is built
+ANN_MIN_TRACKS = int(os.getenv("ANN_MIN_TRACKS", 5000))
+# From this many tracks on IVF is used instead of HNSW (cheaper to build, less RAM)
+ANN_IVF_MIN_TRACKS = int(os.getenv("ANN_IVF_MIN_TRACKS", 200000))
+
+HNSW_M = int(os.getenv("ANN_HNSW_M", 32))
+HNSW_EF_CONSTRUCTION = int(os.getenv("ANN_HNSW_EF_CONSTRUCTION", 200))
+HNSW_EF_SEARCH = int(os.getenv("ANN_HNSW_EF_SEARCH", 128))
+IVF_NPROBE = int(os.getenv("ANN_IVF_NPROBE", 16))
+IVF_TRAIN_POINTS_PER_LIST = 64
+
+# How the ANN indexes store the vectors: "flat" (float32), "fp16" (2x smaller),
+# "sq8" (8-bit scalar quantizer, 4x) or "pq" (product quantization, ~8x).
+# Compressed indexes only produce a shortlist that is re-ranked exactly.
+ANN_STORAGE = os.getenv("ANN_STORAGE", "flat")
+STORAGES = ("flat", "fp16", "sq8", "pq")
+# Dimensions per PQ sub-quantizer (one byte each), i.e. 4 * ANN_PQ_DIMS times smaller than float32
+ANN_PQ_DIMS = int(os.getenv("ANN_PQ_DIMS", 2))
+# Points used to train quantizers that need it (sq8, pq)
+QUANTIZER_TRAIN_POINTS = 100000
+
+
+def _pq_subquantizers(d):
+    """Largest number of PQ sub-quantizers that divides d with >= ANN_PQ_DIMS dimensions each."""
+    m = max(1, d // ANN_PQ_DIMS)
+    while d % m:
+        m -= 1
+    return m
+
+
+def _train_sample(x, n):
+    if n >= len(x):
+        return x
+    return x[np.random.default_rng(0).choice(len(x), n, replace=False)]
+
+
+class _SearchLock:
+    """Any number of searches at once, or one add; a waiting add goes first."""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._searching = 0
+        self._adding = False
+        self._adds_waiting = 0
+
+    @contextmanager
+    def search(self):
+        with self._cond:
+            while self._adding or self._adds_waiting:
+                self._cond.wait()
+            self._searching += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._searching -= 1
+                if not self._searching:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def add(self):
+        with self._cond:
+            self._adds_waiting += 1
+            while self._adding or self._searching:
+                self._cond.wait()
+            self._adds_waiting -= 1
+            self._adding = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._adding = False
+                self._cond.notify_all()
+
+
+def is_available():
+    return faiss is not None
+
+
+def choose_index_kind(n_tracks):
+    """Returns "hnsw", "ivf" or None (library too small to bother)."""
+    if faiss is None or n_tracks < ANN_MIN_TRACKS:
+        return None
+    return "hnsw" if n_tracks < ANN_IVF_MIN_TRACKS else "ivf"
+
+
+class AnnIndex:
+    """
+    Approximate nearest-neighbour index over the combined track vectors.
+    Row i of the index is row i of the matrix it was built from, so search
+    results can be mapped back to track ids with the same ids array.
+    With compressed `storage` its distances are approximate and callers
+    should re-rank the results exactly (see `compressed`).
+
+    FAISS indexes can be searched from several threads at once but must not
+    change meanwhile, so add() waits for running searches and holds off new ones.
+    """
+
+    def __init__(self, index, kind, metric, storage="flat"):
+        self.index = index
+        self.kind = kind
+        self.metric = metric
+        self.storage = storage
+        self._lock = _SearchLock()
+
+    @property
+    def compressed(self):
+        return self.storage != "flat"
+
+    @property
+    def vector_bytes(self):
+        """Bytes the index spends on the stored vectors (graph and lists not counted)."""
+        codes = faiss.downcast_index(self.index.storage) if self.kind == "hnsw" else self.index
+        return codes.code_size * self.ntotal
+
+    def save(self, path):
+        faiss.write_index(self.index, path)
+
+    @classmethod
+    def load(cls, path, kind, metric, storage="flat"):
+        if faiss is None:
+            raise RuntimeError("faiss is not installed")
+        index = faiss.read_index(path)
+        if kind == "hnsw":
+            index.hnsw.efSearch = HNSW_EF_SEARCH
+        elif kind == "ivf":
+            index.nprobe = IVF_NPROBE
+        return cls(index, kind, metric, storage)
+
+    @property
+    def ntotal(self):
+        return self.index.ntotal
+
+    @staticmethod
+    def _prepare(vectors, metric):
+        x = np.ascontiguousarray(vectors, dtype="float32")
+        if metric == "cosine":
+            # Cosine distance is inner product on unit vectors
+            x = x.copy()
+            faiss.normalize_L2(x)
+        return x
+
+    @classmethod
+    def build(cls, vectors, metric="cosine", kind=None, storage=None):
+        if faiss is None:
+            raise RuntimeError("faiss is not installed")
+        if metric not in ("cosine", "euclidean"):
+            raise ValueError("Неизвестная метрика")
+        storage = storage or ANN_STORAGE
+        if storage not in STORAGES:
+            raise ValueError(f"Unknown ANN storage: {storage}")
+
+        t0 = time.perf_counter()
+        n, d = vectors.shape
+        kind = kind or choose_index_kind(n) or "hnsw"
+        faiss_metric = faiss.METRIC_INNER_PRODUCT if metric == "cosine" else faiss.METRIC_L2
+        qtypes = {"fp16": faiss.ScalarQuantizer.QT_fp16, "sq8": faiss.ScalarQuantizer.QT_8bit}
+        x = cls._prepare(vectors, metric)
+
+        if kind == "hnsw":
+            if storage == "flat":
+                index = faiss.IndexHNSWFlat(d, HNSW_M, faiss_metric)
+            elif storage == "pq":
+                # HNSW+PQ is L2 only; on the unit vectors used for cosine it ranks the same
+                index = faiss.IndexHNSWPQ(d, _pq_subquantizers(d), HNSW_M)
+            else:
+                index = faiss.IndexHNSWSQ(d, qtypes[storage], HNSW_M, faiss_metric)
+            index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+            if not index.is_trained:
+                index.train(_train_sample(x, QUANTIZER_TRAIN_POINTS))
+            index.add(x)
+            index.hnsw.efSearch = HNSW_EF_SEARCH
+        elif kind == "ivf":
+            nlist = max(1, int(4 * np.sqrt(n)))
+            quantizer = faiss.IndexFlat(d, faiss_metric)
+            if storage == "flat":
+                index = faiss.IndexIVFFlat(quantizer, d, nlist, faiss_metric)
+            elif storage == "pq":
+                index = faiss.IndexIVFPQ(quantizer, d, nlist, _pq_subquantizers(d), 8, faiss_metric)
+            else:
+                index = faiss.IndexIVFScalarQuantizer(quantizer, d, nlist, qtypes[storage], faiss_metric)
+            n_train = max(nlist * IVF_TRAIN_POINTS_PER_LIST, QUANTIZER_TRAIN_POINTS if storage != "flat" else 0)
+            index.train(_train_sample(x, n_train))
+            index.add(x)
+            index.nprobe = IVF_NPROBE
+        else:
+            raise ValueError(f"Unknown ANN index kind: {kind}")
+
+        print(f"[TIMER] build ANN index ({kind}, {storage}, {metric}, {n} tracks): {time.perf_counter() - t0:.3f} сек")
+        return cls(index, kind, metric, storage)
+
+    def add(self, vectors):
+        """Appends rows; they get the next row numbers, matching an append to the vectors matrix."""
+        if len(vectors):
+            x = self._prepare(vectors, self.metric)
+            with self._lock.add():
+                self.index.add(x)
+
+    def search(self, query, k):
+        """
+        Returns (rows, distances) for the k nearest rows, closest first.
+        Distances are on the same scale as the exact engine:
+        1 - cos for cosine, plain L2 for euclidean.
+        """
+        k = min(k, self.ntotal)
+        if k <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype="float32")
+
+        q = self._prepare(np.asarray(query).reshape(1, -1), self.metric)
+        with self._lock.search():
+            scores, rows = self.index.search(q, k)
+        scores, rows = scores[0], rows[0]
+        valid = rows >= 0
+        scores, rows = scores[valid], rows[valid]
+
+        if self.metric == "cosine" and self.index.metric_type == faiss.METRIC_L2:
+            # |a - b|² = 2 - 2·cos for unit vectors
+            dists = scores / 2
+        elif self.metric == "cosine":
+            dists = 1 - scores
+        else:
+            dists = np.sqrt(np.maximum(scores, 0))
+        return rows, dists
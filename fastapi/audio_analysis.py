@@ -0,0 +1,325 @@
+import os
+os.environ["TORCHCODEC_DISABLE"] = "1"
+
+import asyncio
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import librosa
+import numpy as np
+import torch
+from transformers import pipeline
+
+from classifier_backends import CLASSIFIER_BACKEND, use_backend
+from model_registry import MODELS
+from pipeline import run_batches
+
+CLASSIFIER_MODEL = "MIT/ast-finetuned-audioset-10-10-0.4593"
+
+# "thread" analyses files in the event loop's thread pool with one shared
+# classifier, "process" in a pool of worker processes with one classifier each
+SCAN_EXECUTOR = os.getenv("SCAN_EXECUTOR", "thread")
+SCAN_WORKERS = int(os.getenv("SCAN_WORKERS", os.cpu_count() or 4))
+# torch intra-op threads per worker process (0: cores / workers)
+SCAN_TORCH_THREADS = int(os.getenv("SCAN_TORCH_THREADS", 0))
+
+# Thread mode: clips of concurrent files are classified together in batches
+# of up to GENRE_BATCH_SIZE, waiting at most GENRE_BATCH_MAX_WAIT seconds
+# for a batch to fill up (1 classifies every file on its own)
+GENRE_BATCH_SIZE = int(os.getenv("GENRE_BATCH_SIZE", 8))
+GENRE_BATCH_MAX_WAIT = float(os.getenv("GENRE_BATCH_MAX_WAIT", 0.05))
+
+# Audio features are computed on FEATURE_DURATION seconds from FEATURE_OFFSET
+# at FEATURE_SR; the classifier sees the first CLASSIFIER_CLIP seconds at
+# CLASSIFIER_SR (AST keeps 1024 frames of 10 ms and drops the rest)
+FEATURE_SR = 8000
+FEATURE_OFFSET = 20.0
+FEATURE_DURATION = 30.0
+CLASSIFIER_SR = 16000
+CLASSIFIER_CLIP = 10.24
+# librosa's defaults, shared by all spectral features
+STFT_N_FFT = 2048
+STFT_HOP = 512
+
+KEYS = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
+
+
+# Input of the AST classification head (the pooled CLS/distillation tokens)
+# of the last forward pass in each thread, see _tap_embeddings
+_pooled = threading.local()
+
+
+def load_classifier(backend=CLASSIFIER_BACKEND):
+    """The genre classifier pipeline, running on `backend` (see classifier_backends)."""
+    classifier = pipeline("audio-classification", model=CLASSIFIER_MODEL)
+    if backend != "torch":
+        silence = np.zeros(int(CLASSIFIER_CLIP * CLASSIFIER_SR), dtype=np.float32)
+        use_backend(classifier, backend, CLASSIFIER_MODEL, classifier.preprocess(silence, **classifier._preprocess_params))
+    _tap_embeddings(classifier)
+    return classifier
+
+
+# Thread mode shares one classifier per process: loaded by the first scan
+# that needs it, see ModelRegistry for unloading
+MODELS.register("classifier", load_classifier)
+
+
+def _keep_pooled(pooled):
+    _pooled.value = pooled.detach()
+
+
+def _tap_embeddings(classifier):
+    """
+    Keeps the pooled embedding the classification head receives, so every
+    forward pass yields the track embedding along with the label scores at
+    no extra cost. Models without such a head simply yield no embeddings.
+    """
+    model = getattr(classifier, "model", None)
+    if hasattr(model, "pooled_callback"):
+        # Not a torch model (ONNX backend), it reports the embedding itself
+        model.pooled_callback = _keep_pooled
+        return
+    head = getattr(model, "classifier", None)
+    if head is None or not hasattr(head, "register_forward_hook"):
+        print(f"[WARN] {CLASSIFIER_MODEL}: no classification head found, track embeddings are not stored")
+        return
+    head.register_forward_hook(lambda module, inputs, output: _keep_pooled(inputs[0]))
+
+
+def _take_pooled():
+    """float16 (batch, dim) embeddings of this thread's last forward pass, or None."""
+    pooled = getattr(_pooled, "value", None)
+    _pooled.value = None
+    if pooled is None:
+        return None
+    return pooled.float().cpu().numpy().astype(np.float16)
+
+
+def _top_genres(result, file_path, topn=50):
+    if not result:
+        print(f"[WARNING] Classifier returned empty result for {file_path}.")
+        return []
+    return [r for r in sorted(result, key=lambda x: x['score'], reverse=True) if r['label'].lower() != "music"][:topn]
+
+
+def extract_genres(classifier, clip, file_path, topn=50):
+    """
+    (genres, embedding) of a CLASSIFIER_SR clip (see decode_audio); file_path
+    is only used in messages. The embedding is None if the model gave none.
+    """
+    try:
+        genres = _top_genres(classifier(clip), file_path, topn)
+    except Exception as e:
+        print(f"[ERROR] Classifier failed for {file_path}: {e}")
+        return [], None
+    pooled = _take_pooled()
+    return genres, pooled[0] if pooled is not None else None
+
+
+class GenreBatcher:
+    """
+    Batches genre classification of concurrently scanned files.
+
+    classify() preprocesses a clip (AST filterbank) in the thread pool and
+    queues it; a single consumer task takes up to `batch_size`
+    queued clips, waiting at most `max_wait` seconds after the first one,
+    and runs them through the model in one forward pass. Results are
+    post-processed exactly like a plain pipeline call; like extract_genres,
+    classify() returns (genres, embedding).
+    """
+
+    def __init__(self, classifier, batch_size=GENRE_BATCH_SIZE, max_wait=GENRE_BATCH_MAX_WAIT, stats=None):
+        self.classifier = classifier
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.stats = stats
+        self._queue = asyncio.Queue()
+        self._consumer = None
+
+    async def classify(self, clip, file_path, topn=50):
+        loop = asyncio.get_running_loop()
+        try:
+            inputs = await loop.run_in_executor(None, self._preprocess, clip)
+        except Exception as e:
+            print(f"[ERROR] Classifier failed for {file_path}: {e}")
+            return [], None
+
+        if self._consumer is None:
+            self._consumer = asyncio.create_task(self._consume())
+        result = loop.create_future()
+        await self._queue.put((inputs, result))
+        try:
+            scores, embedding = await result
+            return _top_genres(scores, file_path, topn), embedding
+        except Exception as e:
+            print(f"[ERROR] Classifier failed for {file_path}: {e}")
+            return [], None
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def close(self):
+        if self._consumer is not None:
+            self._consumer.cancel()
+            self._consumer = None
+
+    def _preprocess(self, clip):
+        return self.classifier.preprocess(clip, **self.classifier._preprocess_params)
+
+    def _forward(self, batch):
+        t0 = time.perf_counter()
+        inputs = {key: torch.cat([item[key] for item in batch]) if torch.is_tensor(batch[0][key]) else batch[0][key]
+                  for key in batch[0]}
+        outputs = self.classifier.forward(inputs, **self.classifier._forward_params)
+        pooled = _take_pooled()
+        # Split the batch back into single-clip outputs of the model's own output class
+        results = [(self.classifier.postprocess(type(outputs)(logits=outputs.logits[i:i + 1]),
+                                                **self.classifier._postprocess_params),
+                    pooled[i] if pooled is not None else None)
+                   for i in range(len(batch))]
+        elapsed = time.perf_counter() - t0
+        if self.stats is not None:
+            self.stats.record("genre_batch", elapsed)
+        print(f"[TIMER] классификация пачки из {len(batch)}: {elapsed:.3f} сек")
+        return results
+
+    async def _consume(self):
+        await run_batches(self._queue, self._forward, self.batch_size, self.max_wait)
+
+
+def decode_audio(file_path):
+    """
+    Decodes a file once and resamples it in memory for both consumers.
+    Returns (feature_signal at FEATURE_SR, classifier_clip at CLASSIFIER_SR),
+    or None if the file cannot be decoded or has no audio in the feature window.
+    """
+    try:
+        # Native rate, only as far as the later of the two windows reaches
+        y, sr = librosa.load(file_path, sr=None, mono=True,
+                             duration=max(FEATURE_OFFSET + FEATURE_DURATION, CLASSIFIER_CLIP))
+    except Exception as e:
+        print(f"[ERROR] librosa.load failed for {file_path}: {e}")
+        return None
+
+    segment = y[int(FEATURE_OFFSET * sr):int((FEATURE_OFFSET + FEATURE_DURATION) * sr)]
+    if segment.size == 0:
+        print(f"[WARNING] Loaded empty audio signal from {file_path}. Skipping.")
+        return None
+    signal = librosa.resample(segment, orig_sr=sr, target_sr=FEATURE_SR)
+    clip = librosa.resample(y[:int(CLASSIFIER_CLIP * sr)], orig_sr=sr, target_sr=CLASSIFIER_SR)
+    return signal, clip
+
+
+def _finite_features(features, file_path):
+    for key, value in features.items():
+        if isinstance(value, (int, float)) and not np.isfinite(value):
+            print(f"[WARNING] Non-finite value for feature '{key}' in file {file_path}. Skipping file.")
+            return None
+    return features
+
+
+def extract_audio_features(y, file_path, sr=FEATURE_SR):
+    """
+    Features of a FEATURE_SR signal (see decode_audio); file_path is only used in messages.
+
+    One STFT (librosa's default n_fft/hop/window/padding) feeds every spectral
+    descriptor: the magnitude goes to centroid, bandwidth and rolloff, its
+    square to chroma and the mel spectrogram, whose dB version is shared by
+    the onset envelope and the MFCCs. librosa derives exactly these from `y`
+    when called separately, so the values match extract_audio_features_reference.
+    RMS and zero crossings are computed on the frames of `y`, as before.
+    """
+    magnitude = np.abs(librosa.stft(y, n_fft=STFT_N_FFT, hop_length=STFT_HOP, pad_mode="constant"))
+    power = magnitude ** 2
+    log_mel = librosa.power_to_db(librosa.feature.melspectrogram(S=power, sr=sr))
+    onset_env = librosa.onset.onset_strength(S=log_mel, sr=sr)
+    mfcc = librosa.feature.mfcc(S=log_mel, n_mfcc=13)
+
+    features = {
+        "bpm": float(librosa.beat.tempo(onset_envelope=onset_env, sr=sr)[0]),
+        "key": KEYS[librosa.feature.chroma_stft(S=power, sr=sr).mean(axis=1).argmax()],
+        "rms_energy": float(librosa.feature.rms(y=y).mean()),
+        "spectral_centroid": float(librosa.feature.spectral_centroid(S=magnitude, sr=sr).mean()),
+        "spectral_bandwidth": float(librosa.feature.spectral_bandwidth(S=magnitude, sr=sr).mean()),
+        "spectral_rolloff": float(librosa.feature.spectral_rolloff(S=magnitude, sr=sr).mean()),
+        "zero_crossing_rate": float(librosa.feature.zero_crossing_rate(y).mean()),
+        "mfcc1": float(mfcc[0].mean()), "mfcc2": float(mfcc[1].mean()), "mfcc3": float(mfcc[2].mean()),
+    }
+    return _finite_features(features, file_path)
+
+
+def extract_audio_features_reference(y, file_path, sr=FEATURE_SR):
+    """
+    The same features with one librosa call per descriptor, each computing
+    its own STFT or mel spectrogram. Kept to check and time
+    extract_audio_features against (feature_benchmark.py).
+    """
+    onset_env = librosa.onset.onset_strength(y=y, sr=sr)
+    mfcc = librosa.feature.mfcc(y=y, sr=sr, n_mfcc=13)
+
+    features = {
+        "bpm": float(librosa.beat.tempo(onset_envelope=onset_env, sr=sr)[0]),
+        "key": KEYS[librosa.feature.chroma_stft(y=y, sr=sr).mean(axis=1).argmax()],
+        "rms_energy": float(librosa.feature.rms(y=y).mean()),
+        "spectral_centroid": float(librosa.feature.spectral_centroid(y=y, sr=sr).mean()),
+        "spectral_bandwidth": float(librosa.feature.spectral_bandwidth(y=y, sr=sr).mean()),
+        "spectral_rolloff": float(librosa.feature.spectral_rolloff(y=y, sr=sr).mean()),
+        "zero_crossing_rate": float(librosa.feature.zero_crossing_rate(y).mean()),
+        "mfcc1": float(mfcc[0].mean()), "mfcc2": float(mfcc[1].mean()), "mfcc3": float(mfcc[2].mean()),
+    }
+    return _finite_features(features, file_path)
+
+
+# -------------------------------------------------------------
+# PROCESS POOL
+# -------------------------------------------------------------
+# Each worker process loads its own classifier once, in init_worker, and
+# then analyses files end-to-end; only the feature dict, the genre list and
+# the float16 embedding travel back to the event loop, never the decoded audio.
+
+_worker_classifier = None
+
+
+def init_worker(torch_threads):
+    global _worker_classifier
+    torch.set_num_threads(torch_threads)
+    _worker_classifier = load_classifier()
+
+
+def analyze_file(file_path):
+    """
+    Returns (features, genres, embedding, stage timings) of a file; features
+    are None if it could not be analysed.
+    """
+    timings = {}
+    t0 = time.perf_counter()
+    decoded = decode_audio(file_path)
+    timings["decode"] = time.perf_counter() - t0
+    if decoded is None:
+        return None, [], None, timings
+    signal, clip = decoded
+
+    t0 = time.perf_counter()
+    feats = extract_audio_features(signal, file_path)
+    timings["features"] = time.perf_counter() - t0
+    if feats is None:
+        return None, [], None, timings
+
+    t0 = time.perf_counter()
+    genres, embedding = extract_genres(_worker_classifier, clip, file_path)
+    timings["genres"] = time.perf_counter() - t0
+    return feats, genres, embedding, timings
+
+
+def create_process_pool(workers=SCAN_WORKERS, torch_threads=SCAN_TORCH_THREADS):
+    torch_threads = torch_threads or max(1, (os.cpu_count() or 1) // workers)
+    print(f"Starting {workers} analysis workers with {torch_threads} torch threads each")
+    # spawn: forking a process that already runs torch/uvicorn threads is not safe
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_worker,
+        initargs=(torch_threads,),
+    )
@@ -0,0 +1,284 @@
+"""
+Benchmark of the similarity engine on synthetic libraries, no MySQL needed.
+
+    python benchmark.py                                  # 10k, 100k and 1M tracks
+    python benchmark.py --sizes 10000 --output bench.json
+    python benchmark.py --output new.json --compare old.json
+    python benchmark.py --ann-storage pq --compare new.json
+
+For every library size it reports the precompute time (build_index, i.e.
+precompute_data without the DB load) and the peak RSS of the process, the
+p50/p99 latency of a single-track query per metric and engine, and for
+the ANN engine its recall@k against exact search and the memory its stored
+vectors take. Each size runs in a fresh process so peak RSS is not carried
+over from a smaller run. Results are written as JSON so runs of different
+versions can be compared.
+"""
+import argparse
+import concurrent.futures
+import contextlib
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import time
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # Windows: peak RSS is not reported
+    resource = None
+
+DEFAULT_SIZES = (10_000, 100_000, 1_000_000)
+# AudioSet has 527 classes and the scanner stores the top 50 of each track
+N_LABELS = 527
+GENRES_PER_TRACK = 50
+# Tracks are drawn around this many "styles" so neighbourhoods look like a real library
+N_STYLES = 64
+ROWS_CHUNK = 65536
+# Tracks per block when sampling genres, bounds the n_labels-wide scratch arrays
+SAMPLE_CHUNK = 8192
+
+
+class SyntheticRows:
+    """
+    Read-only list of DB-like dict rows built on the fly from column arrays,
+    so a 1M-track library does not need tens of millions of dicts in memory.
+    `decode` maps a column to the list its integer values index into.
+    """
+
+    def __init__(self, columns, decode=None):
+        self.columns = columns
+        self.decode = decode or {}
+        self._len = len(next(iter(columns.values())))
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        names = list(self.columns)
+        for start in range(0, self._len, ROWS_CHUNK):
+            values = []
+            for name in names:
+                chunk = self.columns[name][start:start + ROWS_CHUNK].tolist()
+                if name in self.decode:
+                    chunk = [self.decode[name][v] for v in chunk]
+                values.append(chunk)
+            for row in zip(*values):
+                yield dict(zip(names, row))
+
+
+class _FileNames:
+    def __getitem__(self, track_id):
+        return f"synthetic/{track_id}.mp3"
+
+
+def make_library(n_tracks, n_labels=N_LABELS, genres_per_track=GENRES_PER_TRACK, seed=0):
+    """Returns (features, genres) rows shaped like load_features()/load_genres() output."""
+    rng = np.random.default_rng(seed)
+    style = rng.integers(0, N_STYLES, n_tracks)
+
+    # Raw feature ranges roughly as librosa reports them for our library
+    mean = np.array([120, 0.15, 2200, 2000, 4500, 0.08, -150, 110, 10])
+    std = np.array([25, 0.07, 600, 400, 1200, 0.03, 60, 25, 20])
+    style_offset = rng.normal(0, 0.7, (N_STYLES, len(mean)))
+    raw = mean + (style_offset[style] + rng.normal(0, 0.7, (n_tracks, len(mean)))) * std
+    names = ["bpm", "rms_energy", "spectral_centroid", "spectral_bandwidth", "spectral_rolloff",
+             "zero_crossing_rate", "mfcc1", "mfcc2", "mfcc3"]
+    features = SyntheticRows({
+        "id": np.arange(1, n_tracks + 1),
+        "file": np.arange(1, n_tracks + 1),
+        **{name: raw[:, i] for i, name in enumerate(names)},
+    }, decode={"file": _FileNames()})
+
+    # Every style prefers a few labels on top of a long-tailed global popularity
+    labels = [f"label_{i:03d}" for i in range(n_labels)]
+    popularity = np.log(1 / np.arange(1, n_labels + 1))
+    style_logits = popularity + 3 * rng.dirichlet(np.full(n_labels, 0.05), N_STYLES)
+    per = min(genres_per_track, n_labels)
+    label_ids = np.empty((n_tracks, per), dtype=np.int16)
+    for start in range(0, n_tracks, SAMPLE_CHUNK):
+        rows = slice(start, start + SAMPLE_CHUNK)
+        # Gumbel top-k: `per` distinct labels per track, sampled from its style
+        keys = style_logits[style[rows]] + rng.gumbel(size=(len(style[rows]), n_labels))
+        label_ids[rows] = np.argpartition(-keys, per - 1, axis=1)[:, :per]
+    # Classifier scores: a few confident labels, then a long tail of small ones
+    scores = np.sort(rng.beta(0.3, 4, (n_tracks, per)), axis=1)[:, ::-1].astype("float32")
+
+    genres = SyntheticRows({
+        "track_id": np.repeat(np.arange(1, n_tracks + 1), per),
+        "label": label_ids.ravel(),
+        "score": scores.ravel(),
+    }, decode={"label": labels})
+    return features, genres
+
+
+def _peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+
+def _latency_stats(seconds):
+    ms = np.asarray(seconds) * 1000
+    return {
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p99_ms": float(np.percentile(ms, 99)),
+        "mean_ms": float(ms.mean()),
+    }
+
+
+def run_size(n_tracks, queries, top_n, k, genres_per_track, seed):
+    """Benchmarks one library size; meant to run in a process of its own."""
+    # Keep the engine's [TIMER] output off stdout, which may carry the report
+    with contextlib.redirect_stdout(sys.stderr):
+        return _run_size(n_tracks, queries, top_n, k, genres_per_track, seed)
+
+
+def _run_size(n_tracks, queries, top_n, k, genres_per_track, seed):
+    import get_vector
+    from ann_index import choose_index_kind
+
+    features, genres = make_library(n_tracks, genres_per_track=genres_per_track, seed=seed)
+    rss_data = _peak_rss_mb()
+
+    t0 = time.perf_counter()
+    index = get_vector.build_index(features, genres)
+    precompute_sec = time.perf_counter() - t0
+    rss_precompute = _peak_rss_mb()
+
+    rng = np.random.default_rng(seed + 1)
+    query_ids = index.ids[rng.choice(len(index), min(queries, len(index)), replace=False)].tolist()
+    engines = {}
+    for metric in ("cosine", "euclidean"):
+        exact_times, exact_top = [], []
+        for track_id in query_ids:
+            t = time.perf_counter()
+            rows, _ = index.exact_search(track_id, k, metric)
+            exact_times.append(time.perf_counter() - t)
+            exact_top.append(set(rows[:top_n].tolist()))
+        engines[metric] = {"exact": _latency_stats(exact_times)}
+
+        if choose_index_kind(len(index)) is None:
+            continue
+        t = time.perf_counter()
+        ann = index.get_ann(metric)
+        build_sec = time.perf_counter() - t
+        if ann is None:
+            continue
+        ann_times, hits = [], 0
+        for track_id, expected in zip(query_ids, exact_top):
+            t = time.perf_counter()
+            rows, _ = index.ann_search(track_id, k, metric)
+            ann_times.append(time.perf_counter() - t)
+            hits += len(expected.intersection(rows[:top_n].tolist()))
+        engines[metric]["ann"] = {
+            **_latency_stats(ann_times),
+            "kind": ann.kind,
+            "storage": ann.storage,
+            "vectors_mb": ann.vector_bytes / 1024 ** 2,
+            # Zero for the eagerly built cosine index, which is part of precompute
+            "build_sec": build_sec,
+            "recall_at_top_n": hits / max(sum(len(e) for e in exact_top), 1),
+        }
+
+    return {
+        "n_tracks": n_tracks,
+        "n_labels": len(index.labels),
+        "genre_scores": int(index.nnz),
+        "precompute_sec": precompute_sec,
+        "peak_rss_data_mb": rss_data,
+        "peak_rss_mb": _peak_rss_mb(),
+        "peak_rss_precompute_mb": rss_precompute,
+        "queries": len(query_ids),
+        "k": k,
+        "engines": engines,
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old, new):
+    """Prints new/old ratios of the headline numbers for sizes present in both reports."""
+    old_by_size = {r["n_tracks"]: r for r in old["results"]}
+    print(f"\nСравнение с {old.get('git_commit')} (новое / старое, < 1 лучше):")
+    for r in new["results"]:
+        o = old_by_size.get(r["n_tracks"])
+        if o is None:
+            continue
+        print(f"  {r['n_tracks']} треков: precompute {r['precompute_sec'] / o['precompute_sec']:.2f}x"
+              + (f", peak RSS {r['peak_rss_mb'] / o['peak_rss_mb']:.2f}x" if r["peak_rss_mb"] and o["peak_rss_mb"] else ""))
+        for metric, engines in r["engines"].items():
+            for engine, stats in engines.items():
+                prev = o["engines"].get(metric, {}).get(engine)
+                if prev:
+                    print(f"    {metric}/{engine}: p50 {stats['p50_ms'] / prev['p50_ms']:.2f}x, "
+                          f"p99 {stats['p99_ms'] / prev['p99_ms']:.2f}x")
+
+
+def main():
+    import ann_index
+    parser = argparse.ArgumentParser(description="Similarity engine benchmark on synthetic libraries")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument("--queries", type=int, default=200, help="single-track queries per metric and engine")
+    parser.add_argument("--top-n", type=int, default=10, help="recall is measured at this k")
+    parser.add_argument("--k", type=int, default=None,
+                        help="neighbours per query (default: top_n + CACHE_EXTRA_NEIGHBOURS, as on a cache miss)")
+    parser.add_argument("--genres-per-track", type=int, default=GENRES_PER_TRACK)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--ann-storage", choices=ann_index.STORAGES, default=ann_index.ANN_STORAGE,
+                        help="vector storage of the ANN indexes (ANN_STORAGE)")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--compare", help="JSON report of a previous run to compare against")
+    args = parser.parse_args()
+    # The benchmark processes read it from the environment they inherit
+    os.environ["ANN_STORAGE"] = args.ann_storage
+
+    if args.k is None:
+        from get_vector import CACHE_EXTRA_NEIGHBOURS
+        args.k = args.top_n + CACHE_EXTRA_NEIGHBOURS
+
+    report = {
+        "benchmark": "similarity",
+        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "git_commit": _git_commit(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "faiss": ann_index.is_available(),
+        "cpu_count": os.cpu_count(),
+        "config": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+        "results": [],
+    }
+    ctx = multiprocessing.get_context("spawn")
+    for n_tracks in args.sizes:
+        print(f"[BENCH] {n_tracks} треков...", file=sys.stderr)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+            result = pool.submit(run_size, n_tracks, args.queries, args.top_n, args.k,
+                                 args.genres_per_track, args.seed).result()
+        report["results"].append(result)
+
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
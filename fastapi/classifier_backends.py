@@ -0,0 +1,137 @@
+import os
+import time
+
+import numpy as np
+import torch
+
+try:
+    import onnxruntime
+except ImportError:  # onnxruntime is optional, only CLASSIFIER_BACKEND=onnx needs it
+    onnxruntime = None
+
+# How the genre classifier runs on CPU: "torch" (fp32, default), "int8"
+# (dynamically quantized Linear layers) or "onnx" (the model exported once
+# to ONNX_MODEL_DIR and run by onnxruntime). classifier_benchmark.py checks
+# a backend against fp32 before switching.
+CLASSIFIER_BACKEND = os.getenv("CLASSIFIER_BACKEND", "torch")
+BACKENDS = ("torch", "int8", "onnx")
+ONNX_MODEL_DIR = os.getenv("ONNX_MODEL_DIR", os.path.join(os.path.dirname(__file__), "cache", "models"))
+ONNX_OPSET = 17
+
+
+def available_backends():
+    return [b for b in BACKENDS if b != "onnx" or onnxruntime is not None]
+
+
+def use_backend(classifier, backend, model_name, sample_inputs):
+    """
+    Swaps the torch model of an audio-classification pipeline for the given
+    backend, in place. `sample_inputs` are preprocessed inputs of one clip
+    (used to trace the ONNX export). Falls back to fp32 torch, with a
+    warning, when the backend cannot be used.
+    """
+    if backend == "torch":
+        return classifier
+    if backend not in BACKENDS:
+        print(f"[WARN] Unknown CLASSIFIER_BACKEND '{backend}', using torch")
+        return classifier
+
+    t0 = time.perf_counter()
+    try:
+        if backend == "int8":
+            classifier.model = quantize_int8(classifier.model)
+        else:
+            classifier.model = OnnxModel.from_torch(classifier.model, model_name, sample_inputs)
+    except Exception as e:
+        print(f"[WARN] Classifier backend '{backend}' is not usable, using torch: {e}")
+        return classifier
+    print(f"[TIMER] подготовка классификатора ({backend}): {time.perf_counter() - t0:.3f} сек")
+    return classifier
+
+
+def quantize_int8(model):
+    """Copy of the model with its Linear layers (nearly all of a transformer's work) in int8."""
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+class _Exportable(torch.nn.Module):
+    """AST classifier returning the pooled embedding along with the logits, for export."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_values):
+        pooled = self.model.audio_spectrogram_transformer(input_values)[1]
+        return self.model.classifier(pooled), pooled
+
+
+def onnx_path(model_name):
+    return os.path.join(ONNX_MODEL_DIR, model_name.replace("/", "--") + ".onnx")
+
+
+def export_onnx(model, model_name, sample_inputs):
+    """
+    Exports the model (from the weights already loaded, nothing is
+    downloaded) to onnx_path(model_name), unless that exists. Returns the path.
+    """
+    path = onnx_path(model_name)
+    if os.path.exists(path):
+        return path
+    os.makedirs(ONNX_MODEL_DIR, exist_ok=True)
+    t0 = time.perf_counter()
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with torch.no_grad():
+        torch.onnx.export(
+            _Exportable(model.eval()), (sample_inputs["input_values"],), tmp,
+            input_names=["input_values"], output_names=["logits", "pooled"],
+            dynamic_axes={"input_values": {0: "batch"}, "logits": {0: "batch"}, "pooled": {0: "batch"}},
+            opset_version=ONNX_OPSET,
+        )
+    os.replace(tmp, path)
+    print(f"[TIMER] экспорт {model_name} в ONNX: {time.perf_counter() - t0:.3f} сек")
+    return path
+
+
+class OnnxModel:
+    """
+    Stands in for the pipeline's torch model: called with the preprocessed
+    inputs, it runs the exported graph in onnxruntime and returns the same
+    output class with the logits. The pooled embedding, which torch models
+    give away through a forward hook, is handed to `pooled_callback`.
+    """
+
+    def __init__(self, path, config, output_class, threads=None):
+        if onnxruntime is None:
+            raise RuntimeError("onnxruntime is not installed")
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads or torch.get_num_threads()
+        self.session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.config = config
+        self.output_class = output_class
+        self.pooled_callback = None
+        self.device = torch.device("cpu")
+        self.dtype = torch.float32
+
+    @classmethod
+    def from_torch(cls, model, model_name, sample_inputs):
+        if onnxruntime is None:
+            raise RuntimeError("onnxruntime is not installed")
+        path = export_onnx(model, model_name, sample_inputs)
+        with torch.no_grad():
+            expected = model(**sample_inputs)
+        onnx_model = cls(path, model.config, type(expected))
+        # A broken export shows up right away instead of as odd genres
+        drift = float(np.abs(onnx_model(**sample_inputs).logits.numpy() - expected.logits.numpy()).max())
+        if drift > 1e-2:
+            raise RuntimeError(f"ONNX logits differ from torch by {drift:.4f}")
+        return onnx_model
+
+    def __call__(self, input_values, **kwargs):
+        logits, pooled = self.session.run(None, {"input_values": input_values.cpu().numpy().astype(np.float32)})
+        if self.pooled_callback is not None:
+            self.pooled_callback(torch.from_numpy(pooled))
+        return self.output_class(logits=torch.from_numpy(logits))
+
+    def eval(self):
+        return self
@@ -0,0 +1,152 @@
+"""
+Agreement and throughput of the genre classifier backends against fp32 torch.
+
+    python classifier_benchmark.py ~/Music --limit 100
+    python classifier_benchmark.py ~/Music --backends int8 onnx --batch 8 --output classifier.json
+    python classifier_benchmark.py --synthetic 32     # no music files needed
+
+Every clip (the first CLASSIFIER_CLIP seconds, decoded as in a scan) goes
+through fp32 torch and each backend. For a backend it reports how often
+its top genre matches fp32's (the label features.primary_genre stores),
+the overlap of the top 5, the largest score difference, the cosine
+similarity of the embeddings, and clips/sec one clip at a time and in
+batches of --batch like the scanner's GenreBatcher. Synthetic clips only
+show whether a conversion is broken; use real music to decide on a switch.
+"""
+import argparse
+import datetime
+import json
+import platform
+import sys
+import time
+
+import numpy as np
+import torch
+
+from audio_analysis import (CLASSIFIER_CLIP, CLASSIFIER_SR, GENRE_BATCH_SIZE, GenreBatcher, _top_genres,
+                            decode_audio, extract_genres, load_classifier)
+from classifier_backends import available_backends
+from feature_benchmark import find_files
+
+# A backend is called safe to switch to from this top-genre match rate on
+MIN_AGREEMENT = 0.95
+
+
+def synthetic_clips(n, seed=0):
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(CLASSIFIER_CLIP * CLASSIFIER_SR)) / CLASSIFIER_SR
+    for i in range(n):
+        tones = sum(np.sin(2 * np.pi * f * t) for f in rng.uniform(80, 2000, size=rng.integers(1, 5)))
+        yield f"synthetic-{i}", (0.1 * tones + 0.05 * rng.standard_normal(t.size)).astype(np.float32)
+
+
+def decoded_clips(files):
+    for file_path in files:
+        decoded = decode_audio(file_path)
+        if decoded is not None:
+            yield file_path, decoded[1]
+
+
+def classify_all(classifier, clips, batch_size):
+    """
+    (genres and embedding per clip, one clip at a time; clips/sec that
+    way; clips/sec in batches of batch_size through GenreBatcher's path).
+    """
+    results = []
+    t0 = time.perf_counter()
+    for name, clip in clips:
+        results.append(extract_genres(classifier, clip, name))
+    single = len(clips) / (time.perf_counter() - t0)
+
+    batcher = GenreBatcher(classifier, batch_size=batch_size)
+    t0 = time.perf_counter()
+    for start in range(0, len(clips), batch_size):
+        batcher._forward([batcher._preprocess(clip) for _, clip in clips[start:start + batch_size]])
+    batched = len(clips) / (time.perf_counter() - t0)
+    return results, single, batched
+
+
+def agreement(reference, results, names):
+    top1 = top5 = 0
+    score_diff, cosines = 0.0, []
+    for name, (ref_genres, ref_emb), (genres, emb) in zip(names, reference, results):
+        ref_genres, genres = _top_genres(ref_genres, name), _top_genres(genres, name)
+        if ref_genres and genres and ref_genres[0]["label"] == genres[0]["label"]:
+            top1 += 1
+        ref_top = {g["label"] for g in ref_genres[:5]}
+        top5 += len(ref_top & {g["label"] for g in genres[:5]}) / max(len(ref_top), 1)
+        scores = {g["label"]: g["score"] for g in genres}
+        for g in ref_genres:
+            if g["label"] in scores:
+                score_diff = max(score_diff, abs(g["score"] - scores[g["label"]]))
+        if ref_emb is not None and emb is not None:
+            a, b = ref_emb.astype(np.float32), emb.astype(np.float32)
+            cosines.append(float(a @ b / (np.linalg.norm(a) * np.linalg.norm(b) or 1)))
+    n = len(names)
+    return {
+        "top1_agreement": round(top1 / n, 4),
+        "top5_overlap": round(top5 / n, 4),
+        "max_score_diff": round(score_diff, 4),
+        "min_embedding_cosine": round(min(cosines), 4) if cosines else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Genre classifier backends vs fp32 torch: agreement and throughput")
+    parser.add_argument("paths", nargs="*", help="audio files or folders")
+    parser.add_argument("--limit", type=int, default=None, help="at most this many files")
+    parser.add_argument("--synthetic", type=int, default=0, help="use this many synthetic clips instead of files")
+    parser.add_argument("--backends", nargs="+", default=None, help="default: every available backend but torch")
+    parser.add_argument("--batch", type=int, default=GENRE_BATCH_SIZE, help="batch size of the batched run")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+    if not args.paths and not args.synthetic:
+        parser.error("give audio files/folders or --synthetic N")
+
+    clips = list(synthetic_clips(args.synthetic) if args.synthetic
+                 else decoded_clips(find_files(args.paths, args.limit)))
+    if not clips:
+        parser.error("no decodable audio found")
+    names = [name for name, _ in clips]
+    backends = [b for b in (args.backends or available_backends()) if b != "torch"]
+
+    print(f"[BENCH] torch (fp32), {len(clips)} клипов...", file=sys.stderr)
+    reference, single, batched = classify_all(load_classifier("torch"), clips, args.batch)
+    results = {"torch": {"clips_per_sec": round(single, 2), "clips_per_sec_batched": round(batched, 2)}}
+    for backend in backends:
+        print(f"[BENCH] {backend}...", file=sys.stderr)
+        classifier = load_classifier(backend)
+        outputs, single, batched = classify_all(classifier, clips, args.batch)
+        result = {
+            "clips_per_sec": round(single, 2),
+            "clips_per_sec_batched": round(batched, 2),
+            "speedup": round(single / results["torch"]["clips_per_sec"], 2),
+            **agreement(reference, outputs, names),
+        }
+        result["safe"] = result["top1_agreement"] >= MIN_AGREEMENT
+        print(f"[TIMER] {backend}: {result['clips_per_sec']:.2f} клипов/сек ({result['speedup']:.2f}x), "
+              f"top-1 совпадает в {result['top1_agreement']:.1%}", file=sys.stderr)
+        results[backend] = result
+
+    report = {
+        "benchmark": "classifier",
+        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "torch_threads": torch.get_num_threads(),
+        "clips": len(clips),
+        "synthetic": bool(args.synthetic),
+        "batch": args.batch,
+        "min_agreement": MIN_AGREEMENT,
+        "backends": results,
+    }
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
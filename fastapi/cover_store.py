@@ -0,0 +1,154 @@
+import hashlib
+import io
+import os
+import shutil
+import threading
+import time
+
+from PIL import Image
+
+# Embedded cover art is stored once per distinct image, content-addressed by
+# the SHA-1 of its bytes: STORE_DIR/<hash[:2]>/<hash>/<size>.<format>. Tracks
+# point at their image through track_covers.hash, so an album's tracks share
+# one copy, and a variant's URL never changes content (served as immutable).
+COVERS_DIR = os.path.join(os.path.dirname(__file__), "covers")
+STORE_DIR = os.path.join(COVERS_DIR, "h")
+STORE_URL = "/covers/h"
+
+# Longest side of each variant, largest first: every variant is resized from
+# the previous one. "full" keeps the original size up to COVER_MAX_SIZE.
+COVER_SIZES = {"full": int(os.getenv("COVER_MAX_SIZE", 1200)), "256": 256, "64": 64}
+COVER_FORMATS = {
+    "webp": ("WEBP", {"quality": 80, "method": 4}),
+    "jpg": ("JPEG", {"quality": 85, "optimize": True, "progressive": True}),
+}
+
+# Covers written by earlier versions as COVERS_DIR/<track_id>.<ext>
+LEGACY_EXTENSIONS = ("jpg", "jpeg", "png", "gif", "bmp", "webp")
+
+# Unfinished variant sets older than this are left over from a crash
+STALE_TMP_AGE = 3600
+
+
+def cover_hash(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def cover_dir(digest):
+    return os.path.join(STORE_DIR, digest[:2], digest)
+
+
+def cover_url(base_url, digest, size="full", fmt="webp"):
+    return f"{base_url}{STORE_URL}/{digest[:2]}/{digest}/{size}.{fmt}"
+
+
+def store_cover(data):
+    """
+    Stores the image once and returns its hash. The variants are written
+    to a temporary directory that is renamed into place, so a concurrent
+    store of the same image (another track of the album) or a crash never
+    leaves a partial set behind. An image already stored is not decoded.
+    """
+    digest = cover_hash(data)
+    final = cover_dir(digest)
+    if os.path.isdir(final):
+        try:
+            # Counts as just stored for a prune_covers running meanwhile
+            os.utime(final)
+        except OSError:
+            pass
+        else:
+            return digest
+
+    image = Image.open(io.BytesIO(data))
+    # JPEG decoders can scale down while decoding, much cheaper for huge art
+    image.draft("RGB", (COVER_SIZES["full"], COVER_SIZES["full"]))
+    image.load()
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+
+    os.makedirs(os.path.dirname(final), exist_ok=True)
+    tmp = f"{final}.{os.getpid()}-{threading.get_ident()}.tmp"
+    os.makedirs(tmp, exist_ok=True)
+    try:
+        for size, edge in COVER_SIZES.items():
+            # thumbnail() keeps the aspect ratio and never enlarges
+            image.thumbnail((edge, edge), Image.LANCZOS)
+            for fmt, (codec, options) in COVER_FORMATS.items():
+                image.save(os.path.join(tmp, f"{size}.{fmt}"), codec, **options)
+        try:
+            os.rename(tmp, final)
+        except OSError:
+            # Stored meanwhile by another thread
+            if not os.path.isdir(final):
+                raise
+            shutil.rmtree(tmp, ignore_errors=True)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    return digest
+
+
+def stored_hashes():
+    """Hashes of every image in the store."""
+    if not os.path.isdir(STORE_DIR):
+        return set()
+    hashes = set()
+    for shard in os.scandir(STORE_DIR):
+        if shard.is_dir():
+            hashes.update(entry.name for entry in os.scandir(shard.path)
+                          if entry.is_dir() and not entry.name.endswith(".tmp"))
+    return hashes
+
+
+def prune_covers(referenced, started=None):
+    """
+    Deletes stored images no track refers to any more (`referenced` is the
+    set of hashes in track_covers) and stale temporary directories.
+    Images stored since `started` (a time.time() taken before reading
+    track_covers) are kept: their track may not be committed yet.
+    Returns the number of images deleted.
+    """
+    removed = 0
+    for digest in stored_hashes() - set(referenced):
+        if started is not None:
+            try:
+                if os.stat(cover_dir(digest)).st_mtime >= started:
+                    continue
+            except OSError:
+                continue
+        shutil.rmtree(cover_dir(digest), ignore_errors=True)
+        try:
+            os.rmdir(os.path.dirname(cover_dir(digest)))
+        except OSError:  # other images in the shard
+            pass
+        removed += 1
+    if os.path.isdir(STORE_DIR):
+        now = time.time()
+        for shard in os.scandir(STORE_DIR):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith(".tmp") and now - entry.stat().st_mtime > STALE_TMP_AGE:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+    return removed
+
+
+def legacy_covers():
+    """{track_id: path} of the covers stored per track by earlier versions."""
+    if not os.path.isdir(COVERS_DIR):
+        return {}
+    covers = {}
+    for entry in os.scandir(COVERS_DIR):
+        name, _, ext = entry.name.rpartition(".")
+        if entry.is_file() and name.isdigit() and ext.lower() in LEGACY_EXTENSIONS:
+            covers[int(name)] = entry.path
+    return covers
+
+
+def remove_legacy_cover(track_id):
+    for ext in LEGACY_EXTENSIONS:
+        try:
+            os.remove(os.path.join(COVERS_DIR, f"{track_id}.{ext}"))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,55 @@
+from collections import Counter, defaultdict
+
+# Stored as the only token of a track whose title and artist gave no tokens,
+# so it counts as indexed instead of having its tags read again every scan
+NO_TOKENS = ""
+# Longest token track_tokens.token can hold; longer words are not indexed
+MAX_TOKEN_LENGTH = 255
+
+
+def stored_tokens(tokens):
+    """The track_tokens values of a token set."""
+    return tokens or (NO_TOKENS,)
+
+
+class TokenIndex:
+    """
+    Inverted index from normalised title/artist token to the tracks that
+    have it, for duplicate detection during a scan.
+
+    A lookup only walks the postings of the new track's own tokens, instead
+    of comparing it with every track in the library.
+    """
+
+    def __init__(self):
+        self.postings = defaultdict(set)
+        self.tokens = {}
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def add(self, key, tokens):
+        self.remove(key)
+        tokens = frozenset(tokens)
+        self.tokens[key] = tokens
+        for token in tokens:
+            self.postings[token].add(key)
+
+    def remove(self, key):
+        for token in self.tokens.pop(key, ()):
+            keys = self.postings[token]
+            keys.discard(key)
+            if not keys:
+                del self.postings[token]
+
+    def find_duplicate(self, tokens, threshold):
+        """Returns a key sharing at least `threshold` tokens with `tokens`, or None."""
+        if len(tokens) < threshold:
+            return None
+        shared = Counter()
+        for token in tokens:
+            shared.update(self.postings.get(token, ()))
+        for key, count in shared.items():
+            if count >= threshold:
+                return key
+        return None
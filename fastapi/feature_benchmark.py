@@ -0,0 +1,147 @@
+"""
+Per-file timing of the shared-STFT feature extractor against the reference
+one that lets every librosa feature compute its own spectrogram.
+
+    python feature_benchmark.py ~/Music --limit 50
+    python feature_benchmark.py track1.mp3 track2.flac --repeats 5 --output features.json
+    python feature_benchmark.py --synthetic 20         # no music files needed
+
+Each file is decoded once (decode_audio, as in a scan) and both extractors
+run on the same signal, alternating, `--repeats` times; the fastest run of
+each is reported. The features of both are compared too: the largest
+relative difference per feature and whether the keys agree.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import sys
+import time
+
+import numpy as np
+
+from audio_analysis import (FEATURE_DURATION, FEATURE_SR, decode_audio, extract_audio_features,
+                            extract_audio_features_reference)
+from file_manifest import AUDIO_EXTENSIONS, iter_tree
+
+
+def find_files(paths, limit=None):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for listing in iter_tree(path):
+                files.extend(os.path.join(path, relative) for relative, _ in listing)
+        elif path.lower().endswith(AUDIO_EXTENSIONS):
+            files.append(path)
+    return files[:limit] if limit else files
+
+
+def synthetic_signals(n, seed=0):
+    """Chords with a beat and some noise, FEATURE_DURATION seconds at FEATURE_SR."""
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(FEATURE_DURATION * FEATURE_SR)) / FEATURE_SR
+    for i in range(n):
+        root = 110 * 2 ** (rng.integers(0, 24) / 12)
+        y = sum(np.sin(2 * np.pi * root * ratio * t) for ratio in (1, 1.26, 1.5))
+        bpm = rng.uniform(70, 170)
+        y = y * (0.5 + 0.5 * (np.sin(np.pi * t * bpm / 60) ** 8)) + 0.05 * rng.standard_normal(t.size)
+        yield f"synthetic-{i}", (0.2 * y).astype(np.float32)
+
+
+def _timed(fn, *args):
+    t0 = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - t0, result
+
+
+def compare_features(reference, shared):
+    """Relative difference per numeric feature, and whether the key is the same."""
+    diffs = {}
+    for name, value in reference.items():
+        if name == "key":
+            continue
+        scale = max(abs(value), 1e-12)
+        diffs[name] = abs(shared[name] - value) / scale
+    return diffs, reference["key"] == shared["key"]
+
+
+def run(signals, repeats):
+    results = []
+    for name, y in signals:
+        # Warm-up, so librosa's cached filter banks do not count against the first extractor
+        extract_audio_features(y, name)
+        reference_sec = shared_sec = None
+        reference = shared = None
+        for _ in range(repeats):
+            sec, reference = _timed(extract_audio_features_reference, y, name)
+            reference_sec = sec if reference_sec is None else min(reference_sec, sec)
+            sec, shared = _timed(extract_audio_features, y, name)
+            shared_sec = sec if shared_sec is None else min(shared_sec, sec)
+        if reference is None or shared is None:
+            print(f"[WARN] {name}: features could not be computed", file=sys.stderr)
+            continue
+        diffs, same_key = compare_features(reference, shared)
+        result = {
+            "file": name,
+            "reference_ms": round(reference_sec * 1000, 2),
+            "shared_ms": round(shared_sec * 1000, 2),
+            "speedup": round(reference_sec / shared_sec, 2),
+            "max_rel_diff": max(diffs.values()),
+            "same_key": same_key,
+        }
+        print(f"[TIMER] {name}: {result['reference_ms']:.1f} мс -> {result['shared_ms']:.1f} мс "
+              f"({result['speedup']:.2f}x), max rel diff {result['max_rel_diff']:.2e}"
+              + ("" if same_key else ", KEY DIFFERS"), file=sys.stderr)
+        results.append(result)
+    return results
+
+
+def decoded_signals(files):
+    for file_path in files:
+        decoded = decode_audio(file_path)
+        if decoded is not None:
+            yield file_path, decoded[0]
+
+
+def main():
+    import librosa
+    parser = argparse.ArgumentParser(description="Shared-STFT vs reference audio feature extraction, per file")
+    parser.add_argument("paths", nargs="*", help="audio files or folders")
+    parser.add_argument("--limit", type=int, default=None, help="at most this many files")
+    parser.add_argument("--synthetic", type=int, default=0, help="use this many synthetic signals instead of files")
+    parser.add_argument("--repeats", type=int, default=3, help="runs per extractor and file, the fastest counts")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+    if not args.paths and not args.synthetic:
+        parser.error("give audio files/folders or --synthetic N")
+
+    signals = synthetic_signals(args.synthetic) if args.synthetic else decoded_signals(find_files(args.paths, args.limit))
+    results = run(signals, args.repeats)
+    reference_total = sum(r["reference_ms"] for r in results)
+    shared_total = sum(r["shared_ms"] for r in results)
+    report = {
+        "benchmark": "features",
+        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "librosa": librosa.__version__,
+        "repeats": args.repeats,
+        "files": len(results),
+        "reference_ms_total": round(reference_total, 1),
+        "shared_ms_total": round(shared_total, 1),
+        "speedup": round(reference_total / shared_total, 2) if shared_total else None,
+        "max_rel_diff": max((r["max_rel_diff"] for r in results), default=None),
+        "keys_differ": sum(1 for r in results if not r["same_key"]),
+        "results": results,
+    }
+
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
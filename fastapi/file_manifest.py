@@ -0,0 +1,125 @@
+import hashlib
+import os
+from collections import defaultdict
+
+# Content fingerprint stored with every scanned file: "partial" hashes the
+# size plus the first and last HASH_CHUNK bytes, "full" the whole file,
+# "none" stores no hash (renames are then matched by size and mtime)
+SCAN_HASH = os.getenv("SCAN_HASH", "partial")
+HASH_CHUNK = 1024 * 1024
+AUDIO_EXTENSIONS = (".mp3", ".wav", ".flac")
+
+
+def iter_tree(folder, unreadable=None):
+    """
+    Yields the audio files under `folder` one directory at a time, as lists
+    of (relative path, (size, mtime_ns)), so a caller can start on the first
+    directory before the walk is complete.
+
+    Raises OSError if `folder` itself cannot be listed. Subdirectories that
+    cannot be are skipped and their relative paths appended to `unreadable`:
+    their files are unknown, not gone.
+    """
+    stack = [""]
+    while stack:
+        relative = stack.pop()
+        try:
+            entries = os.scandir(os.path.join(folder, relative))
+        except OSError:
+            if not relative:
+                raise
+            if unreadable is not None:
+                unreadable.append(relative)
+            continue
+        files = []
+        with entries:
+            for entry in entries:
+                path = f"{relative}/{entry.name}" if relative else entry.name
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(path)
+                    elif entry.name.lower().endswith(AUDIO_EXTENSIONS):
+                        st = entry.stat()
+                        files.append((path, (st.st_size, st.st_mtime_ns)))
+                except OSError:
+                    continue
+        if files:
+            yield files
+
+
+def stat_tree(folder):
+    """Relative path -> (size, mtime_ns) of every audio file under `folder`."""
+    return {path: st for files in iter_tree(folder) for path, st in files}
+
+
+def content_hash(path, mode=SCAN_HASH):
+    if mode == "none":
+        return None
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        if mode == "full":
+            for block in iter(lambda: f.read(HASH_CHUNK), b""):
+                h.update(block)
+        else:
+            size = os.fstat(f.fileno()).st_size
+            h.update(str(size).encode())
+            h.update(f.read(HASH_CHUNK))
+            if size > 2 * HASH_CHUNK:
+                f.seek(-HASH_CHUNK, os.SEEK_END)
+                h.update(f.read(HASH_CHUNK))
+    return h.hexdigest()
+
+
+class ManifestDiff:
+    """Files found or missed since the last scan, by relative path."""
+
+    def __init__(self):
+        self.added = []
+        self.removed = []
+        self.renamed = []  # (old path, new path)
+
+
+def compare_entry(row, stat, hash_of, path):
+    """
+    "unchanged", "touched" (new mtime, same content) or "changed" for a
+    file on disk with the given (size, mtime_ns) and its manifest row.
+    """
+    size, mtime_ns = stat
+    if row["size"] == size and row["mtime_ns"] == mtime_ns:
+        return "unchanged"
+    if row["hash"] and row["size"] == size and hash_of(path) == row["hash"]:
+        return "touched"
+    return "changed"
+
+
+def diff_manifest(found, missing, hash_of):
+    """
+    Pairs files that are on disk but not in the manifest with manifest rows
+    whose file was not found. Files in both have been compared one at a
+    time with compare_entry already.
+
+    `found` maps path -> (size, mtime_ns); `missing` maps path -> row with
+    "size", "mtime_ns" and "hash" as recorded at the last scan. `hash_of(path)`
+    returns the content hash of a file on disk and is only called for files
+    that may be the new name of a missing one.
+
+    A missing file and a found file with the same size and hash (or mtime,
+    when no hash was stored) are reported as a rename.
+    """
+    diff = ManifestDiff()
+    vanished_by_size = defaultdict(list)
+    for path, row in missing.items():
+        if row["size"] is not None:
+            vanished_by_size[row["size"]].append(path)
+    for path in sorted(found):
+        size, mtime_ns = found[path]
+        for old in vanished_by_size.get(size, ()):
+            row = missing[old]
+            if (hash_of(path) == row["hash"]) if row["hash"] else (mtime_ns == row["mtime_ns"]):
+                diff.renamed.append((old, path))
+                vanished_by_size[size].remove(old)
+                break
+
+    diff.added = sorted(found.keys() - {new for _, new in diff.renamed})
+    diff.removed = sorted(missing.keys() - {old for old, _ in diff.renamed})
+    return diff
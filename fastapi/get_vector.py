@@ -1,11 +1,24 @@
+import atexit
 import numpy as np
 import os
-import pandas as pd
+import shutil
+import threading
 import time
 from dotenv import load_dotenv
 import pymysql
 import traceback
 
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-worker lock, each worker may precompute
+    fcntl = None
+
+from ann_index import choose_index_kind
+from similarity_index import (SimilarityIndex, build_genre_csr, get_feature_vector, ANN_MIN_RECALL, EMBEDDING_DTYPE,
+                              SPACES)
+from similarity_cache import SimilarityCache
+from recent_plays import RecentPlays
+
 load_dotenv()
 
 DB_HOST = os.getenv("DB_HOST", "localhost")
@@ -14,8 +27,40 @@ DB_USER = os.getenv("DB_USER", "root")
 DB_PASS = os.getenv("DB_PASS", "root")
 DB_NAME = os.getenv("DB_NAME", "music")
 
-# Global cache for all pre-computed data
-CACHED_DATA = {}
+# "auto" uses the ANN index when one was built and passed the recall check,
+# "ann" always uses it (if built), "exact" always does brute force
+SIMILARITY_ENGINE = os.getenv("SIMILARITY_ENGINE", "auto")
+
+# Ranked neighbour lists of popular tracks, shared by all users
+SIMILARITY_CACHE = SimilarityCache(int(os.getenv("SIMILARITY_CACHE_SIZE", 4096)))
+# Extra neighbours cached beyond top_n so recent plays can be filtered out afterwards
+CACHE_EXTRA_NEIGHBOURS = 50
+
+# Recently played tracks are left out of similar tracks for this many seconds
+RECENT_PLAYS_WINDOW = int(os.getenv("RECENT_PLAYS_WINDOW", 600))
+RECENT_PLAYS = RecentPlays(window=RECENT_PLAYS_WINDOW)
+
+# Where the memory-mapped index snapshots and the library generation live
+SNAPSHOT_DIR = os.getenv("SIMILARITY_SNAPSHOT_DIR", os.path.join(os.path.dirname(__file__), "cache", "similarity"))
+# How often (seconds) a worker looks for a snapshot newer than its index
+SNAPSHOT_CHECK_INTERVAL = float(os.getenv("SNAPSHOT_CHECK_INTERVAL", 5))
+# Snapshots after incremental updates are written in the background, at most
+# one per this many seconds; updates in between are coalesced into it
+SNAPSHOT_SAVE_INTERVAL = float(os.getenv("SNAPSHOT_SAVE_INTERVAL", 30))
+
+# Global similarity index, built by precompute_data or loaded from a snapshot
+SIMILARITY_INDEX = None
+# Library generation SIMILARITY_INDEX corresponds to
+INDEX_GENERATION = None
+# Bumped every time SIMILARITY_INDEX is replaced or updated; tags cached results
+INDEX_VERSION = 0
+_last_snapshot_check = 0.0
+_snapshot_lock = threading.Lock()
+_snapshot_write_lock = threading.Lock()
+_snapshot_timer = None
+_last_snapshot_save = float("-inf")
+# Held for the life of the worker that runs the scanner, see claim_scan_worker
+_scan_worker_lock = None
 
 def get_connection():
     return pymysql.connect(
@@ -28,186 +73,468 @@ def get_connection():
         cursorclass=pymysql.cursors.DictCursor
     )
 
-def get_feature_vector(row):
-    return np.array([
-        row["bpm"], row["rms_energy"], row["spectral_centroid"],
-        row["spectral_bandwidth"], row["spectral_rolloff"], row["zero_crossing_rate"],
-        row["mfcc1"], row["mfcc2"], row["mfcc3"]
-    ], dtype=float)
-
-def load_features():
-    t0 = time.perf_counter()
+def _fetch_rows(table, id_column, track_ids):
     with get_connection() as conn:
         with conn.cursor() as cur:
-            cur.execute("SELECT * FROM features")
-            rows = cur.fetchall()
+            if track_ids is None:
+                cur.execute(f"SELECT * FROM {table}")
+            else:
+                placeholders = ', '.join(['%s'] * len(track_ids))
+                cur.execute(f"SELECT * FROM {table} WHERE {id_column} IN ({placeholders})", tuple(track_ids))
+            return cur.fetchall()
+
+def load_features(track_ids=None):
+    t0 = time.perf_counter()
+    if track_ids is not None and not track_ids:
+        return []
+    rows = _fetch_rows("features", "id", track_ids)
     print(f"[TIMER] load_features: {time.perf_counter() - t0:.3f} сек")
     return rows
 
-def load_genres():
+def load_genres(track_ids=None):
     t0 = time.perf_counter()
-    with get_connection() as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT * FROM genres")
-            rows = cur.fetchall()
+    if track_ids is not None and not track_ids:
+        return []
+    rows = _fetch_rows("genres", "track_id", track_ids)
     print(f"[TIMER] load_genres: {time.perf_counter() - t0:.3f} сек")
     return rows
 
+def load_embeddings(track_ids=None):
+    """{track_id: float16 embedding} of the tracks that have one."""
+    t0 = time.perf_counter()
+    if track_ids is not None and not track_ids:
+        return {}
+    rows = _fetch_rows("track_embeddings", "track_id", track_ids)
+    embeddings = {r["track_id"]: np.frombuffer(r["vector"], dtype=EMBEDDING_DTYPE) for r in rows}
+    print(f"[TIMER] load_embeddings: {time.perf_counter() - t0:.3f} сек")
+    return embeddings
+
 def build_genre_matrix(features, genres):
+    """
+    Returns the genre block of `features` as a CSR matrix (one row per track,
+    one column per label, only the stored scores) and its labels.
+    """
     t0 = time.perf_counter()
     if not genres:
         print("[WARN] No genres found in database. Genre matrix will be empty.")
-        return {}, []
-    df = pd.DataFrame(genres)
-    pivot = df.pivot_table(index="track_id", columns="label", values="score", fill_value=0)
-    all_labels = list(pivot.columns)
-    genre_vectors = {
-        f["file"]: pivot.loc[f["id"]].to_numpy(dtype=float) if f["id"] in pivot.index else np.zeros(len(all_labels))
-        for f in features
-    }
-    print(f"[TIMER] build_genre_matrix: {time.perf_counter() - t0:.3f} сек")
-    return genre_vectors, all_labels
+    labels = sorted({g["label"] for g in genres})
+    block = build_genre_csr(features, genres, {label: i for i, label in enumerate(labels)})
+    print(f"[TIMER] build_genre_matrix: {time.perf_counter() - t0:.3f} сек "
+          f"({block.nnz} оценок, {len(labels)} жанров)")
+    return block, labels
+
+# -------------------------------------------------------------
+# SNAPSHOTS
+# -------------------------------------------------------------
+# The library generation is a counter in SNAPSHOT_DIR/GENERATION that is
+# bumped whenever the tracks in the DB change. A snapshot is only used when
+# it was written for the current generation, so checking it needs no DB.
+
+def library_generation():
+    try:
+        with open(os.path.join(SNAPSHOT_DIR, "GENERATION")) as f:
+            return int(f.read().strip() or 0)
+    except (OSError, ValueError):
+        return 0
+
+def bump_library_generation():
+    """Marks the library as changed, invalidating existing snapshots. Returns the new generation."""
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    generation = library_generation() + 1
+    tmp = os.path.join(SNAPSHOT_DIR, f"GENERATION.{os.getpid()}.tmp")
+    with open(tmp, "w") as f:
+        f.write(str(generation))
+    os.replace(tmp, os.path.join(SNAPSHOT_DIR, "GENERATION"))
+    return generation
+
+def save_snapshot(index, generation):
+    """
+    Writes the index to SNAPSHOT_DIR/gen-<generation> and points CURRENT at it.
+    Older snapshots are deleted; workers still mapping them keep their pages.
+    """
+    t0 = time.perf_counter()
+    name = f"gen-{generation}"
+    tmp = os.path.join(SNAPSHOT_DIR, f"{name}.{os.getpid()}.tmp")
+    shutil.rmtree(tmp, ignore_errors=True)
+    index.save(tmp, generation)
+    target = os.path.join(SNAPSHOT_DIR, name)
+    shutil.rmtree(target, ignore_errors=True)
+    os.replace(tmp, target)
+
+    pointer = os.path.join(SNAPSHOT_DIR, f"CURRENT.{os.getpid()}.tmp")
+    with open(pointer, "w") as f:
+        f.write(name)
+    os.replace(pointer, os.path.join(SNAPSHOT_DIR, "CURRENT"))
+
+    for entry in os.listdir(SNAPSHOT_DIR):
+        if entry.startswith("gen-") and entry != name:
+            shutil.rmtree(os.path.join(SNAPSHOT_DIR, entry), ignore_errors=True)
+    print(f"[TIMER] save_snapshot ({name}): {time.perf_counter() - t0:.3f} сек")
+
+def load_snapshot(generation):
+    """Returns the index from the current snapshot if it matches `generation`, otherwise None."""
+    try:
+        with open(os.path.join(SNAPSHOT_DIR, "CURRENT")) as f:
+            path = os.path.join(SNAPSHOT_DIR, f.read().strip())
+    except OSError:
+        return None
+    meta = SimilarityIndex.read_meta(path)
+    if meta is None or meta["generation"] != generation:
+        return None
+    t0 = time.perf_counter()
+    try:
+        index = SimilarityIndex.load(path, mmap=True)
+    except Exception as e:
+        print(f"[WARN] Failed to load similarity snapshot {path}: {e}")
+        return None
+    print(f"[TIMER] load_snapshot ({len(index)} треков): {time.perf_counter() - t0:.3f} сек")
+    return index
+
+def _save_index(index, generation):
+    with _snapshot_write_lock:
+        try:
+            save_snapshot(index, generation)
+        except Exception as e:
+            print(f"[WARN] Failed to save similarity snapshot: {e}")
+            traceback.print_exc()
+
+def _publish_index(index, generation, save=True):
+    global SIMILARITY_INDEX, INDEX_GENERATION, INDEX_VERSION
+    SIMILARITY_INDEX, INDEX_GENERATION = index, generation
+    # Invalidates every cached similarity result
+    INDEX_VERSION += 1
+    if save:
+        _save_index(index, generation)
+
+def _schedule_snapshot():
+    """
+    Writes a snapshot of the current index in a background thread, at most
+    once per SNAPSHOT_SAVE_INTERVAL seconds, so a stream of small updates
+    (watch mode) costs one O(library) write instead of one per update.
+    """
+    global _snapshot_timer
+    with _snapshot_lock:
+        if _snapshot_timer is not None:
+            # The pending write picks this update up too
+            return
+        delay = max(0.0, _last_snapshot_save + SNAPSHOT_SAVE_INTERVAL - time.monotonic())
+        _snapshot_timer = threading.Timer(delay, _write_pending_snapshot)
+        _snapshot_timer.daemon = True
+        _snapshot_timer.start()
+
+def _write_pending_snapshot():
+    global _snapshot_timer, _last_snapshot_save
+    with _snapshot_lock:
+        _snapshot_timer = None
+        _last_snapshot_save = time.monotonic()
+        index, generation = SIMILARITY_INDEX, INDEX_GENERATION
+    _save_index(index, generation)
+
+def flush_snapshot():
+    """Writes a pending snapshot now instead of when its timer fires, e.g. at exit."""
+    with _snapshot_lock:
+        timer = _snapshot_timer
+    if timer is not None:
+        timer.cancel()
+        _write_pending_snapshot()
+
+atexit.register(flush_snapshot)
+
+def load_similarity_data():
+    """
+    Startup entry point: maps the snapshot of the current library generation
+    if there is one, otherwise precomputes from the DB and writes a snapshot.
+    Workers starting together take a file lock so only one of them hits the DB.
+    """
+    generation = library_generation()
+    index = load_snapshot(generation)
+    if index is not None:
+        _publish_index(index, generation, save=False)
+        return
+
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    with open(os.path.join(SNAPSHOT_DIR, ".lock"), "w") as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        # Another worker may have written it while we waited for the lock
+        generation = library_generation()
+        index = load_snapshot(generation)
+        if index is not None:
+            _publish_index(index, generation, save=False)
+        else:
+            precompute_data()
+
+def claim_scan_worker():
+    """
+    True in the one worker process that resumes scan jobs and watches the
+    library: the first to call it takes an exclusive file lock and keeps it
+    until it exits, so uvicorn workers never run the same job twice.
+    Without fcntl (Windows) every worker gets it.
+    """
+    global _scan_worker_lock
+    if _scan_worker_lock is not None or fcntl is None:
+        return True
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    lock = open(os.path.join(SNAPSHOT_DIR, ".scanner.lock"), "w")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock.close()
+        return False
+    _scan_worker_lock = lock
+    return True
+
+def build_index(features, genres, embeddings=None):
+    """
+    Builds a SimilarityIndex (and the eager ANN index) from `features`/`genres`
+    rows and the {track_id: vector} embeddings, if given.
+    """
+    genre_block, labels = build_genre_matrix(features, genres)
+
+    t0 = time.perf_counter()
+    index = SimilarityIndex.build(features, genre_block, labels, embeddings)
+    print(f"[TIMER] сборка индекса: {time.perf_counter() - t0:.3f} сек")
+
+    # The cosine ANN index is built eagerly since it is the default metric,
+    # the euclidean one on first use
+    if choose_index_kind(len(index)):
+        try:
+            index.get_ann("cosine")
+        except Exception as e:
+            print(f"[WARN] Failed to build ANN index, falling back to exact search: {e}")
+            traceback.print_exc()
+    return index
 
 def precompute_data():
     """
     Loads all data from DB and pre-computes the vectors for similarity search.
-    This should be called once on application startup.
+    This should be called once on application startup; afterwards the index is
+    kept current with add_tracks/remove_tracks.
     """
     print("Начинаем предварительный расчет данных...")
     t_start = time.perf_counter()
+    # Read the generation before loading, so changes made meanwhile invalidate the snapshot
+    generation = library_generation()
 
     features = load_features()
     genres = load_genres()
     print(f"[TIMER] загрузка данных: {time.perf_counter() - t_start:.3f} сек")
 
-    genre_vectors, _ = build_genre_matrix(features, genres)
+    # Embeddings are loaded by the first embedding search, see _rank_neighbours
+    index = build_index(features, genres)
+    _publish_index(index, generation)
+    print(f"Предварительный расчет данных завершен за {time.perf_counter() - t_start:.3f} сек")
 
-    t2 = time.perf_counter()
-    vectors = {r["id"]: get_feature_vector(r) for r in features}
-    files = {r["id"]: r["file"] for r in features}
-    
-    vectors_norm_list = [vectors[r['id']] for r in features]
-    vectors_norm = np.array(vectors_norm_list)
-    mean = vectors_norm.mean(axis=0)
-    std = vectors_norm.std(axis=0) + 1e-8
-    vectors_norm = (vectors_norm - mean) / std
-    print(f"[TIMER] нормализация признаков: {time.perf_counter() - t2:.3f} сек")
-
-    t3 = time.perf_counter()
-    weights = np.array([2.0, 1.0, 0.5, 0.5, 0.5, 0.5, 1.0, 1.0, 1.0])
-    genre_weight = 40.0
-    combined_vectors = []
-    ids = []
-    
-    # Handle case where there are no genres
-    if not genre_vectors:
-        print("[WARN] No genre vectors were built. Proceeding without genre information.")
-        fallback_genre_vec = np.array([])
-    else:
-        fallback_genre_vec = np.zeros_like(next(iter(genre_vectors.values())))
+def get_similarity_index():
+    global _last_snapshot_check
+    if SIMILARITY_INDEX is None:
+        print("[WARN] Данные не были предварительно рассчитаны. Загрузка по требованию. Это будет медленно.")
+        load_similarity_data()
+        return SIMILARITY_INDEX
 
-    for i, r in enumerate(features):
-        try:
-            feat_vec = vectors_norm[i] * weights
-            genre_vec = genre_vectors.get(r["file"], fallback_genre_vec)
-            
-            # Ensure genre_vec is not empty if fallback was used and genre_vectors was empty
-            if genre_vec.size == 0 and fallback_genre_vec.size > 0:
-                 genre_vec = fallback_genre_vec
-            
-            combined = np.concatenate([feat_vec, genre_vec * genre_weight])
-            combined_vectors.append(combined.astype("float32"))
-            ids.append(r["id"])
-        except Exception as e:
-            print(f"[WARN] Failed to process track ID {r.get('id', 'N/A')} during pre-computation: {e}")
-            traceback.print_exc()
-            # Optionally, remove it from 'files' as well if it won't be in the cache
-            if r.get('id') in files:
-                del files[r.get('id')]
-    
-    # Store results in the global cache
-    CACHED_DATA["ids"] = np.array(ids)
-    CACHED_DATA["files"] = files
-    CACHED_DATA["combined_vectors"] = np.array(combined_vectors, dtype="float32")
-    
-    print(f"[TIMER] сборка комбинированных векторов: {time.perf_counter() - t3:.3f} сек")
-    print(f"Предварительный расчет данных завершен за {time.perf_counter() - t_start:.3f} сек")
+    # Pick up snapshots written by the worker that ran a scan
+    now = time.monotonic()
+    if now - _last_snapshot_check > SNAPSHOT_CHECK_INTERVAL:
+        _last_snapshot_check = now
+        generation = library_generation()
+        if generation != INDEX_GENERATION:
+            index = load_snapshot(generation)
+            if index is not None:
+                _publish_index(index, generation, save=False)
+    return SIMILARITY_INDEX
 
-def find_similar_tracks(target_id, user_id: str = None, top_n=10, metric="cosine"):
-    t0 = time.perf_counter()
+def reset_similarity_data():
+    """Empties the index without touching the DB, e.g. after the library was cleared."""
+    _publish_index(SimilarityIndex(), bump_library_generation())
 
-    if not CACHED_DATA:
-        print("[WARN] Данные не были предварительно рассчитаны. Загрузка по требованию. Это будет медленно.")
+def add_tracks(track_ids):
+    """
+    Loads just the given tracks from the DB and adds them to the similarity
+    index, replacing tracks that are already indexed. Cost scales with the
+    number of tracks added, not with the size of the library.
+    """
+    track_ids = list(dict.fromkeys(track_ids))
+    if not track_ids:
+        return
+    if SIMILARITY_INDEX is None:
         precompute_data()
+        return
 
-    ids = CACHED_DATA["ids"]
-    files = CACHED_DATA["files"]
-    combined_vectors = CACHED_DATA["combined_vectors"]
+    t0 = time.perf_counter()
+    features = load_features(track_ids)
+    genres = load_genres(track_ids)
+    # Loaded even if the index has no embeddings yet: they may be filled in before add() runs
+    embeddings = load_embeddings(track_ids)
+    missing = set(track_ids) - {r["id"] for r in features}
+    if missing:
+        SIMILARITY_INDEX.remove(missing)
+    if features:
+        SIMILARITY_INDEX.add(features, genres, embeddings)
+    _publish_index(SIMILARITY_INDEX, bump_library_generation(), save=False)
+    _schedule_snapshot()
+    print(f"[TIMER] add_tracks ({len(features)} треков): {time.perf_counter() - t0:.3f} сек")
 
-    try:
-        target_idx_arr = np.where(ids == target_id)[0]
-        if len(target_idx_arr) == 0:
-            raise ValueError(f"Трек с ID {target_id} не найден в кеше")
-        target_idx = target_idx_arr[0]
-        target_vec = combined_vectors[target_idx]
-    except (KeyError, IndexError):
-        raise ValueError(f"Трек с ID {target_id} не найден в кеше")
+def remove_tracks(track_ids):
+    """Drops tracks from the similarity index without touching the DB."""
+    if SIMILARITY_INDEX is None:
+        return
+    t0 = time.perf_counter()
+    removed = SIMILARITY_INDEX.remove(set(track_ids))
+    _publish_index(SIMILARITY_INDEX, bump_library_generation(), save=False)
+    _schedule_snapshot()
+    print(f"[TIMER] remove_tracks ({removed} треков): {time.perf_counter() - t0:.3f} сек")
 
-    t4 = time.perf_counter()
-    if metric == "euclidean":
-        dists = np.linalg.norm(combined_vectors - target_vec, axis=1)
-    elif metric == "cosine":
-        dot_products = combined_vectors @ target_vec
-        norms = np.linalg.norm(combined_vectors, axis=1) * np.linalg.norm(target_vec)
-        norms[norms == 0] = 1e-8 # avoid division by zero
-        dists = 1 - dot_products / norms
-    else:
+def check_ann_recall(metric="cosine", top_n=10):
+    """Recall@top_n of the ANN index vs exact search, see SimilarityIndex.check_ann_recall."""
+    return get_similarity_index().check_ann_recall(metric=metric, top_n=top_n)
+
+def record_play(user_id, track_id, timestamp=None):
+    """Feeds /api/history/update into the in-memory recent-plays tracker."""
+    RECENT_PLAYS.record(user_id, track_id, timestamp)
+
+def get_recently_played(user_id):
+    """
+    Ids of the tracks the user played in the last RECENT_PLAYS_WINDOW seconds.
+    Served from memory; the DB is only asked the first time a user is seen
+    after a cold start.
+    """
+    if not user_id:
+        return set()
+    recent = RECENT_PLAYS.get(user_id)
+    if recent is not None:
+        return recent
+
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cutoff = int(time.time()) - RECENT_PLAYS_WINDOW
+            cur.execute(
+                "SELECT track_id, last_played FROM listening_history WHERE user_id = %s AND last_played > %s",
+                (user_id, cutoff)
+            )
+            rows = cur.fetchall()
+    RECENT_PLAYS.seed(user_id, [(row['track_id'], row['last_played']) for row in rows])
+    return RECENT_PLAYS.get(user_id)
+
+def _use_ann(index, metric, engine):
+    engine = engine or SIMILARITY_ENGINE
+    if engine == "exact":
+        return False
+    if engine not in ("auto", "ann"):
+        raise ValueError(f"Неизвестный движок поиска: {engine}")
+    # A missing index (the euclidean one on first use) is built in the
+    # background, the query is answered exactly meanwhile
+    if index.get_ann(metric, wait=False) is None:
+        return False
+    if engine == "auto" and index.ann_recall.get(metric, 0.0) < ANN_MIN_RECALL:
+        return False
+    return True
+
+def _rank_neighbours(index, target_id, k, metric, use_ann, exclude_ids=(), space="features"):
+    """[(track_id, distance), ...] of the k nearest tracks, closest first."""
+    rows = None
+    if space == "embedding":
+        # The float16 block is only held by workers that were asked for it
+        index.fill_embeddings(load_embeddings)
+        t4 = time.perf_counter()
+        rows, dists = index.embedding_search(target_id, k, metric, exclude_ids=exclude_ids)
+        print(f"[TIMER] поиск по эмбеддингам: {time.perf_counter() - t4:.3f} сек")
+    elif use_ann:
+        t4 = time.perf_counter()
+        rows, dists = index.ann_search(target_id, k, metric, exclude_ids=exclude_ids)
+        print(f"[TIMER] ANN поиск: {time.perf_counter() - t4:.3f} сек")
+        if len(rows) < min(k, len(index) - 1 - len(exclude_ids)):
+            # The index could not return enough candidates, redo it exactly
+            rows = None
+
+    if rows is None:
+        t4 = time.perf_counter()
+        rows, dists = index.exact_search(target_id, k, metric, exclude_ids=exclude_ids)
+        print(f"[TIMER] расчет расстояний: {time.perf_counter() - t4:.3f} сек")
+
+    # Non-finite distances are already dropped by the index, so the result is JSON-safe
+    return list(zip(index.ids[rows].tolist(), dists.tolist()))
+
+def find_similar_tracks(target_id, user_id: str = None, top_n=10, metric="cosine", engine: str = None,
+                        space="features"):
+    """
+    `space` is "features" (audio features + genre scores) or "embedding"
+    (the pooled AST embeddings, always searched exactly).
+    """
+    t0 = time.perf_counter()
+
+    index = get_similarity_index()
+    if target_id not in index:
+        raise ValueError(f"Трек с ID {target_id} не найден в кеше")
+    if metric not in ("cosine", "euclidean"):
         raise ValueError("Неизвестная метрика")
-    print(f"[TIMER] расчет расстояний: {time.perf_counter() - t4:.3f} сек")
-
-    dists[target_idx] = np.inf
-
-    # Get recently played tracks
-    recently_played = set()
-    if user_id:
-        with get_connection() as conn:
-            with conn.cursor() as cur:
-                ten_minutes_ago = int(time.time()) - 600
-                cur.execute(
-                    "SELECT track_id FROM listening_history WHERE user_id = %s AND last_played > %s",
-                    (user_id, ten_minutes_ago)
-                )
-                rows = cur.fetchall()
-                recently_played = {row['track_id'] for row in rows}
-
-    # Fetch more tracks to have a buffer for filtering
-    initial_top_n = top_n + len(recently_played) + 50 
-    top_idx = np.argsort(dists)
-
-    similarities = []
-    for i in top_idx:
-        track_id = ids[i]
-        if track_id != target_id and track_id not in recently_played:
-            similarities.append((track_id, files[track_id], dists[i]))
-            if len(similarities) >= top_n:
-                break
-    
-    # Filter out non-finite values to prevent JSON serialization errors
-    final_similarities = []
-    for sid, fname, dist in similarities:
-        if np.isfinite(dist):
-            final_similarities.append((sid, fname, dist))
-        else:
-            print(f"[WARN] Skipping track ID {sid} from similar results due to non-finite distance.")
-            
+    if space not in SPACES:
+        raise ValueError(f"Неизвестное пространство: {space}")
+
+    # Read the version before searching: a result computed while the index
+    # is being updated is then tagged stale and never served afterwards
+    version = INDEX_VERSION
+    use_ann = space == "features" and _use_ann(index, metric, engine)
+    key = (target_id, metric, top_n, "ann" if use_ann else "exact", space)
+
+    # Cached lists are not filtered per user, so they carry extra neighbours
+    # to stay useful after recent plays are removed
+    k = top_n + CACHE_EXTRA_NEIGHBOURS
+    ranked = SIMILARITY_CACHE.get(key, version)
+    if ranked is None:
+        ranked = _rank_neighbours(index, target_id, k, metric, use_ann, space=space)
+        SIMILARITY_CACHE.put(key, version, ranked)
+
+    recently_played = get_recently_played(user_id)
+    neighbours = [(sid, dist) for sid, dist in ranked if sid not in recently_played][:top_n]
+    if len(neighbours) < top_n and len(ranked) >= k:
+        # The user played through the whole buffer, search again without the cache
+        neighbours = _rank_neighbours(index, target_id, top_n, metric, use_ann, exclude_ids=recently_played,
+                                      space=space)
+
+    similarities = [(sid, index.files.get(sid), dist) for sid, dist in neighbours]
+
     print(f"[TIMER] find_similar_tracks (только поиск): {time.perf_counter() - t0:.3f} сек")
     
-    return final_similarities
+    return similarities
+
+def similarity_cache_stats():
+    return {**SIMILARITY_CACHE.stats(), "index_version": INDEX_VERSION}
+
+def find_similar_tracks_batch(seed_ids, user_id: str = None, top_n=10, metric="cosine", centroid=False):
+    """
+    Exact neighbours for many seeds with a single matrix product and a
+    single recent-plays lookup. Seeds are never returned as results.
+
+    Returns ({seed_id: [(id, file, distance), ...]}, missing_seed_ids), or
+    ([(id, file, distance), ...], missing_seed_ids) for the fused centroid
+    ranking when centroid=True.
+    """
+    t0 = time.perf_counter()
+    index = get_similarity_index()
+    seed_ids = list(dict.fromkeys(seed_ids))
+    found = [sid for sid in seed_ids if sid in index]
+    missing = [sid for sid in seed_ids if sid not in index]
+    recently_played = get_recently_played(user_id)
+
+    def to_tracks(rows, dists):
+        ids = index.ids[rows].tolist()
+        return [(sid, index.files.get(sid), dist) for sid, dist in zip(ids, dists.tolist())]
+
+    if centroid:
+        result = to_tracks(*index.search_many(found, top_n, metric, recently_played, centroid=True))
+    else:
+        per_seed = index.search_many(found, top_n, metric, recently_played)
+        result = {sid: to_tracks(rows, dists) for sid, (rows, dists) in zip(found, per_seed)}
+
+    print(f"[TIMER] find_similar_tracks_batch ({len(found)} seeds): {time.perf_counter() - t0:.3f} сек")
+    return result, missing
 
 if __name__ == "__main__":
-    precompute_data()
+    load_similarity_data()
     target_id = 14
     similar = find_similar_tracks(target_id, metric="cosine")
     print("Похожие треки:")
     for tid, f, d in similar:
-        print(f"{tid}: {f} -> distance {d:.4f}")
\ No newline at end of file
+        print(f"{tid}: {f} -> distance {d:.4f}")
+    if SIMILARITY_INDEX.get_ann("cosine") is not None:
+        print(f"ANN recall@10 (cosine): {SIMILARITY_INDEX.ann_recall['cosine']:.3f}")
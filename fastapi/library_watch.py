@@ -0,0 +1,134 @@
+import asyncio
+import os
+import traceback
+
+try:
+    import watchfiles
+except ImportError:  # falls back to polling
+    watchfiles = None
+
+from file_manifest import AUDIO_EXTENSIONS, stat_tree
+
+# Changes are handed to the scanner once the folder has been quiet for
+# WATCH_DEBOUNCE seconds, so a file still being copied is analysed once
+WATCH_DEBOUNCE = float(os.getenv("WATCH_DEBOUNCE", 2.0))
+# Without watchfiles (or with WATCH_POLLING=1) the folder is stat-walked
+# every WATCH_POLL_INTERVAL seconds instead of using OS notifications
+WATCH_POLLING = os.getenv("WATCH_POLLING", "0") == "1"
+WATCH_POLL_INTERVAL = float(os.getenv("WATCH_POLL_INTERVAL", 10.0))
+
+
+def uses_notifications():
+    return watchfiles is not None and not WATCH_POLLING
+
+
+def _relevant(path):
+    # Deleted paths can no longer be told apart from deleted directories
+    return path.lower().endswith(AUDIO_EXTENSIONS) or os.path.isdir(path) or not os.path.exists(path)
+
+
+class LibraryWatcher:
+    """
+    Watches the music folder and runs the scanner on just the files and
+    directories that changed, in debounced batches. The scanner diffs them
+    against the file manifest, so new and modified files are analysed,
+    deleted ones pruned and moved ones re-linked, and the similarity index
+    is updated incrementally, without walking the whole library.
+
+    `get_scanner` returns the scanner to use; a batch waits while a full
+    scan is running or an unfinished job waits to be resumed, since the
+    scanner would resume that job instead of scanning the batch.
+    """
+
+    def __init__(self, get_scanner, debounce=WATCH_DEBOUNCE):
+        self.get_scanner = get_scanner
+        self.debounce = debounce
+        self.pending = set()
+        self._changed = asyncio.Event()
+        self._task = None
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        if not self.running:
+            self._task = asyncio.create_task(self._run())
+            self._task.add_done_callback(self._stopped)
+
+    @staticmethod
+    def _stopped(task):
+        if not task.cancelled() and task.exception() is not None:
+            print(f"[WATCH ERROR] watch mode stopped: {task.exception()}")
+            traceback.print_exception(task.exception())
+
+    async def stop(self):
+        if self.running:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+
+    async def _run(self):
+        folder = self.get_scanner().music_folder
+        print(f"[WATCH] Watching {folder} ({'notifications' if uses_notifications() else 'polling'})")
+        consumer = asyncio.create_task(self._consume())
+        consumer.add_done_callback(self._stopped)
+        try:
+            async for paths in (self._notifications(folder) if uses_notifications() else self._poll(folder)):
+                self.pending.update(paths)
+                self._changed.set()
+        finally:
+            consumer.cancel()
+            print("[WATCH] Stopped")
+
+    async def _notifications(self, folder):
+        async for changes in watchfiles.awatch(folder, watch_filter=None):
+            yield {path for _, path in changes if _relevant(path)}
+
+    async def _poll(self, folder):
+        loop = asyncio.get_running_loop()
+        previous = await loop.run_in_executor(None, stat_tree, folder)
+        while True:
+            await asyncio.sleep(WATCH_POLL_INTERVAL)
+            current = await loop.run_in_executor(None, stat_tree, folder)
+            changed = (current.keys() ^ previous.keys()) | {p for p in current.keys() & previous.keys()
+                                                            if current[p] != previous[p]}
+            previous = current
+            if changed:
+                yield {os.path.join(folder, path) for path in changed}
+
+    async def _consume(self):
+        while True:
+            await self._changed.wait()
+            # Debounce: wait until no event arrived for a whole period
+            while self._changed.is_set():
+                self._changed.clear()
+                await asyncio.sleep(self.debounce)
+
+            try:
+                # The job check comes first: nothing may await between the status check and run()
+                while await self._job_waiting() or self.get_scanner().status in ("running", "paused"):
+                    await asyncio.sleep(self.debounce)
+            except Exception as e:
+                print(f"[WATCH ERROR] could not check for scan jobs: {e}")
+                await asyncio.sleep(self.debounce)
+                self._changed.set()
+                continue
+
+            paths, self.pending = self.pending, set()
+            if paths:
+                print(f"[WATCH] {len(paths)} changed paths")
+                try:
+                    await self.get_scanner().run(paths)
+                except Exception as e:
+                    print(f"[WATCH ERROR] scan of {len(paths)} changed paths failed: {e}")
+                    traceback.print_exc()
+
+    async def _job_waiting(self):
+        """True while a scan job is unfinished; a run() now would resume it and drop the batch."""
+        scanner = self.get_scanner()
+        job = await asyncio.get_running_loop().run_in_executor(None, scanner.jobs.unfinished)
+        return job is not None
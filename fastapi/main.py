@@ -7,13 +7,14 @@ from fastapi import FastAPI, HTTPException, Request, status
 from fastapi.responses import JSONResponse, FileResponse
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.staticfiles import StaticFiles
-from pydantic import BaseModel
+from pydantic import BaseModel, conint, conlist
 from dotenv import load_dotenv
 import pymysql
 import json
 
 from get_vector import *
 from playlist_specs import analyze_playlist
+from cover_store import COVER_SIZES, COVERS_DIR, STORE_DIR, STORE_URL, cover_url
 # Add project root to sys.path to allow importing get_vector
 # sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 # from fastapi.get_vector import precompute_data
@@ -99,6 +100,82 @@ def init_db():
             )
         """)
 
+        # Normalised title/artist tokens for the scanner's duplicate check. Binary
+        # collation: the default one ignores accents, so "café" and "cafe" of one
+        # title would collide on the primary key
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS track_tokens (
+                track_id INT NOT NULL,
+                token VARCHAR(255) COLLATE utf8mb4_bin NOT NULL,
+                PRIMARY KEY (track_id, token),
+                KEY (token)
+            )
+        """)
+        cursor.execute("SHOW FULL COLUMNS FROM track_tokens LIKE 'token'")
+        if cursor.fetchone()["Collation"] != "utf8mb4_bin":
+            cursor.execute("ALTER TABLE track_tokens MODIFY token VARCHAR(255) COLLATE utf8mb4_bin NOT NULL")
+
+        # Pooled AST embedding of every track (float16, little-endian), an
+        # alternative similarity space to the hand-made features
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS track_embeddings (
+                track_id INT NOT NULL PRIMARY KEY,
+                vector BLOB NOT NULL
+            )
+        """)
+
+        # Cover art of every track with one, by hash of the image in cover_store
+        # (tracks of an album share it)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS track_covers (
+                track_id INT NOT NULL PRIMARY KEY,
+                hash CHAR(40) NOT NULL,
+                KEY (hash)
+            )
+        """)
+
+        # What every scanned file looked like when it was analysed, so a rescan
+        # only touches new, changed, moved and deleted files
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS file_manifest (
+                file VARCHAR(512) NOT NULL PRIMARY KEY,
+                track_id INT NOT NULL,
+                size BIGINT NOT NULL,
+                mtime_ns BIGINT NOT NULL,
+                hash CHAR(40) NULL,
+                KEY (track_id),
+                KEY (size)
+            )
+        """)
+
+        # Durable scan jobs and their per-file work items, so a scan resumes after a restart
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS scan_jobs (
+                id INT PRIMARY KEY AUTO_INCREMENT,
+                status VARCHAR(16) NOT NULL,
+                created_at BIGINT NOT NULL,
+                finished_at BIGINT NULL,
+                discovered TINYINT NOT NULL DEFAULT 0
+            )
+        """)
+        # Added after the table; a job interrupted before its walk was over has to walk again
+        cursor.execute("SHOW COLUMNS FROM scan_jobs LIKE 'discovered'")
+        if cursor.fetchone() is None:
+            cursor.execute("ALTER TABLE scan_jobs ADD COLUMN discovered TINYINT NOT NULL DEFAULT 0")
+
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS scan_items (
+                job_id INT NOT NULL,
+                file VARCHAR(512) NOT NULL,
+                changed TINYINT NOT NULL DEFAULT 0,
+                state VARCHAR(16) NOT NULL DEFAULT 'pending',
+                attempts INT NOT NULL DEFAULT 0,
+                error TEXT NULL,
+                PRIMARY KEY (job_id, file),
+                KEY (job_id, state)
+            )
+        """)
+
 
 # -------------------------------------------------------------
 # GENRES COLOR
@@ -115,6 +192,33 @@ def get_color_for_genre(label):
     return GENRE_COLORS[('default',)]
 
 
+# -------------------------------------------------------------
+# COVERS
+# -------------------------------------------------------------
+def get_cover_urls(cursor, track_ids):
+    """
+    {track_id: {size: url}} of the tracks with cover art, a URL per
+    cover_store size ("64", "256", "full"; WebP, the JPEG variants sit next
+    to them as .jpg). A cover not moved into the store yet by a full scan
+    has its old per-track URL for every size.
+    """
+    if not track_ids:
+        return {}
+    track_ids = list(track_ids)
+    cursor.execute(f"SELECT track_id, hash FROM track_covers WHERE track_id IN ({', '.join(['%s'] * len(track_ids))})",
+                   track_ids)
+    urls = {row["track_id"]: {size: cover_url(API_BASE_URL, row["hash"], size) for size in COVER_SIZES}
+            for row in cursor.fetchall()}
+    for track_id in track_ids:
+        if track_id in urls:
+            continue
+        for ext in ("jpg", "png"):
+            if os.path.exists(os.path.join(COVERS_DIR, f"{track_id}.{ext}")):
+                urls[track_id] = dict.fromkeys(COVER_SIZES, f"{API_BASE_URL}/covers/{track_id}.{ext}")
+                break
+    return urls
+
+
 # -------------------------------------------------------------
 # ALL TRACK DETAILS
 # -------------------------------------------------------------
@@ -149,17 +253,12 @@ def get_track_details_by_ids(track_ids: List[int], user_id: Optional[str] = None
         cursor.execute(query, params)
         rows = cursor.fetchall()
         
-        covers_dir = os.path.join(os.path.dirname(__file__), "covers")
+        covers = get_cover_urls(cursor, [row["id"] for row in rows])
 
         for row in rows:
             genre = row["primary_genre"] or "Unknown"
             track_id = row["id"]
-            
-            cover_url = None
-            if os.path.exists(os.path.join(covers_dir, f"{track_id}.jpg")):
-                cover_url = f"{API_BASE_URL}/covers/{track_id}.jpg"
-            elif os.path.exists(os.path.join(covers_dir, f"{track_id}.png")):
-                cover_url = f"{API_BASE_URL}/covers/{track_id}.png"
+            cover = covers.get(track_id, {})
 
             details[track_id] = {
                 "id": track_id,
@@ -169,7 +268,8 @@ def get_track_details_by_ids(track_ids: List[int], user_id: Optional[str] = None
                 "genre": genre,
                 "color": get_color_for_genre(genre),
                 "last_played": row["last_played"],
-                "cover_url": cover_url
+                "cover_url": cover.get("full"),
+                "cover_thumb_url": cover.get("64")
             }
             
     return details
@@ -201,7 +301,12 @@ sys.excepthook = log_unhandled_exception
 @app.on_event("startup")
 async def startup_event():
     init_db()
-    precompute_data()
+    load_similarity_data()
+    # With several uvicorn workers only one of them picks up jobs and watches
+    if claim_scan_worker():
+        resume_scan_job()
+        if os.getenv("SCAN_WATCH", "0") == "1":
+            library_watcher.start()
 
 
 @app.middleware("http")
@@ -223,7 +328,19 @@ app.add_middleware(
     allow_headers=["*"]
 )
 
+# Stored covers never change under their URL (it is named by the image hash)
+class ImmutableStaticFiles(StaticFiles):
+    async def get_response(self, path, scope):
+        response = await super().get_response(path, scope)
+        if response.status_code == 200:
+            response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        return response
+
+
 app.mount("/audio", StaticFiles(directory=os.path.join(os.path.dirname(__file__), "audio")), name="audio")
+os.makedirs(STORE_DIR, exist_ok=True)
+# Before /covers, which would match these paths too
+app.mount(STORE_URL, ImmutableStaticFiles(directory=STORE_DIR), name="cover_store")
 app.mount("/covers", StaticFiles(directory=os.path.join(os.path.dirname(__file__),"covers")), name="covers")
 
 
@@ -239,6 +356,7 @@ class Track(BaseModel):
     color: str
     last_played: Optional[int]
     cover_url: Optional[str] = None
+    cover_thumb_url: Optional[str] = None
 
 class Playlist(BaseModel):
     id: int
@@ -251,6 +369,7 @@ class PreviewTrack(BaseModel):
     title: str
     artist: str
     cover_url: Optional[str] = None
+    cover_thumb_url: Optional[str] = None
 
 class PlaylistWithPreview(Playlist):
     preview_tracks: List[PreviewTrack]
@@ -343,6 +462,7 @@ def api_get_tracks(user_id: Optional[str] = None):
 # -------------------------------------------------------------
 @app.post("/api/history/update")
 def update_history(item: HistoryUpdateItem):
+    now = int(time.time())
     with get_connection() as conn:
         cursor = conn.cursor()
         cursor.execute(
@@ -351,8 +471,9 @@ def update_history(item: HistoryUpdateItem):
             VALUES (%s, %s, %s)
             ON DUPLICATE KEY UPDATE last_played = VALUES(last_played)
             """,
-            (item.user_id, item.track_id, int(time.time()))
+            (item.user_id, item.track_id, now)
         )
+    record_play(item.user_id, item.track_id, now)
     return {"status": "ok"}
 
 
@@ -378,13 +499,7 @@ def get_last_played(user_id: str):
 
         genre = row["primary_genre"] or "Unknown"
         track_id = row["id"]
-        
-        cover_url = None
-        covers_dir = os.path.join(os.path.dirname(__file__), "covers")
-        if os.path.exists(os.path.join(covers_dir, f"{track_id}.jpg")):
-            cover_url = f"{API_BASE_URL}/covers/{track_id}.jpg"
-        elif os.path.exists(os.path.join(covers_dir, f"{track_id}.png")):
-            cover_url = f"{API_BASE_URL}/covers/{track_id}.png"
+        cover = get_cover_urls(cursor, [track_id]).get(track_id, {})
 
         return Track(
             id=track_id,
@@ -394,7 +509,8 @@ def get_last_played(user_id: str):
             genre=genre,
             color=get_color_for_genre(genre),
             last_played=row["last_played"],
-            cover_url=cover_url
+            cover_url=cover.get("full"),
+            cover_thumb_url=cover.get("64")
         )
 
 @app.get("/api/history/all", response_model=List[Track])
@@ -536,35 +652,26 @@ def get_playlists(user_id: Optional[str] = None):
                 """
                 params = (user_id, user_id)
                 cursor.execute(query, params)
-                playlists_data = cursor.fetchall()
-                
-                covers_dir = os.path.join(os.path.dirname(__file__), "covers")
+                playlists_data = [row for row in cursor.fetchall() if row["id"] is not None]
+                for row in playlists_data:
+                    row['preview_tracks'] = json.loads(row.get('preview_tracks', '[]'))
+
+                # One lookup for the covers of every playlist
+                covers = get_cover_urls(cursor, {track['id'] for row in playlists_data for track in row['preview_tracks']}
+                                        | {row['last_track_id'] for row in playlists_data if row.get('last_track_id')})
 
                 result = []
                 for row in playlists_data:
-                    if row["id"] is None:
-                        continue
-                    
-                    preview_tracks = json.loads(row.get('preview_tracks', '[]'))
+                    preview_tracks = row['preview_tracks']
                     
                     # Add cover_url to each preview track
                     for track in preview_tracks:
-                        track_id = track['id']
-                        cover_url = None
-                        if os.path.exists(os.path.join(covers_dir, f"{track_id}.jpg")):
-                            cover_url = f"{API_BASE_URL}/covers/{track_id}.jpg"
-                        elif os.path.exists(os.path.join(covers_dir, f"{track_id}.png")):
-                            cover_url = f"{API_BASE_URL}/covers/{track_id}.png"
-                        track['cover_url'] = cover_url
-
-                    # Get cover for the last track in the playlist
-                    last_track_id = row.get('last_track_id')
-                    last_track_cover_url = None
-                    if last_track_id:
-                        if os.path.exists(os.path.join(covers_dir, f"{last_track_id}.jpg")):
-                            last_track_cover_url = f"{API_BASE_URL}/covers/{last_track_id}.jpg"
-                        elif os.path.exists(os.path.join(covers_dir, f"{last_track_id}.png")):
-                            last_track_cover_url = f"{API_BASE_URL}/covers/{last_track_id}.png"
+                        cover = covers.get(track['id'], {})
+                        track['cover_url'] = cover.get("full")
+                        track['cover_thumb_url'] = cover.get("64")
+
+                    # Get cover for the last track in the playlist, sized for the card
+                    last_track_cover_url = covers.get(row.get('last_track_id'), {}).get("256")
 
                     result.append(
                         PlaylistWithPreview(
@@ -597,6 +704,7 @@ class SimilarTrackFull(BaseModel):
     color: str
     last_played: Optional[int] = None
     cover_url: Optional[str] = None
+    cover_thumb_url: Optional[str] = None
 
 
 # try:
@@ -609,10 +717,12 @@ class SimilarTrackFull(BaseModel):
 
 
 @app.get("/api/similar/{track_id}")
-def api_get_similar_tracks(track_id: int, user_id: Optional[str] = None, top_n: int = 15, metric: str = "cosine"):
+def api_get_similar_tracks(track_id: int, user_id: Optional[str] = None, top_n: int = 15, metric: str = "cosine",
+                           engine: Optional[str] = None, space: str = "features"):
     try:
         # 1. Найти похожие треки
-        similar_list_raw = find_similar_tracks(track_id, user_id=user_id, top_n=top_n, metric=metric)
+        similar_list_raw = find_similar_tracks(track_id, user_id=user_id, top_n=top_n, metric=metric, engine=engine,
+                                               space=space)
 
         if not similar_list_raw:
             return []
@@ -640,6 +750,88 @@ def api_get_similar_tracks(track_id: int, user_id: Optional[str] = None, top_n:
         raise HTTPException(status_code=500, detail=f"Ошибка при поиске похожих треков: {str(exc)}")
 
 
+@app.get("/api/similar/cache/stats")
+def api_get_similar_cache_stats():
+    return similarity_cache_stats()
+
+
+# Bounds of one /api/similar/batch request, larger ones get a 422
+SIMILAR_BATCH_MAX_SEEDS = int(os.getenv("SIMILAR_BATCH_MAX_SEEDS", 500))
+SIMILAR_BATCH_MAX_TOP_N = int(os.getenv("SIMILAR_BATCH_MAX_TOP_N", 100))
+
+
+class SimilarBatchRequest(BaseModel):
+    track_ids: conlist(int, max_length=SIMILAR_BATCH_MAX_SEEDS) = []
+    playlist_id: Optional[int] = None
+    user_id: Optional[str] = None
+    top_n: conint(ge=1, le=SIMILAR_BATCH_MAX_TOP_N) = 15
+    metric: str = "cosine"
+    # "per_seed": top_n for every seed, "centroid": one fused ranking for all seeds
+    mode: str = "per_seed"
+
+
+class SimilarBatchResponse(BaseModel):
+    mode: str
+    seeds: List[int]
+    missing: List[int]
+    per_seed: Optional[Dict[int, List[SimilarTrackFull]]] = None
+    tracks: Optional[List[SimilarTrackFull]] = None
+
+
+def get_playlist_track_ids(playlist_id: int) -> List[int]:
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT track_id FROM playlist_tracks WHERE playlist_id = %s ORDER BY position",
+            (playlist_id,)
+        )
+        return [r["track_id"] for r in cursor.fetchall()]
+
+
+@app.post("/api/similar/batch", response_model=SimilarBatchResponse)
+def api_get_similar_tracks_batch(request: SimilarBatchRequest):
+    """
+    Похожие треки сразу для многих треков или целого плейлиста:
+    одно матричное умножение и один запрос деталей вместо N запросов /api/similar.
+    """
+    if request.mode not in ("per_seed", "centroid"):
+        raise HTTPException(400, "mode должен быть 'per_seed' или 'centroid'")
+
+    seeds = list(request.track_ids)
+    if request.playlist_id is not None:
+        seeds += get_playlist_track_ids(request.playlist_id)
+    if not seeds:
+        raise HTTPException(400, "Нужно передать track_ids или playlist_id")
+    seeds = list(dict.fromkeys(seeds))
+    if len(seeds) > SIMILAR_BATCH_MAX_SEEDS:
+        raise HTTPException(422, f"Не больше {SIMILAR_BATCH_MAX_SEEDS} исходных треков за запрос")
+
+    try:
+        result, missing = find_similar_tracks_batch(
+            seeds, user_id=request.user_id, top_n=request.top_n,
+            metric=request.metric, centroid=request.mode == "centroid"
+        )
+    except ValueError as exc:
+        raise HTTPException(400, str(exc))
+
+    lists = [result] if request.mode == "centroid" else list(result.values())
+    all_ids = list({sim_id for sims in lists for sim_id, _, _ in sims})
+    track_details_map = get_track_details_by_ids(all_ids, request.user_id)
+
+    def to_full(sims):
+        return [
+            SimilarTrackFull(distance=float(dist), **track_details_map[sim_id])
+            for sim_id, _, dist in sims if sim_id in track_details_map
+        ]
+
+    response = SimilarBatchResponse(mode=request.mode, seeds=seeds, missing=missing)
+    if request.mode == "centroid":
+        response.tracks = to_full(result)
+    else:
+        response.per_seed = {seed: to_full(sims) for seed, sims in result.items()}
+    return response
+
+
 # -------------------------------------------------------------
 # GET TRACKS FROM PLAYLIST
 # -------------------------------------------------------------
@@ -686,13 +878,25 @@ def get_playlist_tracks(playlist_id: int, user_id: Optional[str] = None):
 import asyncio
 from fastapi import BackgroundTasks
 from scan import Scanner
+from model_registry import MODELS
+from library_watch import LibraryWatcher
 
 # Create a single scanner instance to manage state
 scanner = Scanner(music_folder="audio")
 scanner_task = None
+# Feeds changed files to whatever scanner is current
+library_watcher = LibraryWatcher(lambda: scanner)
+
+def resume_scan_job():
+    """Picks up a scan job that a restart interrupted."""
+    global scanner_task
+    job = scanner.jobs.unfinished()
+    if job is not None:
+        print(f"Found unfinished scan job {job['id']} ({job['status']}), resuming...")
+        scanner_task = asyncio.create_task(scanner.run())
 
 @app.post("/api/scan/start")
-async def start_scan():
+async def start_scan(allow_mass_removal: bool = False):
     global scanner, scanner_task
 
     if scanner.status == "running":
@@ -702,21 +906,22 @@ async def start_scan():
     if scanner.status == "finished":
         scanner = Scanner(music_folder="audio")
 
-    scanner_task = asyncio.create_task(scanner.run())
+    # Lets the scan delete tracks even when most of the library looks gone
+    scanner_task = asyncio.create_task(scanner.run(allow_mass_removal=allow_mass_removal))
     return {"message": "Scan started."}
 
 @app.post("/api/scan/pause")
 async def pause_scan():
     if scanner.status != "running":
         raise HTTPException(status_code=400, detail="No scan is currently running to pause.")
-    scanner.pause()
+    await scanner.pause()
     return {"message": "Scan paused."}
 
 @app.post("/api/scan/resume")
 async def resume_scan():
     if scanner.status != "paused":
         raise HTTPException(status_code=400, detail="Scan is not paused.")
-    scanner.resume()
+    await scanner.resume()
     return {"message": "Scan resumed."}
 
 @app.post("/api/scan/cancel")
@@ -726,7 +931,7 @@ async def cancel_scan():
         raise HTTPException(status_code=400, detail="No active scan to cancel.")
     
     scanner_task.cancel()
-    scanner.cancel()
+    await scanner.cancel()
     scanner_task = None # Clear the task reference
     
     return {"message": "Scan has been cancelled."}
@@ -738,16 +943,34 @@ async def clear_library():
     
     try:
         Scanner.clear_db()
-        # After clearing, it might be good to re-precompute data if needed
-        precompute_data()
+        scanner.forget_library()
+        # The library is empty now, no need to go back to the DB
+        reset_similarity_data()
+        RECENT_PLAYS.clear()
         return {"message": "Music library has been cleared."}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to clear library: {str(e)}")
 
 
+@app.post("/api/scan/watch/start")
+async def start_watch():
+    if library_watcher.running:
+        raise HTTPException(status_code=409, detail="Watch mode is already on.")
+    if not claim_scan_worker():
+        raise HTTPException(status_code=409, detail="Watch mode runs in another worker process.")
+    library_watcher.start()
+    return {"message": "Watching the library for changes."}
+
+@app.post("/api/scan/watch/stop")
+async def stop_watch():
+    if not library_watcher.running:
+        raise HTTPException(status_code=400, detail="Watch mode is not on.")
+    await library_watcher.stop()
+    return {"message": "Stopped watching the library."}
+
 @app.get("/api/scan/progress")
-async def get_scan_progress():
-    return scanner.get_progress()
+def get_scan_progress():
+    return {**scanner.get_progress(), "watching": library_watcher.running, "models": MODELS.status()}
 # -------------------------------------------------------------
 # TRACK COVER
 # -------------------------------------------------------------
@@ -0,0 +1,124 @@
+import ctypes
+import gc
+import os
+import threading
+import time
+
+# Seconds a model may sit unused before it is unloaded to free its RAM
+# (0 keeps models loaded once they are, until the process exits)
+MODEL_IDLE_UNLOAD = float(os.getenv("MODEL_IDLE_UNLOAD", 0))
+
+
+def _release_memory():
+    """Returns freed heap pages to the OS where the C library allows it."""
+    gc.collect()
+    try:
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+class ModelRegistry:
+    """
+    Process-wide models, loaded on first use and shared by every user.
+
+    acquire(name) loads the model with its registered loader the first time
+    (concurrent callers wait for that one load) and counts the caller as a
+    user until release(name). With idle_unload > 0 a model nobody uses is
+    dropped that many seconds after its last release, and loaded again by
+    the next acquire.
+
+    Loads run outside the registry lock, which only guards the dicts, so
+    status() and release() never wait for a model to load.
+    """
+
+    def __init__(self, idle_unload=MODEL_IDLE_UNLOAD):
+        self.idle_unload = idle_unload
+        self._loaders = {}
+        self._models = {}
+        self._users = {}
+        self._released_at = {}
+        # Models being loaded -> event set when the load is over
+        self._loading = {}
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def register(self, name, loader):
+        self._loaders[name] = loader
+
+    def acquire(self, name):
+        while True:
+            with self._lock:
+                if name in self._models:
+                    self._users[name] = self._users.get(name, 0) + 1
+                    return self._models[name]
+                loading = self._loading.get(name)
+                if loading is None:
+                    loading = self._loading[name] = threading.Event()
+                    break
+            # Loaded by another caller; if that load fails, the next waiter tries
+            loading.wait()
+
+        try:
+            t0 = time.perf_counter()
+            model = self._loaders[name]()
+            print(f"[TIMER] загрузка модели {name}: {time.perf_counter() - t0:.3f} сек")
+            with self._lock:
+                self._models[name] = model
+                self._users[name] = self._users.get(name, 0) + 1
+            return model
+        finally:
+            with self._lock:
+                del self._loading[name]
+            loading.set()
+
+    def release(self, name):
+        with self._lock:
+            self._users[name] = max(self._users.get(name, 0) - 1, 0)
+            if self._users[name] == 0:
+                self._released_at[name] = time.monotonic()
+                if self.idle_unload > 0:
+                    self._schedule(self.idle_unload)
+
+    def unload(self, name):
+        """Drops the model now unless it is in use. Returns True if it was unloaded."""
+        with self._lock:
+            if self._users.get(name) or self._models.pop(name, None) is None:
+                return False
+        _release_memory()
+        print(f"Модель {name} выгружена из памяти")
+        return True
+
+    def status(self):
+        with self._lock:
+            return {name: {"loaded": name in self._models, "loading": name in self._loading,
+                           "users": self._users.get(name, 0)}
+                    for name in self._loaders}
+
+    def _schedule(self, delay):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = threading.Timer(delay, self._unload_idle)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _unload_idle(self):
+        now = time.monotonic()
+        with self._lock:
+            self._timer = None
+            idle = [name for name in self._models
+                    if not self._users.get(name) and now - self._released_at.get(name, now) >= self.idle_unload]
+            for name in idle:
+                del self._models[name]
+            # Released again meanwhile: check once its own time is up
+            waiting = [self.idle_unload - (now - self._released_at[name]) for name in self._models
+                       if not self._users.get(name) and name in self._released_at]
+            if waiting:
+                self._schedule(min(waiting))
+        if idle:
+            _release_memory()
+            print(f"Модели выгружены из памяти после {self.idle_unload:g} сек простоя: {', '.join(idle)}")
+
+
+# The models of this process; see audio_analysis for the classifier
+MODELS = ModelRegistry()
@@ -0,0 +1,75 @@
+import asyncio
+import traceback
+
+# Put into a queue after the last item; every stage passes it on once it is done
+END = object()
+
+
+async def close(queue):
+    await queue.put(END)
+
+
+async def run_batches(queue, process, batch_size, max_wait, executor=None):
+    """
+    Serves (payload, future) pairs from `queue` in batches, forever: takes
+    up to `batch_size` of them, waiting at most `max_wait` seconds after
+    the first, runs process([payloads]) in `executor` and resolves every
+    future with its result. A result that is an exception, or an exception
+    raised by process for the whole batch, is set on the future instead.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await queue.get()]
+        deadline = loop.time() + max_wait
+        while len(batch) < batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        try:
+            results = await loop.run_in_executor(executor, process, [payload for payload, _ in batch])
+        except Exception as e:
+            results = [e] * len(batch)
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                # Its caller gave up waiting
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+async def run_stage(inbox, handler, workers, outbox=None):
+    """
+    Runs `workers` tasks that take items from `inbox` until it is closed,
+    await `handler(item)` on each and put the results that are not None
+    into `outbox`. Closes `outbox` when all workers are done.
+
+    The queues are bounded, so a slow stage holds back the ones before it
+    instead of letting work pile up in memory. Handlers are expected to
+    deal with their own errors; an exception that escapes one is printed
+    and the item dropped, so upstream stages are never left blocked.
+    """
+    async def worker():
+        while True:
+            item = await inbox.get()
+            if item is END:
+                # Leave it for the other workers of this stage
+                await inbox.put(END)
+                return
+            try:
+                result = await handler(item)
+            except Exception:
+                traceback.print_exc()
+                continue
+            if result is not None and outbox is not None:
+                await outbox.put(result)
+
+    await asyncio.gather(*(worker() for _ in range(workers)))
+    if outbox is not None:
+        await close(outbox)
@@ -0,0 +1,70 @@
+import threading
+import time
+from collections import OrderedDict, deque
+
+
+class _UserPlays:
+    __slots__ = ("plays", "warm")
+
+    def __init__(self, max_plays):
+        self.plays = deque(maxlen=max_plays)  # (timestamp, track_id), oldest first
+        self.warm = False
+
+
+class RecentPlays:
+    """
+    Tracks each user's plays of the last `window` seconds in process memory,
+    so the similarity filter needs no DB round-trip.
+
+    A user is "warm" once their history was seeded from the DB; until then
+    get() returns None and the caller should fall back to the DB (this only
+    happens once per user after a cold start). Memory is bounded by
+    `max_plays` per user and `max_users` users, least recently seen first out.
+    Plays received by other worker processes are not seen here.
+    """
+
+    def __init__(self, window=600, max_plays=200, max_users=10000):
+        self.window = window
+        self.max_plays = max_plays
+        self.max_users = max_users
+        self._users = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _user(self, user_id):
+        user = self._users.get(user_id)
+        if user is None:
+            user = self._users[user_id] = _UserPlays(self.max_plays)
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        else:
+            self._users.move_to_end(user_id)
+        return user
+
+    def record(self, user_id, track_id, timestamp=None):
+        timestamp = int(time.time()) if timestamp is None else timestamp
+        with self._lock:
+            self._user(user_id).plays.append((timestamp, track_id))
+
+    def seed(self, user_id, plays):
+        """Merges (track_id, timestamp) pairs loaded from the DB and marks the user warm."""
+        with self._lock:
+            user = self._user(user_id)
+            merged = sorted(set(user.plays) | {(ts, track_id) for track_id, ts in plays})
+            user.plays = deque(merged[-self.max_plays:], maxlen=self.max_plays)
+            user.warm = True
+
+    def get(self, user_id, now=None):
+        """Set of track ids played within the window, or None if the user is not warm yet."""
+        cutoff = (int(time.time()) if now is None else now) - self.window
+        with self._lock:
+            user = self._users.get(user_id)
+            if user is None or not user.warm:
+                return None
+            self._users.move_to_end(user_id)
+            while user.plays and user.plays[0][0] <= cutoff:
+                user.plays.popleft()
+            return {track_id for _, track_id in user.plays}
+
+    def clear(self):
+        with self._lock:
+            self._users.clear()
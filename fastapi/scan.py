@@ -3,14 +3,26 @@ import asyncio
 import traceback
 os.environ["TORCHCODEC_DISABLE"] = "1"
 
+import json
 import re
-import librosa
-import numpy as np
+import shutil
+import time
 import pymysql
-from transformers import pipeline
 from mutagen import File as MutagenFile
 from dotenv import load_dotenv
-from get_vector import precompute_data
+from get_vector import add_tracks, bump_library_generation, remove_tracks
+from duplicate_index import MAX_TOKEN_LENGTH, NO_TOKENS, TokenIndex, stored_tokens
+from scan_jobs import ScanJobs
+from scan_stats import ScanStats
+from scan_writer import DB_WRITE_BATCH, ScanWriter
+from file_manifest import AUDIO_EXTENSIONS, compare_entry, content_hash, diff_manifest, iter_tree, stat_tree
+from pipeline import close, run_stage
+from model_registry import MODELS
+from cover_store import legacy_covers, prune_covers, remove_legacy_cover, store_cover
+from audio_analysis import (
+    GENRE_BATCH_SIZE, SCAN_EXECUTOR, SCAN_WORKERS, GenreBatcher, analyze_file,
+    create_process_pool, decode_audio, extract_audio_features, extract_genres,
+)
 
 load_dotenv()
 
@@ -23,6 +35,17 @@ DB_USER = os.getenv("DB_USER", "root")
 DB_PASS = os.getenv("DB_PASS", "root")
 DB_NAME = os.getenv("DB_NAME", "music")
 
+# Bound of the queue of files waiting to be decoded; files are also recorded
+# in the scan job in groups of this size as discovery finds them
+SCAN_QUEUE_SIZE = int(os.getenv("SCAN_QUEUE_SIZE", 64))
+
+# A scan that finds more than this share of the library gone deletes
+# nothing unless started with allow_mass_removal: an unmounted or emptied
+# music folder looks exactly like a library whose files were all deleted
+SCAN_MAX_REMOVE_RATIO = float(os.getenv("SCAN_MAX_REMOVE_RATIO", 0.5))
+# Removals this small are always applied (a small library losing an album)
+MASS_REMOVAL_MIN = 10
+
 def get_connection():
     return pymysql.connect(
         host=DB_HOST,
@@ -35,274 +58,812 @@ def get_connection():
         autocommit=True
     )
 
+def _tag_text(audio, *keys):
+    """First value of the first present tag; ID3 frames keep their values in .text."""
+    for key in keys:
+        value = audio.tags.get(key) if audio.tags else None
+        text = getattr(value, "text", value)
+        if text:
+            return str(text[0]).strip()
+    return ""
+
+class AnalysisError(Exception):
+    """A file could not be decoded or analysed; the details have been printed already."""
+
+
+class LibraryUnavailable(Exception):
+    """The music folder is missing or cannot be read; the scan stops before touching the library."""
+
+
+class ScanItem:
+    """A file on its way through the scan pipeline."""
+
+    def __init__(self, relative_path, file_path, changed):
+        self.relative_path = relative_path
+        self.file_path = file_path
+        self.changed = changed
+        self.started = time.perf_counter()
+        self.stat = None
+        self.tags = None
+        self.tokens = None
+        self.signal = None
+        self.clip = None
+        self.feats = None
+        self.genres = None
+        self.embedding = None
+
+
 class Scanner:
     def __init__(self, music_folder="audio"):
         self.music_folder = os.path.join(os.path.dirname(__file__), music_folder)
-        self.covers_folder = os.path.join(os.path.dirname(__file__), "covers")
         self.status = "idle"
         self.total_files = 0
         self.processed_files = 0
         self.current_filename = ""
-        self.files_to_scan = []
-        self.existing_files_in_db = []
+        self.disk_files = {}
+        self._hashes = {}
+        # Loaded on the first run, then kept up to date across watch-mode runs
+        self.token_index = None
+        self.saved_track_ids = []
         self._pause_event = asyncio.Event()
         self._pause_event.set()
-        self.semaphore = asyncio.Semaphore(os.cpu_count() or 4)
-
-        self.classifier = pipeline("audio-classification", model="MIT/ast-finetuned-audioset-10-10-0.4593")
+        self.use_processes = SCAN_EXECUTOR == "process"
+        # Files per analysis stage; enough to fill a genre batch in thread mode
+        self.concurrency = SCAN_WORKERS if self.use_processes else max(os.cpu_count() or 4, GENRE_BATCH_SIZE)
+        self._queues = {}
+        self.discovering = False
+        self._pool = None
+        self._batcher = None
+        self._writer = None
+        self._workers_lock = asyncio.Lock()
+        # Keeps job status writes in the order they were made (pause then resume)
+        self._status_lock = asyncio.Lock()
+        self.jobs = ScanJobs(get_connection)
+        self.job_id = None
+        self.stats = ScanStats()
+        # Taken from MODELS when a scan needs it and handed back when it ends;
+        # in process mode every worker loads its own classifier instead
+        self.classifier = None
+        # Tracks a scan found gone but did not delete, see SCAN_MAX_REMOVE_RATIO
+        self.held_removals = 0
 
     def get_progress(self):
+        """Progress of the current or last scan job, read from the DB so it survives restarts."""
+        job, counts = self.jobs.progress(self.job_id)
+        if job is None:
+            return {"status": self.status, "total": 0, "current": 0, "failed": 0, "filename": ""}
         return {
-            "status": self.status, "total": self.total_files,
-            "current": self.processed_files, "filename": self.current_filename,
+            # A job left unfinished by a restart reports its stored status until it is resumed
+            "status": self.status if self.job_id == job["id"] else job["status"],
+            "job_id": job["id"],
+            "total": sum(counts.values()),
+            "current": counts.get("done", 0) + counts.get("failed", 0),
+            "failed": counts.get("failed", 0),
+            "filename": self.current_filename,
+            "held_removals": self.held_removals,
+            "stats": self._stats_snapshot(),
         }
 
+    def _stats_snapshot(self):
+        """
+        Stage timings, rate, ETA and queue depths of the scan running in
+        this process. While discovery is still going the total, and so the
+        ETA, only covers the files found so far.
+        """
+        remaining = max(self.total_files - self.processed_files, 0)
+        queues = {name: queue.qsize() for name, queue in self._queues.items()}
+        if self._batcher is not None:
+            queues["genre_batch_queue"] = self._batcher.queue_depth()
+        if self._writer is not None:
+            queues["write_queue"] = self._writer.queue_depth()
+        return {**self.stats.snapshot(remaining, queues), "discovering": self.discovering}
+
     async def _run_in_executor(self, func, *args):
         loop = asyncio.get_running_loop()
         return await loop.run_in_executor(None, func, *args)
 
-    def _discover_files(self):
-        self.files_to_scan = []
-        for root, _, files in os.walk(self.music_folder):
-            for f in files:
-                if f.lower().endswith((".mp3", ".wav", ".flac")):
-                    self.files_to_scan.append(os.path.join(root, f))
-        self.total_files = len(self.files_to_scan)
+    def _relative(self, file_path):
+        return os.path.relpath(file_path, self.music_folder).replace('\\', '/')
+
+    def _stat_paths(self, paths):
+        """
+        Stats just the given changed files and directories into disk_files.
+        Returns (relative paths, directory prefixes) whose manifest rows the
+        change may affect; a path that is gone may have been a directory.
+        Returns None if the whole folder has to be compared.
+        """
+        self.disk_files = {}
+        files, prefixes = [], []
+        for file_path in paths:
+            relative = self._relative(file_path)
+            if relative == ".":
+                # The music folder itself changed: fall back to a full scan
+                return None
+            if relative.startswith(".."):
+                continue
+            if os.path.isdir(file_path):
+                try:
+                    listing = stat_tree(file_path)
+                except FileNotFoundError:
+                    # Deleted since the event: its tracks are gone
+                    listing = {}
+                self.disk_files.update({f"{relative}/{path}": st for path, st in listing.items()})
+                prefixes.append(relative)
+                continue
+            if not file_path.lower().endswith(AUDIO_EXTENSIONS):
+                if not os.path.exists(file_path):
+                    prefixes.append(relative)
+                continue
+            files.append(relative)
+            try:
+                st = os.stat(file_path)
+            except OSError:
+                continue
+            self.disk_files[relative] = (st.st_size, st.st_mtime_ns)
+        return files, prefixes
+
+    def _hash_of(self, relative_path):
+        if relative_path not in self._hashes:
+            try:
+                self._hashes[relative_path] = content_hash(os.path.join(self.music_folder, relative_path))
+            except OSError:
+                self._hashes[relative_path] = None
+        return self._hashes[relative_path]
 
     def _get_existing_files_from_db(self):
         with get_connection() as conn:
             with conn.cursor() as cursor:
-                cursor.execute("SELECT file FROM features")
+                cursor.execute("SELECT f.id, f.file, t.token FROM features f LEFT JOIN track_tokens t ON t.track_id = f.id")
                 rows = cursor.fetchall()
-                self.existing_files_in_db = [os.path.join(self.music_folder, row["file"]) for row in rows]
 
-    def _reset_state(self):
+        tokens, untokenised = {}, {}
+        for row in rows:
+            file_path = os.path.join(self.music_folder, row["file"])
+            tokens.setdefault(file_path, set())
+            if row["token"] is None:
+                untokenised[row["id"]] = file_path
+            elif row["token"] != NO_TOKENS:
+                tokens[file_path].add(row["token"])
+
+        if untokenised:
+            # Tracks scanned before tokens were stored: read their tags once and keep them
+            print(f"Indexing metadata tokens of {len(untokenised)} tracks...")
+            with get_connection() as conn:
+                with conn.cursor() as cursor:
+                    for track_id, file_path in untokenised.items():
+                        try:
+                            file_tokens = self._metadata_words(self._read_tags(file_path), file_path)
+                            self._store_tokens(cursor, track_id, file_tokens)
+                        except Exception as e:
+                            # Tried again on the next scan; one file must not stop the scanner
+                            print(f"[WARN] could not index tokens of {file_path}: {e}")
+                            continue
+                        tokens[file_path] = file_tokens
+
+        self.token_index = TokenIndex()
+        for file_path, file_tokens in tokens.items():
+            self.token_index.add(file_path, file_tokens)
+
+    def _load_manifest(self, scope=None):
+        """
+        Manifest rows of all tracks by relative path, or only of the tracks
+        within `scope` = (files, directory prefixes) from _stat_paths.
+        Tracks scanned before the manifest existed have a row without size.
+        """
+        sql = """SELECT f.id AS track_id, f.file, m.size, m.mtime_ns, m.hash
+                 FROM features f LEFT JOIN file_manifest m ON m.file = f.file"""
+        params = []
+        if scope is not None:
+            files, prefixes = scope
+            if not files and not prefixes:
+                return {}
+            conditions = []
+            if files:
+                conditions.append(f"f.file IN ({','.join(['%s'] * len(files))})")
+                params.extend(files)
+            for prefix in prefixes:
+                conditions.append("f.file LIKE %s")
+                params.append(prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "/%")
+            sql += " WHERE " + " OR ".join(conditions)
+
+        with get_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(sql, params)
+                return {row["file"]: row for row in cursor.fetchall()}
+
+    @staticmethod
+    def _library_size():
+        with get_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT COUNT(*) AS n FROM features")
+                return cursor.fetchone()["n"]
+
+    def _check_music_folder(self):
+        if not os.path.isdir(self.music_folder):
+            raise LibraryUnavailable(f"music folder {self.music_folder} is missing")
+        if not os.access(self.music_folder, os.R_OK | os.X_OK):
+            raise LibraryUnavailable(f"music folder {self.music_folder} cannot be read")
+
+    def _classify_listing(self, listing, manifest, known_sizes, deferred):
+        """
+        Sorts one directory listing against the manifest, popping the rows
+        of files it finds. Returns (items to analyse, touched, adopted):
+        new and changed files, files with a new mtime but the same content,
+        and files of tracks from before the manifest, recorded as they are.
+        New files the size of a known track may be the new name of one that
+        has not been missed yet; they wait in `deferred` until the walk is over.
+        """
+        items, touched, adopted = [], [], []
+        for path, stat in listing:
+            row = manifest.pop(path, None)
+            if row is None:
+                if stat[0] in known_sizes:
+                    deferred[path] = stat
+                else:
+                    items.append((path, False))
+            elif row["size"] is None:
+                adopted.append((path, row["track_id"], *stat))
+            else:
+                state = compare_entry(row, stat, self._hash_of, path)
+                if state == "changed":
+                    items.append((path, True))
+                elif state == "touched":
+                    touched.append((*stat, path))
+        return items, touched, adopted
+
+    def _update_manifest(self, touched, adopted):
+        with get_connection() as conn:
+            with conn.cursor() as cur:
+                if touched:
+                    cur.executemany("UPDATE file_manifest SET size=%s, mtime_ns=%s WHERE file=%s", touched)
+                if adopted:
+                    cur.executemany("INSERT INTO file_manifest (file, track_id, size, mtime_ns) VALUES (%s,%s,%s,%s)",
+                                    adopted)
+
+    def _apply_moves_and_removals(self, diff, manifest):
+        """
+        Re-links moved files to their tracks and deletes tracks whose file is
+        gone, without analysing anything. Returns the ids of deleted tracks.
+        """
+        removed_ids = [manifest[path]["track_id"] for path in diff.removed]
+        with get_connection() as conn:
+            with conn.cursor() as cur:
+                for old, new in diff.renamed:
+                    size, mtime_ns = self.disk_files[new]
+                    cur.execute("UPDATE features SET file=%s WHERE id=%s", (new, manifest[old]["track_id"]))
+                    cur.execute("UPDATE file_manifest SET file=%s, size=%s, mtime_ns=%s WHERE file=%s",
+                                (new, size, mtime_ns, old))
+                if removed_ids:
+                    placeholders = ",".join(["%s"] * len(removed_ids))
+                    for table, column in (("playlist_tracks", "track_id"), ("listening_history", "track_id"),
+                                          ("track_tokens", "track_id"), ("genres", "track_id"),
+                                          ("track_embeddings", "track_id"), ("track_covers", "track_id"),
+                                          ("file_manifest", "track_id"),
+                                          ("features", "id")):
+                        cur.execute(f"DELETE FROM {table} WHERE {column} IN ({placeholders})", removed_ids)
+
+        for old, new in diff.renamed:
+            old_path, new_path = os.path.join(self.music_folder, old), os.path.join(self.music_folder, new)
+            self.token_index.add(new_path, self.token_index.tokens.get(old_path, ()))
+            self.token_index.remove(old_path)
+            print(f"[MOVED] {old} -> {new}")
+        for path, track_id in zip(diff.removed, removed_ids):
+            self.token_index.remove(os.path.join(self.music_folder, path))
+            try:
+                remove_legacy_cover(track_id)
+            except OSError as e:
+                print(f"[COVER ERROR] {track_id}: {e}")
+            print(f"[REMOVED] {path}")
+        return removed_ids
+
+    def _reset_state(self, keep_tokens=False):
         self.status = "idle"
         self.processed_files = 0
         self.total_files = 0
         self.current_filename = ""
-        self.files_to_scan = []
-        self.existing_files_in_db = []
+        self.disk_files = {}
+        self._hashes = {}
+        self._queues = {}
+        self.discovering = False
+        if not keep_tokens:
+            self.token_index = None
+        self.job_id = None
+        self.stats = ScanStats()
+        self.saved_track_ids = []
+        self.held_removals = 0
         self._pause_event.set()
 
-    async def _process_file(self, file_path):
-        async with self.semaphore:
-            await self._pause_event.wait()
-            
-            if file_path in self.existing_files_in_db:
-                # This check is now redundant if we pre-filter but safer to keep
-                self.processed_files += 1
-                return
-
-            try:
-                is_dup = await self._run_in_executor(self._is_duplicate, file_path)
-                if is_dup:
-                    return
+    # ---------------------------------------------------------
+    # PIPELINE
+    # ---------------------------------------------------------
+    # discover -> work -> decode -> decoded -> analyze -> persist -> write
+    # Every arrow is a bounded queue. In process mode the decode stage runs
+    # the whole analysis in the worker pool and feeds persist directly.
 
-                feats = await self._run_in_executor(self._extract_audio_features, file_path)
-                if feats is None:
-                    return
+    async def _run_pipeline(self, produce):
+        """Runs the producer `produce(queue)` and the stages it feeds until all its files are through."""
+        work = asyncio.Queue(SCAN_QUEUE_SIZE)
+        persist = asyncio.Queue(2 * DB_WRITE_BATCH)
+        self._queues = {"work": work, "persist": persist}
 
-                genres = await self._run_in_executor(self._extract_genres, file_path)
-                await self._save_to_db(file_path, feats, genres)
+        async def producer():
+            try:
+                await produce(work)
+            finally:
+                await close(work)
+
+        if self.use_processes:
+            stages = [run_stage(work, self._decode, self.concurrency, persist)]
+        else:
+            # Decoded audio is the bulky part, keep only one batch of it waiting
+            decoded = asyncio.Queue(self.concurrency)
+            self._queues["decoded"] = decoded
+            stages = [run_stage(work, self._decode, self.concurrency, decoded),
+                      run_stage(decoded, self._analyze, self.concurrency, persist)]
+        # Enough writers in flight for the DB writer to fill a batch
+        stages.append(run_stage(persist, self._persist, DB_WRITE_BATCH))
+        await asyncio.gather(producer(), *stages)
+
+    async def _enqueue(self, work, items):
+        """
+        Records [(relative path, changed)] in the job, then queues those still
+        to do (waiting while the queue is full). A resumed job's walk finds
+        items it has already done or given up on again; they are not queued.
+        """
+        if not items:
+            return
+        runnable = await self._run_in_executor(self.jobs.add_items, self.job_id, items)
+        for path, changed in items:
+            if path not in runnable:
+                continue
+            self.total_files += 1
+            await work.put(ScanItem(path, os.path.join(self.music_folder, path), changed))
+
+    async def _discover(self, work, paths=None, allow_mass_removal=False):
+        """
+        Producer of a new job: walks the music folder (or takes just
+        `paths`) a directory at a time with os.scandir and queues new and
+        changed files as soon as they are found. Moves and deletions are
+        only known once the walk is over and are applied then, unless they
+        would remove more than SCAN_MAX_REMOVE_RATIO of the library and
+        `allow_mass_removal` is not set.
+        """
+        self.discovering = True
+        # Also reached by a watch-mode run when the folder itself is deleted
+        await self._run_in_executor(self._check_music_folder)
+        scope = await self._run_in_executor(self._stat_paths, paths) if paths is not None else None
+        unreadable = []
+        listings = iter_tree(self.music_folder, unreadable) if scope is None else iter([list(self.disk_files.items())])
+        manifest = await self._run_in_executor(self._load_manifest, scope)
+        known_sizes = {row["size"] for row in manifest.values() if row["size"] is not None}
+        deferred = {}
+        counts = {"new": 0, "changed": 0, "touched": 0}
+        found = 0
+
+        pending, touched, adopted = [], [], []
+        while True:
+            listing = await self._run_in_executor(next, listings, None)
+            if listing is not None:
+                found += len(listing)
+                classified = await self._run_in_executor(self._classify_listing, listing, manifest, known_sizes, deferred)
+                for collected, new in zip((pending, touched, adopted), classified):
+                    collected.extend(new)
+            if len(pending) >= SCAN_QUEUE_SIZE or listing is None:
+                if touched or adopted:
+                    await self._run_in_executor(self._update_manifest, touched, adopted)
+                counts["touched"] += len(touched)
+                counts["new"] += sum(1 for _, changed in pending if not changed)
+                counts["changed"] += sum(1 for _, changed in pending if changed)
+                items, pending, touched, adopted = pending, [], [], []
+                await self._enqueue(work, items)
+            if listing is None:
+                break
+
+        # Files in directories that could not be listed are unknown, not gone
+        for prefix in unreadable:
+            print(f"[WARN] could not read {prefix}, keeping its tracks")
+            for path in [path for path in manifest if path.startswith(prefix + "/")]:
+                del manifest[path]
+
+        # What is left of the manifest was not found on disk: moved or deleted
+        diff = await self._run_in_executor(diff_manifest, deferred, manifest, self._hash_of)
+        self.disk_files = deferred
+        self.discovering = False
+        print(f"Library changes: {counts['new'] + len(diff.added)} new, {counts['changed']} changed, "
+              f"{len(diff.removed)} removed, {len(diff.renamed)} moved, {counts['touched']} touched")
+        if diff.removed and not allow_mass_removal:
+            library_size = await self._run_in_executor(self._library_size)
+            # A full scan that finds no file at all is an empty mount point whatever the library size
+            if (len(diff.removed) > max(SCAN_MAX_REMOVE_RATIO * library_size, MASS_REMOVAL_MIN)
+                    or (scope is None and not found)):
+                print(f"[WARN] {len(diff.removed)} of {library_size} tracks are gone from {self.music_folder}; "
+                      f"not deleting them. Start the scan with allow_mass_removal to delete them.")
+                self.held_removals = len(diff.removed)
+                diff.removed = []
+        if diff.renamed or diff.removed:
+            self._invalidate_snapshots()
+            removed_ids = await self._run_in_executor(self._apply_moves_and_removals, diff, manifest)
+            if removed_ids:
+                await self._run_in_executor(remove_tracks, removed_ids)
+            # Re-indexed so the similarity data carries the new file names
+            self.saved_track_ids.extend(manifest[old]["track_id"] for old, _ in diff.renamed)
+        await self._enqueue(work, [(path, False) for path in diff.added])
+        await self._run_in_executor(self.jobs.set_discovered, self.job_id)
 
-                # This is not perfectly thread-safe but okay for this use case
-                self.existing_files_in_db.append(file_path)
-                print(f"[OK] {file_path}")
+    @staticmethod
+    def _invalidate_snapshots():
+        """Called before a scan writes to the DB: snapshots of the similarity index are stale from then on."""
+        bump_library_generation()
+
+    async def _pending_items(self, work):
+        """Producer of a resumed job or a retry pass: its items still to do, a page at a time."""
+        after = ""
+        while page := await self._run_in_executor(self.jobs.items_page, self.job_id, after, SCAN_QUEUE_SIZE):
+            for path, changed in page:
+                await work.put(ScanItem(path, os.path.join(self.music_folder, path), changed))
+            after = page[-1][0]
+
+    async def _start_workers(self):
+        """
+        Starts the analysis workers and the DB writer, and gets the
+        classifier, when the first file needs them.
+        """
+        async with self._workers_lock:
+            if self._writer is not None:
+                return
+            if self.use_processes:
+                self._pool = create_process_pool()
+            else:
+                self.classifier = await self._run_in_executor(MODELS.acquire, "classifier")
+                if GENRE_BATCH_SIZE > 1:
+                    self._batcher = GenreBatcher(self.classifier, stats=self.stats)
+            self._invalidate_snapshots()
+            self._writer = ScanWriter(get_connection, stats=self.stats)
+
+    async def _decode(self, item):
+        """
+        Decode stage: tags, duplicate check and decoding (the whole
+        analysis in process mode). Returns the item for the next stage, or
+        None once the file is done with.
+        """
+        await self._pause_event.wait()
+        self.stats.record("wait", time.perf_counter() - item.started)
+        try:
+            with self.stats.gauge("analyzing"):
+                # Counted as an attempt before any work, so a file that keeps failing
+                # (or takes the server down) runs out of attempts
+                await self._run_in_executor(self.jobs.start_item, self.job_id, item.relative_path)
+                await self._start_workers()
+                item.stat = await self._run_in_executor(os.stat, item.file_path)
+
+                # Tags and artwork are read once here and reused for the duplicate check and the DB row
+                with self.stats.timed("tags"):
+                    item.tags = await self._run_in_executor(self._read_tags, item.file_path)
+                item.tokens = self._metadata_words(item.tags, item.file_path)
+                # A changed file keeps its track, it is not a duplicate of itself
+                if not item.changed and self._is_duplicate(item.file_path, item.tokens):
+                    await self._finish(item)
+                    return None
+
+                if self._pool is not None:
+                    loop = asyncio.get_running_loop()
+                    item.feats, item.genres, item.embedding, timings = await loop.run_in_executor(self._pool, analyze_file, item.file_path)
+                    self.stats.record_all(timings)
+                    if item.feats is None:
+                        raise AnalysisError("audio could not be analysed")
+                    return item
+
+                with self.stats.timed("decode"):
+                    decoded = await self._run_in_executor(decode_audio, item.file_path)
+                if decoded is None:
+                    raise AnalysisError("audio could not be decoded")
+                item.signal, item.clip = decoded
+                return item
+        except Exception as e:
+            await self._finish(item, e)
 
-            except Exception as e:
-                print(f"[ERROR] processing {file_path}: {e}")
-                traceback.print_exc()
-            finally:
-                self.processed_files += 1
-                self.current_filename = os.path.basename(file_path)
+    async def _analyze(self, item):
+        """Analyze stage (thread mode): audio features, genres and embedding of a decoded file."""
+        try:
+            with self.stats.gauge("analyzing"):
+                with self.stats.timed("features"):
+                    item.feats = await self._run_in_executor(extract_audio_features, item.signal, item.file_path)
+                if item.feats is None:
+                    raise AnalysisError("audio could not be analysed")
+                # Wall time per file, including the wait for a batch to fill
+                with self.stats.timed("genres"):
+                    if self._batcher is not None:
+                        item.genres, item.embedding = await self._batcher.classify(item.clip, item.file_path)
+                    else:
+                        item.genres, item.embedding = await self._run_in_executor(extract_genres, self.classifier, item.clip, item.file_path)
+            item.signal = item.clip = None
+            return item
+        except Exception as e:
+            await self._finish(item, e)
 
-    async def run(self):
+    async def _persist(self, item):
+        """Persist stage: hands the results to the batched DB writer, which marks the item done."""
+        try:
+            with self.stats.gauge("writing"):
+                track_id = await self._save_to_db(item)
+            self.saved_track_ids.append(track_id)
+            self.token_index.add(item.file_path, item.tokens)
+            print(f"[OK] {item.file_path}")
+            await self._finish(item, saved=True)
+        except Exception as e:
+            await self._finish(item, e)
+
+    async def _finish(self, item, error=None, saved=False):
+        """Bookkeeping of a file leaving the pipeline: job state (unless the writer did it) and stats."""
+        if isinstance(error, AnalysisError):
+            message = str(error)
+        elif error is not None:
+            print(f"[ERROR] processing {item.file_path}: {error}")
+            traceback.print_exception(type(error), error, error.__traceback__)
+            message = str(error) or type(error).__name__
+        else:
+            message = None
+        try:
+            if not saved:
+                await self._run_in_executor(self.jobs.finish_item, self.job_id, item.relative_path, message)
+        finally:
+            self.stats.record("file", time.perf_counter() - item.started)
+            self.stats.file_done()
+            self.processed_files += 1
+            self.current_filename = os.path.basename(item.file_path)
+
+    async def run(self, paths=None, allow_mass_removal=False):
+        """
+        Scans the whole music folder, or only `paths` (changed files and
+        directories, see LibraryWatcher). A job left unfinished by a
+        restart is resumed instead. `allow_mass_removal` lets the scan
+        delete more than SCAN_MAX_REMOVE_RATIO of the library.
+        """
         if self.status == "running": return
-        self._reset_state()
+        self._reset_state(keep_tokens=paths is not None)
         self.status = "running"
         
         try:
-            self._discover_files()
-            self._get_existing_files_from_db()
-
-            # Pre-filter files to avoid redundant checks in parallel tasks
-            files_to_process = [fp for fp in self.files_to_scan if fp not in self.existing_files_in_db]
-            self.total_files = len(files_to_process) # Update total to reflect only new files
-            self.processed_files = 0
-
+            if self.token_index is None:
+                await self._run_in_executor(self._get_existing_files_from_db)
+
+            job = await self._run_in_executor(self.jobs.unfinished)
+            if job is None:
+                self.job_id = await self._run_in_executor(self.jobs.create)
+                await self._run_pipeline(lambda work: self._discover(work, paths, allow_mass_removal))
+            else:
+                self.job_id = job["id"]
+                left = await self._run_in_executor(self.jobs.requeue_interrupted, self.job_id)
+                if job["status"] == "paused":
+                    await self.pause()
+                if job["discovered"]:
+                    print(f"Resuming scan job {self.job_id}: {left} files left")
+                    self.total_files = left
+                    await self._run_pipeline(self._pending_items)
+                else:
+                    # Stopped during the walk: the files it had not reached are only found by walking
+                    # again. Recorded items are found again too (add_items ignores them), and the
+                    # retry passes below pick up any that are not.
+                    print(f"Resuming scan job {self.job_id}: {left} files recorded, walking the library again")
+                    await self._run_pipeline(lambda work: self._discover(work))
+
+            # Failed files with attempts left
+            while retries := await self._run_in_executor(self.jobs.count_to_run, self.job_id):
+                print(f"Retrying {retries} failed files...")
+                self.total_files += retries
+                await self._run_pipeline(self._pending_items)
+            self._queues = {}
+
+            self._shutdown_workers()
+            await self._set_job_status(self.job_id, "finished")
+            _, counts = await self._run_in_executor(self.jobs.progress, self.job_id)
+            print("[SCAN SUMMARY] " + json.dumps(self.stats.summary(
+                job_id=self.job_id, saved=len(self.saved_track_ids), failed=counts.get("failed", 0),
+                executor="process" if self.use_processes else "thread", concurrency=self.concurrency)))
 
-            tasks = [self._process_file(file_path) for file_path in files_to_process]
-            await asyncio.gather(*tasks)
-
-            self.status = "finished"
             self.current_filename = ""
-            print("Scan finished. Re-computing data for similarity search...")
-            await self._run_in_executor(precompute_data)
-            print("Re-computing finished.")
+            print(f"Scan finished. Adding {len(self.saved_track_ids)} tracks to the similarity data...")
+            await self._run_in_executor(add_tracks, self.saved_track_ids)
+            print("Similarity data updated.")
+            # Needs the whole library, so not after a scan of some paths. Done before the
+            # status flips, which lets watch-mode runs (and their new covers) start
+            if paths is None:
+                try:
+                    await self._run_in_executor(self._tidy_covers)
+                except Exception as e:
+                    print(f"[COVER ERROR] {e}")
+            self.status = "finished"
 
         except asyncio.CancelledError:
+            # The job stays unfinished: a cancel through the API marks it cancelled in cancel(),
+            # a server shutdown leaves it to be resumed
+            self._shutdown_workers()
             self._reset_state()
             print("Scan was cancelled.")
             raise
         except Exception as e:
+            if self.job_id is not None:
+                try:
+                    await self._set_job_status(self.job_id, "failed")
+                except Exception as db_error:
+                    print(f"[DB ERROR] could not mark scan job {self.job_id} failed: {db_error}")
+            self._shutdown_workers()
             self._reset_state()
-            print(f"[ERROR] Unhandled exception in scanner: {e}")
-            traceback.print_exc()
+            if isinstance(e, LibraryUnavailable):
+                print(f"[ERROR] Scan aborted: {e}")
+            else:
+                print(f"[ERROR] Unhandled exception in scanner: {e}")
+                traceback.print_exc()
 
-    def pause(self):
+    def _shutdown_workers(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._batcher is not None:
+            self._batcher.close()
+            self._batcher = None
+        if self._pool is not None:
+            # Workers hold a model each, free them as soon as the scan is over
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+        if self.classifier is not None:
+            MODELS.release("classifier")
+            self.classifier = None
+
+    async def _set_job_status(self, job_id, status):
+        async with self._status_lock:
+            await self._run_in_executor(self.jobs.set_status, job_id, status)
+
+    async def pause(self):
         if self.status == "running":
             self.status = "paused"
             self._pause_event.clear()
+            if self.job_id is not None:
+                await self._set_job_status(self.job_id, "paused")
 
-    def resume(self):
+    async def resume(self):
         if self.status == "paused":
             self.status = "running"
             self._pause_event.set()
+            if self.job_id is not None:
+                await self._set_job_status(self.job_id, "running")
 
-    def cancel(self):
+    async def cancel(self):
+        job_id = self.job_id
+        self._shutdown_workers()
         self._reset_state()
-
-    def _get_metadata_info(self, file_path):
-        try:
-            audio = MutagenFile(file_path, easy=True)
-            if audio:
-                title = audio.get("title", [""])[0]
-                artist = audio.get("artist", [""])[0]
-                combined = f"{artist} {title}".lower()
-                combined = re.sub(r'[^a-z0-9\s]', ' ', combined)
-                return {w for w in combined.split() if len(w) > 2}
-        except Exception: pass
-        name = os.path.splitext(os.path.basename(file_path).lower())[0]
-        name = re.sub(r'[^a-z0-9\s]', ' ', name)
-        return {word for word in name.split() if len(word) > 2}
-
-    def _is_duplicate(self, new_file_path, word_threshold=4):
-        new_words = self._get_metadata_info(new_file_path)
-        for existing_file in self.existing_files_in_db:
-            existing_words = self._get_metadata_info(existing_file)
-            if len(new_words.intersection(existing_words)) >= word_threshold:
-                print(f"[DUPLICATE] {new_file_path} == {existing_file}")
-                return True
-        return False
-
-    def _extract_genres(self, file_path, topn=50):
-        try:
-            result = self.classifier(file_path)
-            if not result:
-                print(f"[WARNING] Classifier returned empty result for {file_path}.")
-                return []
-            return [r for r in sorted(result, key=lambda x: x['score'], reverse=True) if r['label'].lower() != "music"][:topn]
-        except Exception as e:
-            print(f"[ERROR] Classifier failed for {file_path}: {e}")
-            return []
-
-    def _extract_audio_features(self, file_path):
-        try:
-            y, sr = librosa.load(file_path, sr=8000, mono=True, duration=30.0, offset=20.0)
-            if y.size == 0:
-                print(f"[WARNING] Loaded empty audio signal from {file_path}. Skipping.")
-                return None
-        except Exception as e:
-            print(f"[ERROR] librosa.load failed for {file_path}: {e}")
-            return None
-
-        onset_env = librosa.onset.onset_strength(y=y, sr=sr)
-        keys = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
-        mfcc = librosa.feature.mfcc(y=y, sr=sr, n_mfcc=13)
-        
-        features = {
-            "bpm": float(librosa.beat.tempo(onset_envelope=onset_env, sr=sr)[0]),
-            "key": keys[librosa.feature.chroma_stft(y=y, sr=sr).mean(axis=1).argmax()],
-            "rms_energy": float(librosa.feature.rms(y=y).mean()),
-            "spectral_centroid": float(librosa.feature.spectral_centroid(y=y, sr=sr).mean()),
-            "spectral_bandwidth": float(librosa.feature.spectral_bandwidth(y=y, sr=sr).mean()),
-            "spectral_rolloff": float(librosa.feature.spectral_rolloff(y=y, sr=sr).mean()),
-            "zero_crossing_rate": float(librosa.feature.zero_crossing_rate(y).mean()),
-            "mfcc1": float(mfcc[0].mean()), "mfcc2": float(mfcc[1].mean()), "mfcc3": float(mfcc[2].mean()),
-        }
-
-        for key, value in features.items():
-            if isinstance(value, (int, float)) and not np.isfinite(value):
-                print(f"[WARNING] Non-finite value for feature '{key}' in file {file_path}. Skipping file.")
-                return None
-
-        return features
-
-    def _get_title_artist(self, file_path):
-        try:
-            audio = MutagenFile(file_path, easy=True)
-            if audio: return audio.get("title", [""])[0].strip(), audio.get("artist", [""])[0].strip()
-        except Exception: pass
-        return os.path.splitext(os.path.basename(file_path))[0], ""
-    
-    def _extract_and_save_cover(self, file_path, track_id):
+        if job_id is not None:
+            await self._set_job_status(job_id, "cancelled")
+
+    def forget_library(self):
+        """Drops what the scanner keeps about the library, after it was cleared."""
+        self.token_index = None
+
+    def _read_tags(self, file_path):
+        """
+        Title, artist and cover art of a file from a single mutagen open.
+        "tagged" is False when mutagen cannot read the file; the title then
+        falls back to the file name.
+        """
+        tags = {"tagged": False, "title": os.path.splitext(os.path.basename(file_path))[0], "artist": "", "cover": None}
         try:
-            os.makedirs(self.covers_folder, exist_ok=True)
             audio = MutagenFile(file_path)
-            if not audio: return
-
-            cover_data, ext = None, None
+        except Exception:
+            return tags
+        if not audio:
+            return tags
+
+        tags["tagged"] = True
+        tags["title"] = _tag_text(audio, "TIT2", "title", "\xa9nam")
+        tags["artist"] = _tag_text(audio, "TPE1", "artist", "\xa9ART")
+        try:
             if apic_tags := [tag for tag in audio.keys() if tag.startswith("APIC")]:
                 apic = audio[apic_tags[0]]
-                cover_data, ext = apic.data, apic.mime.split("/")[-1]
+                tags["cover"] = (apic.data, apic.mime.split("/")[-1])
             elif hasattr(audio, "pictures") and audio.pictures:
                 pic = audio.pictures[0]
-                cover_data, ext = pic.data, pic.mime.split('/')[-1]
-            
-            if cover_data:
-                ext = "jpg" if ext == "jpeg" else ext
-                with open(os.path.join(self.covers_folder, f"{track_id}.{ext}"), "wb") as f:
-                    f.write(cover_data)
+                tags["cover"] = (pic.data, pic.mime.split('/')[-1])
         except Exception as e:
             print(f"[COVER ERROR] {file_path}: {e}")
+        return tags
+
+    @staticmethod
+    def _metadata_words(tags, file_path):
+        if tags["tagged"]:
+            combined = f"{tags['artist']} {tags['title']}".lower()
+        else:
+            combined = os.path.splitext(os.path.basename(file_path).lower())[0]
+        # Letters of any script count, so Cyrillic titles give tokens too
+        combined = re.sub(r'[\W_]', ' ', combined)
+        return {w for w in combined.split() if 2 < len(w) <= MAX_TOKEN_LENGTH}
+
+    def _is_duplicate(self, new_file_path, tokens, word_threshold=4):
+        existing_file = self.token_index.find_duplicate(tokens, word_threshold)
+        if existing_file is not None:
+            print(f"[DUPLICATE] {new_file_path} == {existing_file}")
+            return True
+        return False
 
-    async def _save_to_db(self, file_path, feats, genres):
-        await self._run_in_executor(self._blocking_save_to_db, file_path, feats, genres)
+    @staticmethod
+    def _store_tokens(cursor, track_id, tokens):
+        cursor.execute("DELETE FROM track_tokens WHERE track_id=%s", (track_id,))
+        cursor.executemany("INSERT IGNORE INTO track_tokens (track_id, token) VALUES (%s,%s)",
+                           [(track_id, token) for token in stored_tokens(tokens)])
 
-    def _blocking_save_to_db(self, file_path, feats, genres):
+    @staticmethod
+    def _save_cover(file_path, cover):
+        """Hash of the file's cover art in the cover store, None without (usable) art."""
+        if not cover:
+            return None
+        try:
+            return store_cover(cover[0])
+        except Exception as e:
+            print(f"[COVER ERROR] {file_path}: {e}")
+            return None
+
+    @staticmethod
+    def _tidy_covers():
+        """
+        Moves covers stored per track by earlier versions into the cover
+        store, and deletes stored images no track uses any more.
+        """
+        t0 = time.perf_counter()
+        started = time.time()
+        legacy, tracks = legacy_covers(), set()
         with get_connection() as conn:
             with conn.cursor() as cur:
-                title, artist = self._get_title_artist(file_path)
-                primary_genre = genres[0]["label"] if genres else None
-                relative_path = os.path.relpath(file_path, self.music_folder).replace('\\', '/')
-
-                sql = """INSERT INTO features (file, title, artist, primary_genre, bpm, `key`, rms_energy,
-                             spectral_centroid, spectral_bandwidth, spectral_rolloff, zero_crossing_rate,
-                             mfcc1, mfcc2, mfcc3)
-                           VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
-                           ON DUPLICATE KEY UPDATE title=VALUES(title), artist=VALUES(artist), 
-                             primary_genre=VALUES(primary_genre), bpm=VALUES(bpm), `key`=VALUES(`key`),
-                             rms_energy=VALUES(rms_energy), spectral_centroid=VALUES(spectral_centroid),
-                             spectral_bandwidth=VALUES(spectral_bandwidth), spectral_rolloff=VALUES(spectral_rolloff),
-                             zero_crossing_rate=VALUES(zero_crossing_rate), mfcc1=VALUES(mfcc1),
-                             mfcc2=VALUES(mfcc2), mfcc3=VALUES(mfcc3)"""
-                params = (relative_path, title, artist, primary_genre, feats["bpm"], feats["key"], feats["rms_energy"],
-                          feats["spectral_centroid"], feats["spectral_bandwidth"], feats["spectral_rolloff"],
-                          feats["zero_crossing_rate"], feats["mfcc1"], feats["mfcc2"], feats["mfcc3"])
-                cur.execute(sql, params)
-
-
-                cur.execute("SELECT id FROM features WHERE file=%s", (relative_path,))
-                if not (row := cur.fetchone()):
-                    print(f"[DB ERROR] Track not found after insert: {relative_path}")
-                    return
-
-                track_id = row["id"]
-                self._extract_and_save_cover(file_path, track_id)
-
-                cur.execute("DELETE FROM genres WHERE track_id=%s", (track_id,))
-                if genres:
-                    genre_data = [(track_id, g["label"], g["score"]) for g in genres]
-                    cur.executemany("INSERT INTO genres (track_id, label, score) VALUES (%s,%s,%s)", genre_data)
-
+                cur.execute("SELECT track_id, hash FROM track_covers")
+                covers = {row["track_id"]: row["hash"] for row in cur.fetchall()}
+                if legacy:
+                    ids = list(legacy)
+                    cur.execute(f"SELECT id FROM features WHERE id IN ({','.join(['%s'] * len(ids))})", ids)
+                    tracks = {row["id"] for row in cur.fetchall()}
+                    migrated = []
+                    for track_id, path in legacy.items():
+                        if track_id in tracks and track_id not in covers:
+                            try:
+                                with open(path, "rb") as f:
+                                    covers[track_id] = store_cover(f.read())
+                                migrated.append((track_id, covers[track_id]))
+                            except Exception as e:
+                                print(f"[COVER ERROR] {path}: {e}")
+                    if migrated:
+                        cur.executemany("INSERT INTO track_covers (track_id, hash) VALUES (%s,%s)", migrated)
+                        print(f"Перенесено обложек в хранилище: {len(migrated)}")
+            conn.commit()
+        # Only once the rows that point at them are committed
+        for track_id in legacy:
+            if track_id in covers or track_id not in tracks:
+                remove_legacy_cover(track_id)
+        removed = prune_covers(set(covers.values()), started)
+        if removed:
+            print(f"Удалено неиспользуемых обложек: {removed}")
+        print(f"[TIMER] обложки: {time.perf_counter() - t0:.3f} сек")
+
+    async def _save_to_db(self, item):
+        tags = item.tags
+        file_hash = await self._run_in_executor(self._hash_of, item.relative_path)
+        with self.stats.timed("cover"):
+            cover_hash = await self._run_in_executor(self._save_cover, item.file_path, tags["cover"])
+        # Includes the wait for the batch to fill and commit
+        with self.stats.timed("db_write"):
+            track_id = await self._writer.save({
+                "job_id": self.job_id, "file": item.relative_path, "title": tags["title"], "artist": tags["artist"],
+                "feats": item.feats, "genres": item.genres, "embedding": item.embedding, "tokens": item.tokens,
+                "size": item.stat.st_size, "mtime_ns": item.stat.st_mtime_ns, "hash": file_hash,
+                "cover_hash": cover_hash,
+            })
+        # The hash is in the manifest now, keep the cache to files still in flight
+        self._hashes.pop(item.relative_path, None)
+        return track_id
 
     @staticmethod
     def clear_db():
         with get_connection() as conn:
             with conn.cursor() as cursor:
                 cursor.execute("SET FOREIGN_KEY_CHECKS=0;")
-                for table in ["playlist_tracks", "playlists", "listening_history", "genres", "features"]:
+                for table in ["playlist_tracks", "playlists", "listening_history", "track_tokens", "track_embeddings",
+                              "track_covers", "file_manifest", "scan_items", "scan_jobs", "genres", "features"]:
                     cursor.execute(f"TRUNCATE TABLE {table};")
                 cursor.execute("SET FOREIGN_KEY_CHECKS=1;")
             conn.commit()
@@ -311,6 +872,10 @@ class Scanner:
         if os.path.isdir(covers_dir):
             for f in os.listdir(covers_dir):
                 try:
-                    os.remove(os.path.join(covers_dir, f))
+                    path = os.path.join(covers_dir, f)
+                    if os.path.isdir(path):
+                        shutil.rmtree(path)
+                    else:
+                        os.remove(path)
                 except OSError as e:
                     print(f"Error removing file {f}: {e}")
\ No newline at end of file
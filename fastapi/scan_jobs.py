@@ -0,0 +1,134 @@
+import os
+import time
+
+# A file is retried until it has been attempted this many times; a file
+# that was being analysed when the server went down counts as an attempt
+SCAN_MAX_ATTEMPTS = int(os.getenv("SCAN_MAX_ATTEMPTS", 3))
+
+UNFINISHED = ("running", "paused")
+
+
+def _placeholders(values):
+    return ",".join(["%s"] * len(values))
+
+
+class ScanJobs:
+    """
+    Durable scan jobs (scan_jobs) and their per-file work items
+    (scan_items), so a scan survives a server restart.
+
+    Items go pending -> running -> done | failed. The ScanWriter marks an
+    item done in the same transaction that stores its track.
+    """
+
+    def __init__(self, connect, max_attempts=SCAN_MAX_ATTEMPTS):
+        self.connect = connect
+        self.max_attempts = max_attempts
+
+    def unfinished(self):
+        with self.connect() as conn:
+            with conn.cursor() as cur:
+                cur.execute(f"SELECT * FROM scan_jobs WHERE status IN ({_placeholders(UNFINISHED)}) "
+                            "ORDER BY id DESC LIMIT 1", UNFINISHED)
+                return cur.fetchone()
+
+    def create(self):
+        """New running job without items; items of older jobs are dropped."""
+        with self.connect() as conn:
+            with conn.cursor() as cur:
+                cur.execute("INSERT INTO scan_jobs (status, created_at) VALUES ('running', %s)", (int(time.time()),))
+                job_id = cur.lastrowid
+                cur.execute("DELETE FROM scan_items WHERE job_id <> %s", (job_id,))
+        return job_id
+
+    def add_items(self, job_id, items):
+        """
+        Records [(relative path, changed)] as pending work of the job. Items
+        the job already has are left as they are. Returns the set of paths
+        still to do: new items, pending ones and failed ones with attempts
+        left, but not those done or out of attempts.
+        """
+        paths = [path for path, _ in items]
+        with self.connect() as conn:
+            with conn.cursor() as cur:
+                cur.executemany("INSERT IGNORE INTO scan_items (job_id, file, changed) VALUES (%s,%s,%s)",
+                                [(job_id, path, int(changed)) for path, changed in items])
+                cur.execute(f"""SELECT file FROM scan_items
+                                WHERE job_id = %s AND file IN ({_placeholders(paths)})
+                                  AND (state = 'pending' OR (state = 'failed' AND attempts < %s))""",
+                            (job_id, *paths, self.max_attempts))
+                return {row["file"] for row in cur.fetchall()}
+
+    def requeue_interrupted(self, job_id):
+        """
+        Items left running by a crash go back to pending, or to failed once
+        they are out of attempts. Returns the number of items still to do.
+        """
+        with self.connect() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""UPDATE scan_items
+                               SET state = IF(attempts >= %s, 'failed', 'pending'),
+                                   error = IF(attempts >= %s, 'interrupted', error)
+                               WHERE job_id = %s AND state = 'running'""",
+                            (self.max_attempts, self.max_attempts, job_id))
+        return self.count_to_run(job_id)
+
+    def count_to_run(self, job_id):
+        with self.connect() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""SELECT COUNT(*) AS n FROM scan_items
+                               WHERE job_id = %s AND (state = 'pending' OR (state = 'failed' AND attempts < %s))""",
+                            (job_id, self.max_attempts))
+                return cur.fetchone()["n"]
+
+    def items_page(self, job_id, after="", limit=500):
+        """
+        Next `limit` items still to do after the path `after`, as
+        [(relative path, changed)]: pending items and failed ones with
+        attempts left. Paging by path keeps memory flat for any job size.
+        """
+        with self.connect() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""SELECT file, changed FROM scan_items
+                               WHERE job_id = %s AND file > %s
+                                 AND (state = 'pending' OR (state = 'failed' AND attempts < %s))
+                               ORDER BY file LIMIT %s""", (job_id, after, self.max_attempts, limit))
+                return [(row["file"], bool(row["changed"])) for row in cur.fetchall()]
+
+    def start_item(self, job_id, path):
+        with self.connect() as conn:
+            with conn.cursor() as cur:
+                cur.execute("UPDATE scan_items SET state='running', attempts=attempts+1 WHERE job_id=%s AND file=%s",
+                            (job_id, path))
+
+    def finish_item(self, job_id, path, error=None):
+        with self.connect() as conn:
+            with conn.cursor() as cur:
+                cur.execute("UPDATE scan_items SET state=%s, error=%s WHERE job_id=%s AND file=%s",
+                            ("failed" if error else "done", error, job_id, path))
+
+    def set_discovered(self, job_id):
+        """Every file of the job has been recorded as an item."""
+        with self.connect() as conn:
+            with conn.cursor() as cur:
+                cur.execute("UPDATE scan_jobs SET discovered=1 WHERE id=%s", (job_id,))
+
+    def set_status(self, job_id, status):
+        with self.connect() as conn:
+            with conn.cursor() as cur:
+                cur.execute("UPDATE scan_jobs SET status=%s, finished_at=%s WHERE id=%s",
+                            (status, None if status in UNFINISHED else int(time.time()), job_id))
+
+    def progress(self, job_id=None):
+        """(job row, {state: count}) of the given job or the latest one; (None, {}) if there is none."""
+        with self.connect() as conn:
+            with conn.cursor() as cur:
+                if job_id is None:
+                    cur.execute("SELECT * FROM scan_jobs ORDER BY id DESC LIMIT 1")
+                else:
+                    cur.execute("SELECT * FROM scan_jobs WHERE id=%s", (job_id,))
+                job = cur.fetchone()
+                if job is None:
+                    return None, {}
+                cur.execute("SELECT state, COUNT(*) AS n FROM scan_items WHERE job_id=%s GROUP BY state", (job["id"],))
+                return job, {row["state"]: row["n"] for row in cur.fetchall()}
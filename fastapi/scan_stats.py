@@ -0,0 +1,138 @@
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+
+# Upper bounds of the timing histogram buckets, in milliseconds
+HISTOGRAM_BOUNDS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+# Files/sec is measured over the files finished in the last SCAN_RATE_WINDOW seconds
+SCAN_RATE_WINDOW = float(os.getenv("SCAN_RATE_WINDOW", 60))
+
+
+class StageHistogram:
+    """Fixed-bucket timing histogram, constant memory however many files are scanned."""
+
+    def __init__(self):
+        self.buckets = [0] * (len(HISTOGRAM_BOUNDS_MS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        ms = seconds * 1000
+        self.buckets[bisect_left(HISTOGRAM_BOUNDS_MS, ms)] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def percentile(self, q):
+        """Upper bound of the bucket holding the q-th percentile (the maximum for the last bucket)."""
+        rank = q / 100 * self.count
+        seen = 0
+        for bound, n in zip(HISTOGRAM_BOUNDS_MS, self.buckets):
+            seen += n
+            if n and seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "mean_ms": round(self.total / self.count, 1) if self.count else 0.0,
+            "p50_ms": round(self.percentile(50), 1),
+            "p95_ms": round(self.percentile(95), 1),
+            "max_ms": round(self.max, 1),
+            "total_sec": round(self.total / 1000, 3),
+            "histogram": {**{f"<={bound}ms": n for bound, n in zip(HISTOGRAM_BOUNDS_MS, self.buckets)},
+                          f">{HISTOGRAM_BOUNDS_MS[-1]}ms": self.buckets[-1]},
+        }
+
+
+class ScanStats:
+    """
+    Timings of one scan: a histogram per stage (wall time per file, or per
+    batch for the *_batch stages), gauges of files in each step, and the
+    rolling files/sec the ETA is based on. record() is thread-safe, stages
+    are timed in executor threads and worker processes too.
+    """
+
+    def __init__(self, rate_window=SCAN_RATE_WINDOW):
+        self.rate_window = rate_window
+        self.started = time.monotonic()
+        self.stages = {}
+        self.gauges = {}
+        self.files = 0
+        self._finished = deque()
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        with self._lock:
+            self.stages.setdefault(stage, StageHistogram()).add(seconds)
+
+    def record_all(self, timings):
+        for stage, seconds in timings.items():
+            self.record(stage, seconds)
+
+    @contextmanager
+    def timed(self, stage):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - t0)
+
+    @contextmanager
+    def gauge(self, name):
+        """Counts the files inside the block under `name` while they are in it."""
+        self.gauges[name] = self.gauges.get(name, 0) + 1
+        try:
+            yield
+        finally:
+            self.gauges[name] -= 1
+
+    def file_done(self):
+        now = time.monotonic()
+        with self._lock:
+            self.files += 1
+            self._finished.append(now)
+            while self._finished and now - self._finished[0] > self.rate_window:
+                self._finished.popleft()
+
+    def files_per_sec(self):
+        now = time.monotonic()
+        with self._lock:
+            recent = sum(1 for t in self._finished if now - t <= self.rate_window)
+        window = min(self.rate_window, now - self.started)
+        return recent / window if window > 0 else 0.0
+
+    def snapshot(self, remaining, queues=None):
+        rate = self.files_per_sec()
+        if not remaining:
+            eta = 0.0
+        else:
+            eta = round(remaining / rate, 1) if rate > 0 else None
+        with self._lock:
+            stages = {stage: histogram.to_dict() for stage, histogram in self.stages.items()}
+        return {
+            "elapsed_sec": round(time.monotonic() - self.started, 1),
+            "files_per_sec": round(rate, 3),
+            "eta_sec": eta,
+            "queues": {**self.gauges, **(queues or {})},
+            "stages": stages,
+        }
+
+    def summary(self, **extra):
+        """Whole-run numbers for the log line written when a scan finishes."""
+        elapsed = time.monotonic() - self.started
+        with self._lock:
+            stages = {stage: {key: value for key, value in histogram.to_dict().items() if key != "histogram"}
+                      for stage, histogram in self.stages.items()}
+        return {
+            **extra,
+            "files": self.files,
+            "elapsed_sec": round(elapsed, 1),
+            "files_per_sec": round(self.files / elapsed, 3) if elapsed > 0 else 0.0,
+            "stages": stages,
+        }
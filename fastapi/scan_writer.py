@@ -0,0 +1,169 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from duplicate_index import stored_tokens
+from pipeline import run_batches
+from similarity_index import EMBEDDING_DTYPE
+
+# Scan results are written in transactions of up to DB_WRITE_BATCH tracks,
+# waiting at most DB_FLUSH_INTERVAL seconds for a batch to fill
+DB_WRITE_BATCH = int(os.getenv("DB_WRITE_BATCH", 64))
+DB_FLUSH_INTERVAL = float(os.getenv("DB_FLUSH_INTERVAL", 0.5))
+
+FEATURE_COLUMNS = ("bpm", "key", "rms_energy", "spectral_centroid", "spectral_bandwidth", "spectral_rolloff",
+                   "zero_crossing_rate", "mfcc1", "mfcc2", "mfcc3")
+
+# pymysql turns executemany() of these into multi-row INSERTs
+UPSERT_FEATURES = """INSERT INTO features (file, title, artist, primary_genre, bpm, `key`, rms_energy,
+                         spectral_centroid, spectral_bandwidth, spectral_rolloff, zero_crossing_rate,
+                         mfcc1, mfcc2, mfcc3)
+                     VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
+                     ON DUPLICATE KEY UPDATE title=VALUES(title), artist=VALUES(artist),
+                       primary_genre=VALUES(primary_genre), bpm=VALUES(bpm), `key`=VALUES(`key`),
+                       rms_energy=VALUES(rms_energy), spectral_centroid=VALUES(spectral_centroid),
+                       spectral_bandwidth=VALUES(spectral_bandwidth), spectral_rolloff=VALUES(spectral_rolloff),
+                       zero_crossing_rate=VALUES(zero_crossing_rate), mfcc1=VALUES(mfcc1),
+                       mfcc2=VALUES(mfcc2), mfcc3=VALUES(mfcc3)"""
+INSERT_GENRES = "INSERT INTO genres (track_id, label, score) VALUES (%s,%s,%s)"
+INSERT_TOKENS = "INSERT IGNORE INTO track_tokens (track_id, token) VALUES (%s,%s)"
+INSERT_EMBEDDINGS = "INSERT INTO track_embeddings (track_id, vector) VALUES (%s,%s)"
+INSERT_COVERS = "INSERT INTO track_covers (track_id, hash) VALUES (%s,%s)"
+UPSERT_MANIFEST = """INSERT INTO file_manifest (file, track_id, size, mtime_ns, hash) VALUES (%s,%s,%s,%s,%s)
+                     ON DUPLICATE KEY UPDATE track_id=VALUES(track_id), size=VALUES(size),
+                       mtime_ns=VALUES(mtime_ns), hash=VALUES(hash)"""
+
+
+def _placeholders(values):
+    return ",".join(["%s"] * len(values))
+
+
+class ScanWriter:
+    """
+    Single writer stage for scan results.
+
+    save() queues a record and resolves to its track id once it is
+    committed. A consumer task takes up to `batch_size` queued records,
+    waiting at most `flush_interval` seconds after the first one, and
+    writes them in one transaction on one reused connection: a multi-row
+    upsert of the features, a single SELECT for all their ids (MySQL has
+    no RETURNING and lastrowid is not reliable for upserts), then
+    multi-row inserts of genres, tokens, embeddings, covers and manifest
+    rows. The scan items of the batch are marked done in the same
+    transaction.
+
+    A record is a dict with file (relative path), title, artist, feats,
+    genres, tokens, size, mtime_ns, hash and optionally job_id, embedding
+    (a vector stored as an EMBEDDING_DTYPE blob) and cover_hash (the
+    track's image in cover_store).
+    """
+
+    def __init__(self, connect, batch_size=DB_WRITE_BATCH, flush_interval=DB_FLUSH_INTERVAL, stats=None):
+        self.connect = connect
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.stats = stats
+        self._queue = asyncio.Queue()
+        self._consumer = None
+        # One thread owns the connection, pymysql connections are not thread-safe
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._conn = None
+
+    async def save(self, record):
+        if self._consumer is None:
+            self._consumer = asyncio.create_task(self._consume())
+        result = asyncio.get_running_loop().create_future()
+        await self._queue.put((record, result))
+        return await result
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def close(self):
+        if self._consumer is not None:
+            self._consumer.cancel()
+            self._consumer = None
+        # Runs after a batch that may still be in flight
+        self._executor.submit(self._disconnect)
+        self._executor.shutdown(wait=False)
+
+    async def _consume(self):
+        await run_batches(self._queue, self._write, self.batch_size, self.flush_interval, self._executor)
+
+    def _write(self, records):
+        """Track ids of the records, or the exception a record failed with."""
+        t0 = time.perf_counter()
+        if self._conn is None:
+            self._conn = self.connect()
+        else:
+            self._conn.ping(reconnect=True)
+        try:
+            results = self._write_batch(records)
+        except Exception as e:
+            self._conn.rollback()
+            if len(records) == 1:
+                return [e]
+            # Keep the good records of a batch with a bad one
+            print(f"[DB ERROR] batch of {len(records)} tracks failed ({e}), writing them one by one")
+            results = []
+            for record in records:
+                try:
+                    results.extend(self._write_batch([record]))
+                except Exception as e:
+                    self._conn.rollback()
+                    results.append(e)
+        elapsed = time.perf_counter() - t0
+        if self.stats is not None:
+            self.stats.record("db_batch", elapsed)
+        print(f"[TIMER] запись пачки из {len(records)} треков: {elapsed:.3f} сек")
+        return results
+
+    def _write_batch(self, records):
+        self._conn.begin()
+        with self._conn.cursor() as cur:
+            cur.executemany(UPSERT_FEATURES, [
+                (r["file"], r["title"], r["artist"], r["genres"][0]["label"] if r["genres"] else None,
+                 *(r["feats"][column] for column in FEATURE_COLUMNS))
+                for r in records
+            ])
+            files = [r["file"] for r in records]
+            cur.execute(f"SELECT id, file FROM features WHERE file IN ({_placeholders(files)})", files)
+            ids = {row["file"]: row["id"] for row in cur.fetchall()}
+            missing = [f for f in files if f not in ids]
+            if missing:
+                raise LookupError(f"Track not found after insert: {missing[0]}")
+            track_ids = [ids[f] for f in files]
+
+            cur.execute(f"DELETE FROM genres WHERE track_id IN ({_placeholders(track_ids)})", track_ids)
+            cur.execute(f"DELETE FROM track_tokens WHERE track_id IN ({_placeholders(track_ids)})", track_ids)
+            cur.execute(f"DELETE FROM track_embeddings WHERE track_id IN ({_placeholders(track_ids)})", track_ids)
+            cur.execute(f"DELETE FROM track_covers WHERE track_id IN ({_placeholders(track_ids)})", track_ids)
+            genre_rows = [(track_id, g["label"], g["score"]) for track_id, r in zip(track_ids, records) for g in r["genres"]]
+            if genre_rows:
+                cur.executemany(INSERT_GENRES, genre_rows)
+            cur.executemany(INSERT_TOKENS, [(track_id, token) for track_id, r in zip(track_ids, records)
+                                            for token in stored_tokens(r["tokens"])])
+            embedding_rows = [(track_id, r["embedding"].astype(EMBEDDING_DTYPE).tobytes())
+                              for track_id, r in zip(track_ids, records) if r.get("embedding") is not None]
+            if embedding_rows:
+                cur.executemany(INSERT_EMBEDDINGS, embedding_rows)
+            cover_rows = [(track_id, r["cover_hash"]) for track_id, r in zip(track_ids, records) if r.get("cover_hash")]
+            if cover_rows:
+                cur.executemany(INSERT_COVERS, cover_rows)
+            cur.executemany(UPSERT_MANIFEST, [(r["file"], track_id, r["size"], r["mtime_ns"], r["hash"])
+                                              for track_id, r in zip(track_ids, records)])
+            for job_id in {r["job_id"] for r in records if r.get("job_id") is not None}:
+                job_files = [r["file"] for r in records if r.get("job_id") == job_id]
+                cur.execute(f"UPDATE scan_items SET state='done', error=NULL WHERE job_id=%s AND file IN ({_placeholders(job_files)})",
+                            [job_id, *job_files])
+        self._conn.commit()
+        return track_ids
+
+    def _disconnect(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+            self._conn = None
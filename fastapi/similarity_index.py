@@ -0,0 +1,830 @@
+import json
+import os
+import threading
+import time
+import traceback
+import numpy as np
+from scipy import sparse
+
+from ann_index import ANN_STORAGE, AnnIndex, choose_index_kind
+
+FEATURE_WEIGHTS = np.array([2.0, 1.0, 0.5, 0.5, 0.5, 0.5, 1.0, 1.0, 1.0])
+GENRE_WEIGHT = 40.0
+N_FEATURES = len(FEATURE_WEIGHTS)
+# Keep only the K best genre scores of each track (0 keeps all the scanner stored)
+GENRE_TOP_K = int(os.getenv("GENRE_TOP_K", 0))
+
+# Incremental updates keep the normalisation mean/std until they drift by more
+# than this (in units of the current std) from the stats of the live library
+NORM_DRIFT_THRESHOLD = float(os.getenv("NORM_DRIFT_THRESHOLD", 0.05))
+# Deleted rows are only masked out; arrays are compacted once this share is dead
+COMPACT_DEAD_RATIO = 0.2
+
+# Minimum recall@k vs the exact engine for "auto" to trust the ANN index
+ANN_MIN_RECALL = float(os.getenv("ANN_MIN_RECALL", 0.9))
+ANN_RECALL_SAMPLE = int(os.getenv("ANN_RECALL_SAMPLE", 50))
+# Compressed ANN indexes return this many times k candidates, re-ranked exactly
+ANN_RERANK_FACTOR = int(os.getenv("ANN_RERANK_FACTOR", 4))
+
+METRICS = ("cosine", "euclidean")
+# "features": audio features + genre scores, "embedding": pooled AST embeddings
+SPACES = ("features", "embedding")
+# How track embeddings are stored in the DB (track_embeddings.vector); they
+# stay float16 in memory too and are upcast this many rows at a time to search
+EMBEDDING_DTYPE = "<f2"
+EMBEDDING_CHUNK_ROWS = 8192
+# Upper bound on the seeds x tracks distance matrix search_many holds at once
+SEARCH_MANY_MAX_CELLS = 2 ** 25
+
+# Bump when the on-disk layout written by SimilarityIndex.save changes
+SNAPSHOT_VERSION = 4
+
+# Index dtype of the CSR genre block. int32 is what scipy uses for matrices
+# this size, so views over the buffers need no conversion copy per query
+INDEX_DTYPE = np.int32
+
+
+def get_feature_vector(row):
+    return np.array([
+        row["bpm"], row["rms_energy"], row["spectral_centroid"],
+        row["spectral_bandwidth"], row["spectral_rolloff"], row["zero_crossing_rate"],
+        row["mfcc1"], row["mfcc2"], row["mfcc3"]
+    ], dtype=float)
+
+
+def build_genre_csr(features, genres, label_index, top_k=GENRE_TOP_K):
+    """
+    Builds the genre block for `features` as a CSR matrix straight from the
+    `genres` rows: one row per track, one column per label, only the stored
+    scores kept. Labels missing from `label_index` are appended to it. With
+    top_k > 0 only the top_k scores of each track are kept.
+    """
+    row_of = {r["id"]: i for i, r in enumerate(features)}
+    count = len(genres)
+    rows = np.fromiter((row_of.get(g["track_id"], -1) for g in genres), dtype=np.int64, count=count)
+    cols = np.fromiter((label_index.setdefault(g["label"], len(label_index)) for g in genres),
+                       dtype=np.int64, count=count)
+    scores = np.fromiter((g["score"] for g in genres), dtype="float32", count=count)
+    known = rows >= 0
+    rows, cols, scores = rows[known], cols[known], scores[known]
+
+    if top_k and len(rows):
+        order = np.lexsort((-scores, rows))
+        rows, cols, scores = rows[order], cols[order], scores[order]
+        rank = np.arange(len(rows)) - np.searchsorted(rows, rows)
+        rows, cols, scores = rows[rank < top_k], cols[rank < top_k], scores[rank < top_k]
+
+    block = sparse.csr_matrix((scores, (rows, cols)), shape=(len(features), len(label_index)), dtype="float32")
+    block.indices = block.indices.astype(INDEX_DTYPE, copy=False)
+    block.indptr = block.indptr.astype(INDEX_DTYPE, copy=False)
+    return block
+
+
+def _feature_stats(raw):
+    return {"count": len(raw), "sum": raw.sum(axis=0), "sumsq": (raw ** 2).sum(axis=0)}
+
+
+def _stats_mean_std(stats):
+    if stats["count"] == 0:
+        return np.zeros(N_FEATURES), np.ones(N_FEATURES)
+    mean = stats["sum"] / stats["count"]
+    var = np.maximum(stats["sumsq"] / stats["count"] - mean ** 2, 0)
+    return mean, np.sqrt(var) + 1e-8
+
+
+def _weighted_features(raw, mean, std):
+    return ((raw - mean) / std * FEATURE_WEIGHTS).astype("float32")
+
+
+def _sq_norms(feat, genres):
+    """Squared norms of combined vectors from their dense feature rows and CSR genre rows."""
+    return (feat ** 2).sum(axis=1) + np.asarray(genres.multiply(genres).sum(axis=1), dtype="float32").ravel()
+
+
+def _distances(dots, norms, q_norm, metric):
+    """Turns dot products with the query into distances for the metric."""
+    if metric == "cosine":
+        denom = norms * q_norm
+        return 1 - dots / np.where(denom == 0, 1, denom)
+    return np.sqrt(np.maximum(norms ** 2 + q_norm ** 2 - 2 * dots, 0))
+
+
+def _embedding_dots(emb, query):
+    """emb @ query in float32, upcasting the float16 rows a chunk at a time."""
+    dots = np.empty(len(emb), dtype="float32")
+    for start in range(0, len(emb), EMBEDDING_CHUNK_ROWS):
+        dots[start:start + EMBEDDING_CHUNK_ROWS] = emb[start:start + EMBEDDING_CHUNK_ROWS].astype("float32") @ query
+    return dots
+
+
+def _embedding_norms(emb):
+    norms = np.empty(len(emb), dtype="float32")
+    for start in range(0, len(emb), EMBEDDING_CHUNK_ROWS):
+        chunk = emb[start:start + EMBEDDING_CHUNK_ROWS].astype("float32")
+        norms[start:start + EMBEDDING_CHUNK_ROWS] = np.sqrt(np.einsum("ij,ij->i", chunk, chunk))
+    return norms
+
+
+def _query_distances(feat, genres, norms, row, metric, rows=None):
+    """Exact distances from row `row` to `rows` (all rows by default)."""
+    q_feat, q_genres, q_norm = feat[row], genres[row].toarray().ravel(), norms[row]
+    if rows is not None:
+        feat, genres, norms = feat[rows], genres[rows], norms[rows]
+    return _distances(feat @ q_feat + genres @ q_genres, norms, q_norm, metric)
+
+
+def _top_k(dists, k):
+    """Rows of the k smallest finite distances, closest first (O(n) + O(k log k))."""
+    k = min(k, len(dists))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    top = np.argpartition(dists, k - 1)[:k]
+    top = top[np.argsort(dists[top])]
+    return top[np.isfinite(dists[top])]
+
+
+def _grow(buf, n, extra):
+    """
+    Returns a buffer with room for n + extra rows whose first n rows are buf[:n].
+    Reuses buf while it has spare capacity, otherwise doubles it, so appending
+    is amortised O(rows appended). Views of buf[:n] held by readers stay valid.
+    """
+    if len(buf) >= n + extra and buf.flags.writeable:
+        return buf
+    new = np.empty((max(n + extra, 2 * n, 256),) + buf.shape[1:], dtype=buf.dtype)
+    new[:n] = buf[:n]
+    return new
+
+
+class SimilarityIndex:
+    """
+    In-memory vector index of the library used by find_similar_tracks.
+
+    The combined vector of a track is its weighted, normalised audio features
+    followed by its weighted genre scores. It is stored in two blocks: a dense
+    float32 block of N_FEATURES columns and a CSR genre block holding only the
+    scores the scanner kept (at most 50 of several hundred labels), plus the
+    cached norm of every combined vector. A query costs a small GEMV, a sparse
+    mat-vec, O(n) elementwise work and an O(n) argpartition for the top k:
+
+        dot       = F·q_f + G·q_g
+        cosine    = 1 - dot / (|x|·|q|)
+        euclidean = sqrt(|x|² + |q|² - 2·dot)
+
+    Tracks can also carry an embedding (the pooled AST embedding the scanner
+    stores), kept as a separate float16 block with its own norms and searched
+    exactly by embedding_search; rows without one are zero and never match.
+    The block is only filled once fill_embeddings() was called, until then
+    the embeddings passed to add() are ignored.
+
+    Deleted tracks are masked out and compacted lazily, appends go into
+    buffers that grow by doubling. Mutations take the lock and publish new
+    views, so readers never see a half-written row. Mutations and ANN
+    builds are serialised by a second lock; a FAISS index is built outside
+    the query lock and swapped in, so queries never wait for a build.
+    """
+
+    def __init__(self, labels=()):
+        self.labels = list(labels)
+        self.label_index = {label: i for i, label in enumerate(self.labels)}
+        self.n = 0
+        self.nnz = 0
+        self.n_dead = 0
+        self.row_of = {}
+        self.files = {}
+        self._ids = np.empty(0, dtype=np.int64)
+        self._raw = np.empty((0, N_FEATURES))
+        self._feat = np.empty((0, N_FEATURES), dtype="float32")
+        self._gdata = np.empty(0, dtype="float32")
+        self._gindices = np.empty(0, dtype=INDEX_DTYPE)
+        self._gindptr = np.zeros(1, dtype=INDEX_DTYPE)
+        self._norms = np.empty(0, dtype="float32")
+        self._alive = np.empty(0, dtype=bool)
+        self.emb_dim = 0
+        self.has_embeddings = False
+        self._emb = np.empty((0, 0), dtype="float16")
+        self._emb_norms = np.empty(0, dtype="float32")
+        self.stats = _feature_stats(self._raw)
+        self.mean, self.std = _stats_mean_std(self.stats)
+        self.ann = {}
+        self.ann_recall = {}
+        self._ann_building = set()
+        # _lock guards what queries read and is only held briefly; _write_lock
+        # is held by add/remove and ANN builds for their whole duration
+        self._lock = threading.RLock()
+        self._write_lock = threading.RLock()
+
+    # ---------------------------------------------------------
+    # Building and incremental updates
+    # ---------------------------------------------------------
+    @classmethod
+    def build(cls, features, genre_block, labels, embeddings=None):
+        """
+        Builds the index from `features` rows and a sparse genre block (see
+        build_genre_csr) whose rows are aligned with them and whose columns
+        follow `labels`. `embeddings` maps track ids to their embedding;
+        without them the index has no embedding block until fill_embeddings().
+        """
+        index = cls(labels)
+        index.has_embeddings = embeddings is not None
+        raw = np.array([get_feature_vector(r) for r in features], dtype=float).reshape(-1, N_FEATURES)
+        index.stats = _feature_stats(raw)
+        index.mean, index.std = _stats_mean_std(index.stats)
+        index._write_rows(features, raw, genre_block, embeddings)
+        return index
+
+    def save(self, path, generation):
+        """
+        Writes the live rows to the directory `path` as plain .npy files that
+        load() can memory-map, plus meta.json (written last). ANN indexes are
+        saved too when no rows are masked out, so row numbers still match.
+        Holds the writer lock, which keeps the rows put: updates wait for
+        the write, queries do not.
+        """
+        os.makedirs(path, exist_ok=True)
+        with self._write_lock:
+            # Without masked-out rows plain slices do, nothing is copied
+            live = slice(0, self.n) if self.n_dead == 0 else np.flatnonzero(self.alive)
+            ids = self.ids[live]
+            genres = self.genre_block()[live]
+            arrays = {
+                "ids": ids, "raw": self._raw[live], "feat": self._feat[live], "norms": self._norms[live],
+                "gdata": genres.data,
+                "gindices": genres.indices.astype(INDEX_DTYPE, copy=False),
+                "gindptr": genres.indptr.astype(INDEX_DTYPE, copy=False),
+            }
+            if self.has_embeddings:
+                arrays.update(emb=self._emb[live], emb_norms=self._emb_norms[live])
+            for name, array in arrays.items():
+                np.save(os.path.join(path, f"{name}.npy"), array)
+            with open(os.path.join(path, "files.json"), "w", encoding="utf-8") as f:
+                json.dump([self.files[track_id] for track_id in ids.tolist()], f, ensure_ascii=False)
+
+            ann = {}
+            if self.n_dead == 0:
+                for metric, index in list(self.ann.items()):
+                    if index is not None:
+                        index.save(os.path.join(path, f"ann_{metric}.faiss"))
+                        ann[metric] = {"kind": index.kind, "storage": index.storage,
+                                       "recall": self.ann_recall.get(metric, 0.0)}
+
+            meta = {
+                "version": SNAPSHOT_VERSION,
+                "generation": generation,
+                "labels": self.labels,
+                "emb_dim": self.emb_dim,
+                "embeddings": self.has_embeddings,
+                "stats": {k: np.asarray(v).tolist() for k, v in self.stats.items()},
+                "mean": self.mean.tolist(),
+                "std": self.std.tolist(),
+                "ann": ann,
+            }
+            with open(os.path.join(path, "meta.json"), "w", encoding="utf-8") as f:
+                json.dump(meta, f, ensure_ascii=False)
+
+    @staticmethod
+    def read_meta(path):
+        """Returns the snapshot's meta.json, or None if it is missing or from another version."""
+        try:
+            with open(os.path.join(path, "meta.json"), encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return meta if meta.get("version") == SNAPSHOT_VERSION else None
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Opens a snapshot written by save(). With mmap=True the vectors are
+        mapped read-only, so every process loading the same snapshot shares
+        one page-cache copy; the first incremental update copies them.
+        """
+        meta = cls.read_meta(path)
+        if meta is None:
+            raise ValueError(f"No usable similarity snapshot in {path}")
+
+        index = cls(meta["labels"])
+        ids = np.load(os.path.join(path, "ids.npy"))
+        with open(os.path.join(path, "files.json"), encoding="utf-8") as f:
+            files = json.load(f)
+
+        def load_array(name):
+            # Empty arrays have nothing worth mapping (and numpy refuses to map 0 bytes)
+            array = np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r" if mmap else None)
+            return array if array.size else np.array(array)
+
+        index._ids = ids
+        index._raw = load_array("raw")
+        index._feat = load_array("feat")
+        index._norms = load_array("norms")
+        index._gdata = load_array("gdata")
+        index._gindices = load_array("gindices")
+        index._gindptr = load_array("gindptr")
+        if meta["embeddings"]:
+            index._emb = load_array("emb")
+            index._emb_norms = load_array("emb_norms")
+            index.emb_dim = meta["emb_dim"]
+            index.has_embeddings = True
+        else:
+            # Rows without embeddings, like build() without them
+            index._emb = np.zeros((len(ids), 0), dtype="float16")
+            index._emb_norms = np.zeros(len(ids), dtype="float32")
+        index._alive = np.ones(len(ids), dtype=bool)
+        index.n = len(ids)
+        index.nnz = len(index._gdata)
+        index.row_of = {track_id: i for i, track_id in enumerate(ids.tolist())}
+        index.files = dict(zip(ids.tolist(), files))
+        index.stats = {k: np.array(v) if k != "count" else v for k, v in meta["stats"].items()}
+        index.mean, index.std = np.array(meta["mean"]), np.array(meta["std"])
+
+        for metric, info in meta["ann"].items():
+            storage = info.get("storage", "flat")
+            if storage != ANN_STORAGE:
+                print(f"[WARN] ANN index ({metric}) in the snapshot uses {storage} storage, "
+                      f"it will be rebuilt as {ANN_STORAGE}")
+                continue
+            try:
+                index.ann[metric] = AnnIndex.load(os.path.join(path, f"ann_{metric}.faiss"), info["kind"], metric, storage)
+                index.ann_recall[metric] = info["recall"]
+            except Exception as e:
+                print(f"[WARN] Failed to load ANN index ({metric}) from snapshot, it will be rebuilt: {e}")
+        return index
+
+    @property
+    def dim(self):
+        return N_FEATURES + len(self.labels)
+
+    @property
+    def ids(self):
+        return self._ids[:self.n]
+
+    @property
+    def alive(self):
+        return self._alive[:self.n]
+
+    def __len__(self):
+        return self.n - self.n_dead
+
+    def __contains__(self, track_id):
+        return track_id in self.row_of
+
+    def genre_block(self):
+        """CSR matrix over the weighted genre scores of all rows (a view, nothing is copied)."""
+        n, nnz = self.n, self.nnz
+        return sparse.csr_matrix(
+            (self._gdata[:nnz], self._gindices[:nnz], self._gindptr[:n + 1]),
+            shape=(n, len(self.labels)), copy=False,
+        )
+
+    def _embedding_rows(self, features, embeddings):
+        """
+        (width of the embedding block, float16 embedding rows aligned with
+        `features`). Tracks without an embedding, or with one of another
+        width than the library's, get a zero row.
+        """
+        vectors = [embeddings.get(r["id"]) for r in features] if embeddings else []
+        dim = self.emb_dim or next((len(v) for v in vectors if v is not None), 0)
+        rows = np.zeros((len(features), dim), dtype="float16")
+        skipped = 0
+        for i, vector in enumerate(vectors):
+            if vector is None:
+                continue
+            if len(vector) != dim:
+                skipped += 1
+                continue
+            rows[i] = vector
+        if skipped:
+            print(f"[WARN] {skipped} track embeddings are not {dim}-dimensional like the library's, ignoring them")
+        return dim, rows
+
+    def combined_vectors(self, rows=None):
+        """Dense combined vectors of the given rows (all rows by default), e.g. to build FAISS indexes."""
+        feat, genres = self._feat[:self.n], self.genre_block()
+        if rows is not None:
+            feat, genres = feat[rows], genres[rows]
+        return np.hstack([feat, genres.toarray()])
+
+    def _write_rows(self, features, raw, genre_block, embeddings=None):
+        """
+        Appends rows; `genre_block` holds the unweighted genre scores aligned
+        with `features`, `embeddings` maps track ids to their embedding.
+        """
+        n, m = self.n, len(features)
+        nnz, m_nnz = self.nnz, genre_block.nnz
+        if nnz + m_nnz > np.iinfo(INDEX_DTYPE).max:
+            raise OverflowError("Too many genre scores for the CSR index dtype")
+        feat = _weighted_features(raw, self.mean, self.std)
+        genre_block = sparse.csr_matrix(genre_block, dtype="float32") * np.float32(GENRE_WEIGHT)
+        emb_dim, emb = self._embedding_rows(features, embeddings if self.has_embeddings else None)
+        # The first embeddings give the block its width; earlier rows have none
+        emb_buf = self._emb if emb_dim == self.emb_dim else np.zeros((n, emb_dim), dtype="float16")
+
+        ids = _grow(self._ids, n, m)
+        raw_buf = _grow(self._raw, n, m)
+        feat_buf = _grow(self._feat, n, m)
+        norms = _grow(self._norms, n, m)
+        alive = _grow(self._alive, n, m)
+        gdata = _grow(self._gdata, nnz, m_nnz)
+        gindices = _grow(self._gindices, nnz, m_nnz)
+        gindptr = _grow(self._gindptr, n + 1, m)
+        emb_buf = _grow(emb_buf, n, m)
+        emb_norms = _grow(self._emb_norms, n, m)
+        ids[n:n + m] = [r["id"] for r in features]
+        raw_buf[n:n + m] = raw
+        feat_buf[n:n + m] = feat
+        norms[n:n + m] = np.sqrt(_sq_norms(feat, genre_block))
+        alive[n:n + m] = True
+        gdata[nnz:nnz + m_nnz] = genre_block.data
+        gindices[nnz:nnz + m_nnz] = genre_block.indices
+        gindptr[n + 1:n + m + 1] = genre_block.indptr[1:] + nnz
+        emb_buf[n:n + m] = emb
+        emb_norms[n:n + m] = _embedding_norms(emb)
+
+        with self._lock:
+            self._ids, self._raw, self._feat, self._norms, self._alive = ids, raw_buf, feat_buf, norms, alive
+            self._gdata, self._gindices, self._gindptr = gdata, gindices, gindptr
+            self._emb, self._emb_norms, self.emb_dim = emb_buf, emb_norms, emb_dim
+            self.files.update({r["id"]: r["file"] for r in features})
+            self.row_of.update({r["id"]: n + i for i, r in enumerate(features)})
+            self.n, self.nnz = n + m, nnz + m_nnz
+
+    def add(self, features, genres, embeddings=None):
+        """
+        Adds tracks from `features`/`genres` DB rows (and their embeddings,
+        {track id: vector}), replacing rows of ids that are already indexed. Cost scales with the number of tracks added
+        unless the normalisation drifts, the label space grows or compaction
+        kicks in.
+        """
+        with self._write_lock:
+            with self._lock:
+                self._remove_rows({r["id"] for r in features})
+            first_new_row = self.n
+
+            # New labels just become new columns, all zero for the existing rows
+            n_labels = len(self.label_index)
+            genre_block = build_genre_csr(features, genres, self.label_index)
+            if len(self.label_index) > n_labels:
+                print(f"[WARN] {len(self.label_index) - n_labels} new genre labels, widening the vector space")
+                with self._lock:
+                    self.labels = sorted(self.label_index, key=self.label_index.get)
+                    self._retire_ann()
+
+            raw = np.array([get_feature_vector(r) for r in features], dtype=float).reshape(-1, N_FEATURES)
+            self.stats["count"] += len(raw)
+            self.stats["sum"] = self.stats["sum"] + raw.sum(axis=0)
+            self.stats["sumsq"] = self.stats["sumsq"] + (raw ** 2).sum(axis=0)
+            self._write_rows(features, raw, genre_block, embeddings)
+
+            self._refresh_normalisation()
+            self._compact()
+            self._update_ann(first_new_row)
+
+    def fill_embeddings(self, load):
+        """
+        Fills the embedding block for every row from load() -> {track id:
+        vector}, e.g. on the first embedding search; add() keeps it current
+        from then on. load() runs under the writer lock, so tracks added
+        meanwhile are either in what it returns or added with theirs.
+        """
+        if self.has_embeddings:
+            # Without the writer lock: queries do not wait for updates
+            return
+        with self._write_lock:
+            if self.has_embeddings:
+                return
+            embeddings = load()
+            n = self.n
+            emb_dim, emb = self._embedding_rows([{"id": track_id} for track_id in self._ids[:n].tolist()], embeddings)
+            emb_norms = _embedding_norms(emb)
+            with self._lock:
+                self._emb, self._emb_norms, self.emb_dim = emb, emb_norms, emb_dim
+                self.has_embeddings = True
+
+    def remove(self, track_ids):
+        """Drops tracks from the index. Returns the number of tracks removed."""
+        with self._write_lock:
+            with self._lock:
+                removed = self._remove_rows(track_ids)
+            if removed and (self._refresh_normalisation() | self._compact()):
+                self._update_ann()
+            return removed
+
+    def _remove_rows(self, track_ids):
+        rows = [self.row_of.pop(track_id) for track_id in track_ids if track_id in self.row_of]
+        if not rows:
+            return 0
+        for track_id in self._ids[rows].tolist():
+            self.files.pop(track_id, None)
+
+        raw = self._raw[rows]
+        self.stats["count"] -= len(rows)
+        self.stats["sum"] = self.stats["sum"] - raw.sum(axis=0)
+        self.stats["sumsq"] = self.stats["sumsq"] - (raw ** 2).sum(axis=0)
+        self._alive[rows] = False
+        self.n_dead += len(rows)
+        return len(rows)
+
+    def _refresh_normalisation(self):
+        """
+        Recomputes the feature block of every row if the library stats drifted
+        past NORM_DRIFT_THRESHOLD. Works from the cached raw features, no DB
+        access; the genre block is left as is. Returns True if the vectors
+        changed, in which case the ANN indexes are retired with them.
+        """
+        mean, std = _stats_mean_std(self.stats)
+        drift = max(np.max(np.abs(mean - self.mean) / self.std), np.max(np.abs(std - self.std) / self.std))
+        if not drift > NORM_DRIFT_THRESHOLD:
+            return False
+
+        t0 = time.perf_counter()
+        # New buffers instead of writing in place so concurrent queries keep a consistent matrix
+        feat = _weighted_features(self._raw[:self.n], mean, std)
+        norms = np.sqrt(_sq_norms(feat, self.genre_block()))
+        with self._lock:
+            self._feat, self._norms = feat, norms
+            self.mean, self.std = mean, std
+            self._retire_ann()
+        print(f"[TIMER] перенормализация (дрейф {drift:.3f}): {time.perf_counter() - t0:.3f} сек")
+        return True
+
+    def _compact(self):
+        """
+        Drops masked-out rows once they make up COMPACT_DEAD_RATIO of the
+        index; row numbers change, so the ANN indexes are retired with them.
+        Returns True if it ran.
+        """
+        if self.n == 0 or self.n_dead <= COMPACT_DEAD_RATIO * self.n:
+            return False
+        keep = np.flatnonzero(self.alive)
+        genres = self.genre_block()[keep]
+        ids = self._ids[keep]
+        arrays = (ids, self._raw[keep], self._feat[keep], self._norms[keep], self._emb[keep], self._emb_norms[keep],
+                  genres.data, genres.indices.astype(INDEX_DTYPE, copy=False),
+                  genres.indptr.astype(INDEX_DTYPE, copy=False), np.ones(len(keep), dtype=bool))
+        row_of = {track_id: i for i, track_id in enumerate(ids.tolist())}
+        with self._lock:
+            (self._ids, self._raw, self._feat, self._norms, self._emb, self._emb_norms,
+             self._gdata, self._gindices, self._gindptr, self._alive) = arrays
+            self.row_of = row_of
+            self.n, self.nnz, self.n_dead = len(keep), genres.nnz, 0
+            self._retire_ann()
+        return True
+
+    # ---------------------------------------------------------
+    # Exact search
+    # ---------------------------------------------------------
+    def _view(self, track_id, exclude_ids):
+        """Consistent snapshot of the arrays plus the rows of the query and excluded tracks."""
+        with self._lock:
+            if track_id not in self.row_of:
+                raise ValueError(f"Трек с ID {track_id} не найден в индексе")
+            n = self.n
+            excluded = [self.row_of[t] for t in exclude_ids if t in self.row_of]
+            return (self._feat[:n], self.genre_block(), self._norms[:n], self._alive[:n],
+                    self.row_of[track_id], excluded)
+
+    def exact_search(self, track_id, k, metric="cosine", exclude_ids=()):
+        """
+        Returns (rows, distances) of the k nearest live rows to the track,
+        closest first. The track itself and `exclude_ids` are never returned.
+        """
+        if metric not in METRICS:
+            raise ValueError("Неизвестная метрика")
+        feat, genres, norms, alive, row, excluded = self._view(track_id, exclude_ids)
+
+        dists = _query_distances(feat, genres, norms, row, metric)
+        dists[~alive] = np.inf
+        dists[row] = np.inf
+        dists[excluded] = np.inf
+
+        top = _top_k(dists, k)
+        return top, dists[top]
+
+    def embedding_search(self, track_id, k, metric="cosine", exclude_ids=()):
+        """
+        Like exact_search, but by the distance between the tracks'
+        embeddings. Tracks without an embedding are never returned.
+        """
+        if metric not in METRICS:
+            raise ValueError("Неизвестная метрика")
+        if not self.has_embeddings:
+            raise ValueError("Эмбеддинги не загружены")
+        with self._lock:
+            if track_id not in self.row_of:
+                raise ValueError(f"Трек с ID {track_id} не найден в индексе")
+            n = self.n
+            emb, norms, alive = self._emb[:n], self._emb_norms[:n], self._alive[:n]
+            row = self.row_of[track_id]
+            excluded = [self.row_of[t] for t in exclude_ids if t in self.row_of]
+        if norms[row] == 0:
+            raise ValueError(f"У трека с ID {track_id} нет эмбеддинга")
+
+        dists = _distances(_embedding_dots(emb, emb[row].astype("float32")), norms, norms[row], metric)
+        dists[~alive | (norms == 0)] = np.inf
+        dists[row] = np.inf
+        dists[excluded] = np.inf
+
+        top = _top_k(dists, k)
+        return top, dists[top]
+
+    def search_many(self, track_ids, k, metric="cosine", exclude_ids=(), centroid=False):
+        """
+        Nearest neighbours for several seed tracks at once. Seeds are scored
+        with one matrix-matrix product (in chunks to bound memory) and are
+        never returned themselves, nor are `exclude_ids`.
+
+        Returns a list of (rows, distances) aligned with the seeds found in
+        the index, or a single (rows, distances) for their centroid when
+        centroid=True. Unknown seeds are skipped; see `row_of`.
+        """
+        if metric not in METRICS:
+            raise ValueError("Неизвестная метрика")
+        with self._lock:
+            n = self.n
+            feat, genres, norms, alive = self._feat[:n], self.genre_block(), self._norms[:n], self._alive[:n]
+            seeds = [self.row_of[t] for t in track_ids if t in self.row_of]
+            excluded = seeds + [self.row_of[t] for t in exclude_ids if t in self.row_of]
+        if not seeds:
+            return (np.empty(0, dtype=np.int64), np.empty(0)) if centroid else []
+
+        mask = ~alive
+        mask[excluded] = True
+
+        if centroid:
+            # Mean direction for cosine, mean point for euclidean
+            if metric == "cosine":
+                scale = 1 / np.where(norms[seeds] == 0, 1, norms[seeds])
+            else:
+                scale = np.ones(len(seeds), dtype="float32")
+            q_feat = (feat[seeds] * scale[:, None]).mean(axis=0)
+            q_genres = np.asarray(genres[seeds].multiply(scale[:, None]).mean(axis=0), dtype="float32").ravel()
+            q_norm = np.sqrt(q_feat @ q_feat + q_genres @ q_genres)
+            dists = _distances(feat @ q_feat + genres @ q_genres, norms, q_norm, metric)
+            dists[mask] = np.inf
+            top = _top_k(dists, k)
+            return top, dists[top]
+
+        results = []
+        chunk = max(1, SEARCH_MANY_MAX_CELLS // max(n, 1))
+        for start in range(0, len(seeds), chunk):
+            rows = seeds[start:start + chunk]
+            dots = feat[rows] @ feat.T + (genres @ genres[rows].toarray().T).T
+            dists = _distances(dots, norms, norms[rows, None], metric)
+            dists[:, mask] = np.inf
+            for d in dists:
+                top = _top_k(d, k)
+                results.append((top, d[top]))
+        return results
+
+    # ---------------------------------------------------------
+    # Approximate search
+    # ---------------------------------------------------------
+    def get_ann(self, metric="cosine", wait=True):
+        """
+        Returns the ANN index for the metric, building it on first use.
+        Returns None when the library is too small or faiss is not installed.
+        With wait=False a missing index is built in a background thread and
+        None is returned meanwhile, so the caller can search exactly.
+        """
+        with self._lock:
+            if metric in self.ann:
+                return self.ann[metric]
+            if not wait:
+                if metric not in self._ann_building:
+                    self._ann_building.add(metric)
+                    threading.Thread(target=self._build_ann_in_background, args=(metric,), daemon=True).start()
+                return None
+        with self._write_lock:
+            with self._lock:
+                # Built by another thread while we waited
+                if metric in self.ann:
+                    return self.ann[metric]
+            return self._rebuild_ann(metric)
+
+    def _build_ann_in_background(self, metric):
+        try:
+            self.get_ann(metric)
+        except Exception as e:
+            print(f"[WARN] Failed to build ANN index ({metric}), falling back to exact search: {e}")
+            traceback.print_exc()
+            with self._lock:
+                self.ann[metric] = None
+        finally:
+            with self._lock:
+                self._ann_building.discard(metric)
+
+    def _rebuild_ann(self, metric):
+        """
+        Builds the ANN index of the metric from the current rows and checks
+        its recall, then swaps it in. The caller holds _write_lock, so the
+        rows stay put; queries keep running meanwhile.
+        """
+        kind = choose_index_kind(self.n)
+        index, recall = None, 0.0
+        if kind is not None:
+            index = AnnIndex.build(self.combined_vectors(), metric=metric, kind=kind)
+            recall = self.check_ann_recall(metric=metric, index=index)
+        with self._lock:
+            self.ann[metric] = index
+            if index is not None:
+                self.ann_recall[metric] = recall
+        if index is not None and recall < ANN_MIN_RECALL:
+            print(f"[WARN] ANN recall@10 ({metric}) = {recall:.3f} is below {ANN_MIN_RECALL}, "
+                  f"engine=auto will keep using exact search")
+        return index
+
+    def _retire_ann(self):
+        """
+        Takes the ANN indexes out of service after existing rows changed (row
+        numbers or vectors no longer match them); queries search exactly
+        until _update_ann has rebuilt them. Called under _lock, in the same
+        section that publishes the changed rows.
+        """
+        for metric in self.ann:
+            self.ann[metric] = None
+
+    def _update_ann(self, first_new_row=None):
+        """
+        Keeps the ANN indexes in line with the vectors; the caller holds
+        _write_lock. Rows from first_new_row on are added to the live
+        indexes, retired ones are rebuilt, and the cosine one is built once
+        the library is large enough.
+        """
+        for metric in set(self.ann) | {"cosine"}:
+            index = self.ann.get(metric)
+            try:
+                if index is not None:
+                    if first_new_row is not None:
+                        # AnnIndex.add waits for the searches running on it
+                        index.add(self.combined_vectors(slice(first_new_row, self.n)))
+                elif metric in self.ann or choose_index_kind(self.n):
+                    self._rebuild_ann(metric)
+            except Exception as e:
+                print(f"[WARN] Failed to update ANN index ({metric}), falling back to exact search: {e}")
+                traceback.print_exc()
+                with self._lock:
+                    self.ann[metric] = None
+
+    def ann_search(self, track_id, k, metric="cosine", exclude_ids=(), index=None):
+        """
+        Like exact_search but through the ANN index (or `index`). May return
+        fewer than k rows when the index did not find enough live
+        candidates. A compressed index only picks a shortlist of
+        ANN_RERANK_FACTOR * k candidates, which are ranked by their exact
+        distances. Searches exactly while the index is being rebuilt.
+        """
+        # The index and the rows it is mapped back to are taken together: a
+        # change that renumbers or reshapes the rows retires the index under
+        # the same lock. The search itself runs outside it.
+        with self._lock:
+            if index is None:
+                index = self.ann.get(metric)
+            if index is not None:
+                feat, genres, norms, alive, row, excluded = self._view(track_id, exclude_ids)
+                n_dead = self.n_dead
+        if index is None:
+            return self.exact_search(track_id, k, metric, exclude_ids)
+
+        query = np.hstack([feat[row], genres[row].toarray().ravel()])
+        excluded = set(excluded)
+        excluded.add(row)
+        # Ask for enough neighbours to survive filtering of excluded and deleted rows
+        fetch = k + len(excluded) + min(n_dead, k)
+        rows, dists = index.search(query, fetch * ANN_RERANK_FACTOR if index.compressed else fetch)
+
+        keep = np.array([r < len(alive) and alive[r] and r not in excluded for r in rows.tolist()], dtype=bool)
+        rows, dists = rows[keep], dists[keep]
+        if index.compressed and len(rows):
+            dists = _query_distances(feat, genres, norms, row, metric, rows)
+            order = np.argsort(dists, kind="stable")
+            rows, dists = rows[order], dists[order]
+        return rows[:k], dists[:k]
+
+    def check_ann_recall(self, metric="cosine", top_n=10, sample_size=ANN_RECALL_SAMPLE, seed=0, index=None):
+        """
+        Measures recall@top_n of the ANN index (or of `index`, one not
+        swapped in yet) against exact search on a random sample of library
+        tracks used as queries. 1.0 means the ANN index returned exactly the
+        same neighbours for every sampled query.
+        """
+        if index is None:
+            index = self.ann.get(metric)
+        if index is None:
+            return 0.0
+        live_rows = np.flatnonzero(self.alive)
+        if len(live_rows) <= top_n:
+            return 1.0
+
+        t0 = time.perf_counter()
+        rng = np.random.default_rng(seed)
+        queries = rng.choice(live_rows, min(sample_size, len(live_rows)), replace=False)
+        hits = 0
+        for track_id in self.ids[queries].tolist():
+            exact, _ = self.exact_search(track_id, top_n, metric)
+            approx, _ = self.ann_search(track_id, top_n, metric, index=index)
+            hits += len(set(exact.tolist()).intersection(approx.tolist()))
+
+        recall = hits / (len(queries) * top_n)
+        print(f"[TIMER] ANN recall check ({metric}): recall@{top_n} = {recall:.3f} "
+              f"on {len(queries)} queries, {time.perf_counter() - t0:.3f} сек")
+        return recall
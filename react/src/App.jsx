@@ -205,7 +205,8 @@ function App() {
             genre: t.genre || 'Unknown',
             color: t.color || '#808080',
             last_played: t.last_played,
-            cover_url: t.cover_url
+            cover_url: t.cover_url,
+            cover_thumb_url: t.cover_thumb_url
           }));
           const p = [currentTrack, ...newTracks];
           setCurrentPlaylist(p);
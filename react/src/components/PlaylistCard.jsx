@@ -102,7 +102,7 @@ const PlaylistCard = ({ playlist, onClick, onLoadFromTrack }) => {
                 className="playlist-card-tracks-preview-item"
                 onClick={(e) => handleTrackClick(e, playlist.id, track.id)}
               >
-                <img src={track.cover_url || '/default-music-cover-dark.png'} alt={track.title} className="playlist-preview-item-cover" />
+                <img src={track.cover_thumb_url || track.cover_url || '/default-music-cover-dark.png'} alt={track.title} className="playlist-preview-item-cover" />
                 <div className="playlist-preview-item-info">
                   <span className="preview-item-title">{track.title}</span>
                   <span className="preview-item-artist">{track.artist}</span>
@@ -93,7 +93,7 @@ export default function TrackList({ API_URL, tracks, currentTrack, onTrackSelect
               style={{ '--animation-order': animationOrder }}
             >
               <img
-                src={track.cover_url || '/default-music-cover-dark.png'}
+                src={track.cover_thumb_url || track.cover_url || '/default-music-cover-dark.png'}
                 alt={track.title}
                 className="track-item-cover"
               />